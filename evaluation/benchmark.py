@@ -0,0 +1,307 @@
+"""
+Benchmarks of the pipeline (mgf -> library table -> MassQL queries -> labels -> FDR, and add_ms2 of the
+library generation) on seeded synthetic bile-acid libraries.
+
+Synthetic spectra carry the diagnostic fragments of NEW_QUERIES: the class fragments (with the precursor
+loss fragment) and the ion pairs of one isomer query chain (or of one part of a merged query, e.g.
+1-OH-Sidechain; 1-OH-core_2), with intensity ratios around the query thresholds, plus noise peaks. Names
+follow the new core library, so the labels come out of new_core_db_label.
+Every stage runs in a fresh worker process; wall time, peak RSS and spectra / s are saved as JSON, and a
+run can be compared against a saved baseline:
+
+    results = run_benchmarks([10000, 100000])
+    save_results(results, 'data/benchmark/baseline.json')
+    compare_to_baseline(run_benchmarks([10000, 100000]), 'data/benchmark/baseline.json')
+"""
+import os
+import re
+import sys
+import json
+import time
+import platform
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from query_engine import compile_query
+from main_evaluation import group_containers, get_query_names
+from new_core_db_msql import NEW_QUERIES
+from msql_common import MERGED_QUERIES
+
+
+STAGES = ['generate_library_df', 'massql_filter_gated', 'massql_filter', 'label', 'evaluation', 'add_ms2']
+
+# class mix of the synthetic library (None: no bile acid, noise only)
+CLASS_P = {'mono': 0.2, 'di': 0.35, 'tri': 0.3, None: 0.15}
+# mix of a raw repository dump, mostly other compounds
+RAW_DUMP_P = {'mono': 0.01, 'di': 0.01, 'tri': 0.01, None: 0.97}
+ADDUCTS = ['[M+H]+', '[M-H2O+H]+', '[M+Na]+']
+
+LIBRARY_GENERATION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'library_generation')
+
+
+def make_templates(massql_queries=NEW_QUERIES, containers=group_containers):
+    """
+    Fragments of every BA class and of every isomer query chain, from the compiled queries
+    """
+    templates = {}
+    for group, group_container in containers.items():
+        class_conditions = compile_query(massql_queries[get_query_names(group, group_container)[0]])
+        chains = []
+        for _group, (massql_groups, group_ls) in group_container.items():
+            chain = [compile_query(massql_queries[x]) for x in dict.fromkeys(massql_groups + [_group])
+                     if x in massql_queries]
+            chains.append((chain, group_ls))
+        # queries evaluated beside the containers (1-OH-core for di) are merged from their parts, one chain each
+        group_labels = list(dict.fromkeys(x for _, group_ls in chains for x in group_ls))
+        for query_name in get_query_names(group, group_container)[1:]:
+            for x in MERGED_QUERIES.get(query_name, []):
+                chains.append(([compile_query(massql_queries[x])], group_labels))
+        templates[group] = {
+            'fragments': [c['mz'] for c in class_conditions if c['type'] == 'prod' and c['mz'] is not None],
+            'losses': [c['x_offset'] for c in class_conditions if c['type'] == 'prod' and c['x_offset'] is not None],
+            'chains': chains,
+        }
+    return templates
+
+
+def _name_token(label):
+    """
+    New core style name of a group label: 3a7b12keto -> 3alpha7beta12keto
+    """
+    return re.sub(r'(\d)b', r'\1beta', re.sub(r'(\d)a', r'\1alpha', label))
+
+
+def _spectrum(rng, templates, all_labels, class_p=CLASS_P):
+    """
+    (precursor m/z, name, adduct, peaks dict m/z -> intensity) of one synthetic spectrum
+    """
+    group = list(class_p)[rng.choice(len(class_p), p=list(class_p.values()))]
+    precmz = round(float(rng.uniform(100, 900)), 4)
+    peaks = {round(precmz - 18.0106, 4): 1000.0}
+
+    if group is None:
+        label = all_labels[rng.integers(len(all_labels))]
+    else:
+        template = templates[group]
+        precmz = round(-template['losses'][0] + float(rng.uniform(60, 260)), 4)
+        peaks = {round(precmz - 18.0106, 4): 1000.0}
+        # class fragments, one of them missing now and then
+        fragments = template['fragments'] + [precmz + x for x in template['losses']]
+        missing = rng.integers(len(fragments)) if rng.random() < 0.1 else -1
+        for i, mz in enumerate(fragments):
+            if i != missing:
+                peaks[round(mz, 4)] = float(rng.uniform(50, 600))
+
+        # ion pairs of one isomer chain, the ratio is off now and then
+        chain, group_ls = template['chains'][rng.integers(len(template['chains']))]
+        for conditions in chain:
+            register = {}
+            for c in conditions:
+                if c['mz'] is None or c['type'] != 'prod':
+                    continue
+                if c['match_var'] is None:
+                    intensity = float(rng.uniform(120, 800))
+                    if c['ref_var'] is not None:
+                        register[c['ref_var']] = intensity
+                else:
+                    ratio = c['match_factor'] * (1 + rng.uniform(-0.5, 0.5) * c['match_tol_percent'] / 100)
+                    if rng.random() < 0.15:
+                        ratio = float(rng.uniform(0.1, 5))
+                    intensity = min(register.get(c['match_var'], 500.0) * ratio, 990.0)
+                peaks[round(c['mz'], 4)] = intensity
+
+        label = group_ls[rng.integers(len(group_ls))]
+        if rng.random() < 0.1:
+            label = all_labels[rng.integers(len(all_labels))]
+
+    # noise
+    n_noise = int(rng.integers(10, 40))
+    for mz, intensity in zip(rng.uniform(50, precmz, n_noise), rng.lognormal(3, 1, n_noise)):
+        peaks.setdefault(round(float(mz), 4), float(min(intensity, 900.0)))
+
+    adduct = ADDUCTS[rng.integers(len(ADDUCTS))]
+    return precmz, f'{_name_token(label)}_{adduct}', adduct, peaks
+
+
+def generate_library(out_mgf, n_spectra, seed=0, class_p=CLASS_P, chunk_size=10000):
+    """
+    Write a seeded synthetic library of n_spectra, chunk by chunk
+    class_p: probability of each BA class (None: other compounds)
+    """
+    rng = np.random.default_rng(seed)
+    templates = make_templates()
+    all_labels = sorted({x for t in templates.values() for _, group_ls in t['chains'] for x in group_ls})
+
+    os.makedirs(os.path.dirname(out_mgf) or '.', exist_ok=True)
+    tmp_mgf = f'{out_mgf}.{os.getpid()}.tmp'
+    with open(tmp_mgf, 'w') as file:
+        for start in range(0, n_spectra, chunk_size):
+            blocks = []
+            for i in range(start, min(start + chunk_size, n_spectra)):
+                precmz, name, adduct, peaks = _spectrum(rng, templates, all_labels, class_p)
+                peak_lines = '\n'.join(f'{mz:.4f} {peaks[mz]:.2f}' for mz in sorted(peaks))
+                blocks.append(f'BEGIN IONS\nPEPMASS={precmz:.4f}\nCHARGE=1\nNAME={name}\nADDUCT={adduct}\n'
+                              f'SCANS={i + 1}\n{peak_lines}\nEND IONS\n\n')
+            file.write(''.join(blocks))
+    os.replace(tmp_mgf, out_mgf)
+
+
+def _stage_add_ms2(library_mgf):
+    """
+    add_ms2 of gen_lib on a merged table with one row per synthetic spectrum (all in the mono file)
+    """
+    sys.path.insert(0, LIBRARY_GENERATION_DIR)
+    from gen_lib import add_ms2
+
+    df = pd.read_csv(library_mgf.replace('.mgf', '.tsv'), sep='\t', usecols=['NAME', 'PEPMASS', 'SCANS'])
+    merged_df = pd.DataFrame({'id': 'mono_' + df['SCANS'].astype(str), 'stage2_merged_scan': df['SCANS'],
+                              'new_name': df['NAME'], 'precmz': df['PEPMASS']})
+    os.makedirs('out', exist_ok=True)
+    merged_df.to_csv('out/merged_db_all_metadata.tsv', sep='\t', index=False)
+    for prefix in ['mono', 'di', 'tri']:
+        path = f'data/{prefix}_nowaterloss_stage2_result_merged.mgf'
+        if os.path.lexists(path):
+            os.remove(path)
+        if prefix == 'mono':
+            os.symlink(os.path.abspath(library_mgf), path)
+        else:
+            open(path, 'w').close()
+
+    add_ms2()
+
+
+def _run_stage(stage, work_dir, library_mgf):
+    """
+    Worker: run one stage in work_dir, return (seconds, peak RSS in MB)
+    """
+    import resource
+    from mgf_reader import write_library_tsv
+    from new_core_db_msql import massql_filter
+    from new_core_db_label import get_label
+    from main_evaluation import main_evaluation
+
+    os.chdir(work_dir)
+    start = time.perf_counter()
+    if stage == 'generate_library_df':
+        write_library_tsv(library_mgf, library_mgf.replace('.mgf', '.tsv'))
+    elif stage == 'massql_filter':
+        massql_filter(library_mgf, NEW_QUERIES)
+    elif stage == 'massql_filter_gated':
+        massql_filter(library_mgf, NEW_QUERIES, gated=True)
+    elif stage == 'label':
+        get_label(input_tsv=library_mgf.replace('.mgf', '_massql.tsv'), out_tsv='data/label/new_core_df.tsv')
+    elif stage == 'evaluation':
+        df = pd.read_csv('data/label/new_core_df.tsv', sep='\t')
+        # chain queries not in NEW_QUERIES (e.g. 3-OH) pass, as in the generator
+        for group_container in group_containers.values():
+            for massql_groups, _ in group_container.values():
+                for x in massql_groups:
+                    if x not in df.columns:
+                        df[x] = 1
+        for group in group_containers:
+            main_evaluation(group, label_tables=(df, df))
+    elif stage == 'add_ms2':
+        _stage_add_ms2(library_mgf)
+    else:
+        raise ValueError(f'Unknown stage: {stage}')
+    seconds = time.perf_counter() - start
+
+    # KB on Linux, bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return seconds, max_rss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def run_benchmarks(sizes=(10000,), stages=STAGES, seed=0, class_p=CLASS_P, work_dir='data/benchmark'):
+    """
+    Time every stage on synthetic libraries of the given sizes (generated once per size, seed and class mix,
+    then reused). Returns a dict with the environment and one result per (size, stage).
+    """
+    work_dir = os.path.abspath(work_dir)
+    mix = '' if class_p == CLASS_P else '_' + '_'.join(f'{k}{v:g}' for k, v in class_p.items())
+    results = []
+    for n_spectra in sizes:
+        run_dir = os.path.join(work_dir, f'n{n_spectra}_seed{seed}{mix}')
+        os.makedirs(os.path.join(run_dir, 'data', 'label'), exist_ok=True)
+        os.makedirs(os.path.join(run_dir, 'data', 'result'), exist_ok=True)
+        library_mgf = os.path.join(run_dir, 'data', 'library.mgf')
+        if not os.path.exists(library_mgf):
+            start = time.perf_counter()
+            generate_library(library_mgf, n_spectra, seed=seed, class_p=class_p)
+            print(f'{n_spectra} spectra generated in {time.perf_counter() - start:.1f} s')
+
+        for stage in stages:
+            # fresh process per stage, so that the peak RSS is the stage's own
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                try:
+                    seconds, peak_rss_mb = executor.submit(_run_stage, stage, run_dir, library_mgf).result()
+                except ImportError as e:
+                    print(f'{stage}: skipped, {e}')
+                    continue
+            results.append({'n_spectra': n_spectra, 'stage': stage, 'seconds': round(seconds, 4),
+                            'peak_rss_mb': round(peak_rss_mb, 1), 'spectra_per_s': round(n_spectra / seconds, 1)})
+            print(f'{n_spectra:>9} {stage:<20} {seconds:9.2f} s {peak_rss_mb:9.1f} MB '
+                  f'{n_spectra / seconds:12.0f} spectra/s')
+
+    return {
+        'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+                        'platform': platform.platform(), 'processor': platform.processor(),
+                        'cpu_count': os.cpu_count()},
+        'seed': seed,
+        'class_p': {str(k): v for k, v in class_p.items()},
+        'results': results,
+    }
+
+
+def save_results(results, out_json):
+    os.makedirs(os.path.dirname(out_json) or '.', exist_ok=True)
+    with open(out_json, 'w') as file:
+        json.dump(results, file, indent=1)
+
+
+def compare_to_baseline(results, baseline_json, max_slowdown=1.25, max_rss_growth=1.25):
+    """
+    Stages slower (or with a larger peak RSS) than the baseline by more than the given factors.
+    Returns the list of regressions, also printed.
+    """
+    with open(baseline_json) as file:
+        baseline = json.load(file)
+    for key in ['seed', 'class_p']:
+        if baseline.get(key) != results.get(key):
+            print(f'baseline {key} {baseline.get(key)} differs from {results.get(key)}')
+
+    baseline_results = {(x['n_spectra'], x['stage']): x for x in baseline['results']}
+    regressions = []
+    for x in results['results']:
+        base = baseline_results.get((x['n_spectra'], x['stage']))
+        if base is None:
+            continue
+        if x['seconds'] > base['seconds'] * max_slowdown:
+            regressions.append(f'{x["stage"]} ({x["n_spectra"]} spectra): {base["seconds"]:.2f} s -> '
+                               f'{x["seconds"]:.2f} s')
+        if x['peak_rss_mb'] > base['peak_rss_mb'] * max_rss_growth:
+            regressions.append(f'{x["stage"]} ({x["n_spectra"]} spectra): {base["peak_rss_mb"]:.0f} MB -> '
+                               f'{x["peak_rss_mb"]:.0f} MB peak RSS')
+
+    for x in regressions:
+        print(f'regression: {x}')
+    return regressions
+
+
+if __name__ == '__main__':
+    results = run_benchmarks([10000, 100000])
+
+    baseline_json = 'data/benchmark/baseline.json'
+    if os.path.exists(baseline_json):
+        compare_to_baseline(results, baseline_json)
+    else:
+        save_results(results, baseline_json)
+
+    # larger libraries, up to production scale
+    # results = run_benchmarks([1000000, 5000000], stages=['generate_library_df', 'massql_filter', 'label'])
+
+    # a raw repository dump, mostly other compounds
+    # results = run_benchmarks([100000], stages=['generate_library_df', 'massql_filter_gated', 'massql_filter'],
+    #                          class_p=RAW_DUMP_P)
@@ -1,3 +1,7 @@
+import os
+import json
+
+import numpy as np
 import pandas as pd
 
 
@@ -8,6 +12,19 @@ import pandas as pd
 # [16*]O_alpha [16*]=O
 
 
+# (column, label) in label order, the label is added if the column is > 0
+STEREO_LABELS = [
+    ('[1*]O_beta', '1b'), ('[2*]O_alpha', '2a'), ('[2*]O_beta', '2b'), ('[3*]=O', '3keto'),
+    ('[3*]O_alpha', '3a'), ('[3*]O_beta', '3b'), ('[4*]O_alpha', '4a'), ('[4*]O_beta', '4b'),
+    ('[6*]O_alpha', '6a'), ('[6*]O_beta', '6b'), ('[6*]=O', '6keto'), ('[7*]O_alpha', '7a'),
+    ('[7*]O_beta', '7b'), ('[7*]=O', '7keto'), ('[12*]O_alpha', '12a'), ('[12*]O_beta', '12b'),
+    ('[12*]=O', '12keto'), ('[14*]O_alpha', '14a'), ('[15*]O_alpha', '15a'), ('[15*]O_beta', '15b'),
+    ('[16*]O_alpha', '16a'), ('[16*]=O', '16keto'),
+]
+
+LABEL_COLUMNS = ['group', 'mono_gt', 'di_gt', 'tri_gt', 'di_1_sc_oh', 'amide']
+
+
 def process_unique_smiles():
 
     df = pd.read_csv('data/label/BILELIB19_Names_ok_labaled_IM.csv')
@@ -19,53 +36,39 @@ def process_unique_smiles():
     df = df.fillna(0)
 
     # for col [1*]O_beta, fill 1 if 1, else 0
-    df['[1*]O_beta'] = df['[1*]O_beta'].apply(lambda x: 1 if x == 1 else 0)
+    df['[1*]O_beta'] = (df['[1*]O_beta'] == 1).astype(int)
 
     # create labels
-    df['group'] = df.apply(lambda x: gen_label_stereo(x['[1*]O_beta'], x['[2*]O_alpha'], x['[2*]O_beta'], x['[3*]=O'],
-                                                      x['[3*]O_alpha'], x['[3*]O_beta'], x['[4*]O_alpha'],
-                                                      x['[4*]O_beta'],
-                                                      x['[6*]O_alpha'], x['[6*]O_beta'], x['[6*]=O'], x['[7*]O_alpha'],
-                                                      x['[7*]O_beta'], x['[7*]=O'], x['[12*]O_alpha'], x['[12*]O_beta'],
-                                                      x['[12*]=O'], x['[14*]O_alpha'], x['[15*]O_alpha'],
-                                                      x['[15*]O_beta'], x['[16*]O_alpha'], x['[16*]=O']), axis=1)
+    df['group'] = gen_label_table(df)
 
     # ground truth
-    df['mono_gt'] = df['[*]O'].apply(lambda x: 1 if x == 1 else 0)
-    df['di_gt'] = df['[*]O'].apply(lambda x: 1 if x == 2 else 0)
-    df['tri_gt'] = df['[*]O'].apply(lambda x: 1 if x == 3 else 0)
+    df['mono_gt'] = (df['[*]O'] == 1).astype(int)
+    df['di_gt'] = (df['[*]O'] == 2).astype(int)
+    df['tri_gt'] = (df['[*]O'] == 3).astype(int)
 
     #### Di, 1-SC-OH ############### any of the 3 queries
-    df['di_1_sc_oh'] = df['BA_Class'].apply(lambda x: 1 if x == 'Dihydroxy, 1_SC_OH' else 0)
+    df['di_1_sc_oh'] = (df['BA_Class'] == 'Dihydroxy, 1_SC_OH').astype(int)
 
-    df['amide'] = df['tail_has'].apply(lambda x: 1 if x == 'Amide' else 0)
+    df['amide'] = (df['tail_has'] == 'Amide').astype(int)
 
-    df = df[['SMILES', 'group', 'mono_gt', 'di_gt', 'tri_gt', 'di_1_sc_oh', 'amide']]
+    df = df[['SMILES'] + LABEL_COLUMNS]
 
     # save the df
     df.to_csv('data/label/BILELIB19_SMILES_group.tsv', sep='\t', index=False)
 
 
-def get_label():
+def get_label(label_index=None):
 
     df = pd.read_csv('data/BILELIB19_corrected_massql.tsv', sep='\t')
 
-    smiles_df = pd.read_csv('data/label/BILELIB19_SMILES_group.tsv', sep='\t')
-
-    # dictionary of mapping SMILES to group
-    smiles_dict = dict(zip(smiles_df['SMILES'], smiles_df['group']))
-    mono_gt_dict = dict(zip(smiles_df['SMILES'], smiles_df['mono_gt']))
-    di_gt_dict = dict(zip(smiles_df['SMILES'], smiles_df['di_gt']))
-    tri_gt_dict = dict(zip(smiles_df['SMILES'], smiles_df['tri_gt']))
-    di_1_sc_oh_dict = dict(zip(smiles_df['SMILES'], smiles_df['di_1_sc_oh']))
-    amide_dict = dict(zip(smiles_df['SMILES'], smiles_df['amide']))
+    if label_index is None:
+        label_index = load_label_index()
+    smiles_index, name_index = label_index
 
-    df['group'] = df['SMILES'].map(smiles_dict)
-    df['mono_gt'] = df['SMILES'].map(mono_gt_dict)
-    df['di_gt'] = df['SMILES'].map(di_gt_dict)
-    df['tri_gt'] = df['SMILES'].map(tri_gt_dict)
-    df['di_1_sc_oh'] = df['SMILES'].map(di_1_sc_oh_dict)
-    df['amide'] = df['SMILES'].map(amide_dict)
+    # SMILES -> group and ground truth, one join
+    labels = join_labels(df['SMILES'], smiles_index, 'SMILES')
+    for col in LABEL_COLUMNS:
+        df[col] = labels[col].values
 
     # should be either mono/di/tri BAs
     df = df[(df['mono_gt'] == 1) | (df['di_gt'] == 1) | (df['tri_gt'] == 1)].reset_index(drop=True)
@@ -73,71 +76,73 @@ def get_label():
     # should be amide
     df = df[df['amide'] == 1].reset_index(drop=True)
 
-    corrected_df = pd.read_csv('data/label/bilelib19_df_corrected.tsv', sep='\t')
-    # dictionary of mapping NAME to group
-    name_dict = dict(zip(corrected_df['NAME'], corrected_df['group']))
-
-    df['group'] = df['NAME'].map(name_dict)
+    # NAME -> corrected group
+    df['group'] = join_labels(df['NAME'], name_index, 'NAME')['group'].values
 
-    df['ADDUCT'] = df['NAME'].apply(lambda x: x.split(' ')[-1])
+    df['ADDUCT'] = df['NAME'].str.split(' ').str[-1]
 
     df.to_csv('data/label/bilelib19_df.tsv', sep='\t', index=False)
 
 
-def gen_label_stereo(o1b, o2a, o2b, k3, o3a, o3b, o4a, o4b, o6a, o6b, k6, o7a, o7b, k7, o12a, o12b, k12, o14a,
-                     o15a, o15b, o16a, k16):
+def _file_stamp(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def load_label_index(smiles_tsv='data/label/BILELIB19_SMILES_group.tsv',
+                     corrected_tsv='data/label/bilelib19_df_corrected.tsv',
+                     index_dir='data/label/label_index'):
+    """
+    SMILES -> labels and NAME -> group tables with one row per key (the last one, as with a dict).
+    Saved as Parquet in index_dir and rebuilt only when one of the source tables changes.
+    """
+    stamp = {'smiles': _file_stamp(smiles_tsv), 'corrected': _file_stamp(corrected_tsv)}
+    stamp_path = os.path.join(index_dir, 'stamp.json')
+    smiles_path = os.path.join(index_dir, 'smiles.parquet')
+    name_path = os.path.join(index_dir, 'name.parquet')
+
+    if os.path.exists(stamp_path):
+        with open(stamp_path) as file:
+            if json.load(file) == stamp:
+                return pd.read_parquet(smiles_path), pd.read_parquet(name_path)
+
+    smiles_df = pd.read_csv(smiles_tsv, sep='\t', usecols=['SMILES'] + LABEL_COLUMNS)
+    smiles_index = smiles_df.dropna(subset=['SMILES']).drop_duplicates(subset=['SMILES'], keep='last')
+    corrected_df = pd.read_csv(corrected_tsv, sep='\t', usecols=['NAME', 'group'])
+    name_index = corrected_df.dropna(subset=['NAME']).drop_duplicates(subset=['NAME'], keep='last')
+
+    os.makedirs(index_dir, exist_ok=True)
+    smiles_index.to_parquet(smiles_path, index=False)
+    name_index.to_parquet(name_path, index=False)
+    with open(stamp_path, 'w') as file:
+        json.dump(stamp, file)
+
+    return smiles_index.reset_index(drop=True), name_index.reset_index(drop=True)
+
+
+def join_labels(keys, index_df, key):
     """
-    generate label for BA
+    Columns of index_df for each key (NaN if the key is not in the index), as one lookup of the keys
+    in the index keys
     """
+    rows = pd.Index(index_df[key]).get_indexer(pd.Series(keys).values)
+
+    return index_df.drop(columns=key).reset_index(drop=True).reindex(rows).reset_index(drop=True)
+
+
+def gen_label_table(df, stereo_labels=STEREO_LABELS):
+    """
+    generate labels for all BAs at once: the labels of the stereo columns > 0, in label order
+    """
+    # one bit per position / stereo column, the label is built once per distinct bit pattern
+    flags = np.stack([df[col].values > 0 for col, _ in stereo_labels], axis=1)
+    bits = flags.astype(np.int64) @ (1 << np.arange(len(stereo_labels), dtype=np.int64))
+    patterns, inverse = np.unique(bits, return_inverse=True)
+
+    labels = np.array([''.join(label for k, (_, label) in enumerate(stereo_labels) if pattern >> k & 1)
+                       for pattern in patterns.tolist()], dtype=object)
 
-    group_name = ''
-
-    if o1b > 0:
-        group_name += '1b'
-    if o2a > 0:
-        group_name += '2a'
-    if o2b > 0:
-        group_name += '2b'
-    if k3 > 0:
-        group_name += '3keto'
-    if o3a > 0:
-        group_name += '3a'
-    if o3b > 0:
-        group_name += '3b'
-    if o4a > 0:
-        group_name += '4a'
-    if o4b > 0:
-        group_name += '4b'
-    if o6a > 0:
-        group_name += '6a'
-    if o6b > 0:
-        group_name += '6b'
-    if k6 > 0:
-        group_name += '6keto'
-    if o7a > 0:
-        group_name += '7a'
-    if o7b > 0:
-        group_name += '7b'
-    if k7 > 0:
-        group_name += '7keto'
-    if o12a > 0:
-        group_name += '12a'
-    if o12b > 0:
-        group_name += '12b'
-    if k12 > 0:
-        group_name += '12keto'
-    if o14a > 0:
-        group_name += '14a'
-    if o15a > 0:
-        group_name += '15a'
-    if o15b > 0:
-        group_name += '15b'
-    if o16a > 0:
-        group_name += '16a'
-    if k16 > 0:
-        group_name += '16keto'
-
-    return group_name
+    return pd.Series(labels[inverse.ravel()], index=df.index)
 
 
 if __name__ == '__main__':
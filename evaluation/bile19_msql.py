@@ -1,6 +1,6 @@
-import pandas as pd
-
-from massql import msql_engine
+from mgf_reader import write_library_tsv, correct_mgf, scans_rule
+from library_bundle import mgf_to_bundle, preprocess_bundle
+from msql_common import massql_filter
 
 
 NEW_QUERIES = {
@@ -41,109 +41,26 @@ NEW_QUERIES = {
 }
 
 
+# header rewrite rules of the library
+BILE19_RULES = [scans_rule()]
+
+
 def correct_scans(input_mgf='data/BILELIB19.mgf'):
     """
     Correct the scans in the library
     """
-
-    scan_cnt = 0
-    new_lines = []
-    # read mgf line by line
-    with open(input_mgf, 'r') as file:
-        for line in file:
-            # empty line
-            _line = line.strip()
-            if not _line:
-                new_lines.append(line)
-                continue
-            elif line.startswith('SCANS'):
-                new_lines.append(f'SCANS={scan_cnt}\n')
-                scan_cnt += 1
-            else:
-                new_lines.append(line)
-
-    # write the new mgf
+    # streamed block by block, the rules can also be passed to the readers to skip the corrected copy
     out_name = input_mgf.replace('.mgf', '_corrected.mgf')
-    with open(out_name, 'w') as file:
-        for line in new_lines:
-            file.write(line)
+    correct_mgf(input_mgf, out_name, BILE19_RULES)
 
 
 def generate_library_df(library_mgf):
     """
     Generate metadata dataframe for the mgf file
     """
-    with open(library_mgf, 'r') as file:
-        spectrum_list = []
-        for line in file:
-            # empty line
-            _line = line.strip()  # remove leading and trailing whitespace
-            if not _line:
-                continue
-            elif line.startswith('BEGIN IONS'):
-                spectrum = {}
-                # initialize spectrum
-                mz_list = []
-                intensity_list = []
-            elif line.startswith('END IONS'):
-                if len(mz_list) == 0:
-                    continue
-                spectrum['mz_ls'] = mz_list
-                spectrum['intensity_ls'] = intensity_list
-                spectrum_list.append(spectrum)
-                continue
-            else:
-                # if line contains '=', it is a key-value pair
-                if '=' in _line:
-                    # split by first '='
-                    key, value = _line.split('=', 1)
-                    spectrum[key] = value
-                else:
-                    # if no '=', it is a spectrum pair
-                    this_mz, this_int = _line.split()
-                    try:
-                        mz_list.append(float(this_mz))
-                        intensity_list.append(float(this_int))
-                    except:
-                        continue
-
-    df = pd.DataFrame(spectrum_list)
-
-    # drop cols of mz_ls and intensity_ls
-    df.drop(columns=['mz_ls', 'intensity_ls'], inplace=True)
-
     # save the result
     out_name = library_mgf.replace('.mgf', '.tsv')
-    df.to_csv(out_name, sep='\t', index=False)
-
-
-def massql_filter(input_mgf, massql_queries):
-    """
-    Filter the library for BA
-    """
-    # read the library
-    df = pd.read_csv(input_mgf.replace('.mgf', '.tsv'), sep='\t')
-
-    # process the queries
-    for query_name, input_query in massql_queries.items():
-        results_df = msql_engine.process_query(input_query, input_mgf)
-        if len(results_df) == 0:
-            df[query_name] = 0
-            continue
-        passed_scan_ls = results_df['scan'].values.tolist()
-        passed_scan_ls = [str(x) for x in passed_scan_ls]
-
-        df[query_name] = df['SCANS'].apply(lambda x: 1 if str(x) in passed_scan_ls else 0)
-
-    # merge 1-OH-Sidechain; 1-OH-core_1 and 1-OH-Sidechain; 1-OH-core_2 and 1-OH-Sidechain; 1-OH-core_3
-    df['1-OH-Sidechain; 1-OH-core'] = df['1-OH-Sidechain; 1-OH-core_1'] | df['1-OH-Sidechain; 1-OH-core_2'] | df[
-        '1-OH-Sidechain; 1-OH-core_3']
-    df.drop(['1-OH-Sidechain; 1-OH-core_1', '1-OH-Sidechain; 1-OH-core_2', '1-OH-Sidechain; 1-OH-core_3'], axis=1,
-            inplace=True)
-
-    # save the result
-    out_name = input_mgf.replace('.mgf', '_massql.tsv')
-    df.to_csv(out_name, sep='\t', index=False)
+    write_library_tsv(library_mgf, out_name)
 
 
 if __name__ == '__main__':
@@ -152,5 +69,14 @@ if __name__ == '__main__':
 
     # generate_library_df('data/BILELIB19_corrected.mgf')
 
+    # convert to a library bundle, later runs skip the mgf parsing
+    # mgf_to_bundle('data/BILELIB19_corrected.mgf')
+    # or straight from the raw mgf, correcting on the fly
+    # mgf_to_bundle('data/BILELIB19.mgf', 'data/BILELIB19_corrected.bundle', rules=BILE19_RULES)
+    # normalize and sort the bundle peaks once (top_n / min_rel_intensity also filter the noise peaks)
+    # preprocess_bundle('data/BILELIB19_corrected.bundle')
+
     massql_filter('data/BILELIB19_corrected.mgf', NEW_QUERIES)
+    # or keep the passed scans of every query, later runs only run new or edited queries
+    # massql_filter('data/BILELIB19_corrected.mgf', NEW_QUERIES, cache_dir='data/cache')
 
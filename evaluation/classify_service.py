@@ -0,0 +1,281 @@
+"""
+Real-time classification of incoming MS2 spectra, e.g. as an instrument run produces them.
+
+NEW_QUERIES are compiled once. Spectra come in as JSON lines on stdin or a local socket, one spectrum
+{"scan": ..., "precursor_mz": ..., "peaks": [[mz, intensity], ...]} or a list of spectra (a batch) per line,
+and each is answered with its query hits and its hierarchical class, following the group container chains
+of main_evaluation. {"command": "stats"} returns the throughput and latency counters.
+
+Variable (MS2PREC=X) queries take X from the precursor of each spectrum, as massql on a file holding that
+spectrum only, so a spectrum gets the same answer whatever it is batched with.
+"""
+import io
+import sys
+import json
+import time
+import queue
+import threading
+import socketserver
+from collections import deque
+
+import numpy as np
+
+from query_engine import FlatSpectra, compile_query, compile_plan, run_plan
+from main_evaluation import group_containers, get_query_names
+from msql_common import MERGED_QUERIES
+from bile19_msql import NEW_QUERIES
+
+
+def records_to_spectra(records):
+    """
+    FlatSpectra of a batch of JSON spectra, zero-intensity peaks are dropped as in load_mgf_peaks
+    """
+    peaks_ls = [np.asarray(x['peaks'], dtype=np.float64).reshape(-1, 2) for x in records]
+    peaks_ls = [x[x[:, 1] != 0] for x in peaks_ls]
+    peaks = np.concatenate(peaks_ls) if peaks_ls else np.zeros((0, 2))
+
+    offsets = np.zeros(len(records) + 1, dtype=np.int64)
+    np.cumsum([len(x) for x in peaks_ls], out=offsets[1:])
+
+    return FlatSpectra([str(x.get('scan', '')) for x in records], [float(x['precursor_mz']) for x in records],
+                       offsets, peaks[:, 0], peaks[:, 1])
+
+
+class Classifier:
+    """
+    Compiled queries and group container chains, with throughput and latency counters
+    """
+
+    def __init__(self, massql_queries=NEW_QUERIES, containers=group_containers, latency_window=10000):
+        compiled_queries = {}
+        for query_name, input_query in massql_queries.items():
+            try:
+                compiled_queries[query_name] = compile_query(input_query)
+            except ValueError as e:
+                print(f'{query_name}: {e}, skipped', file=sys.stderr)
+        self.plan = compile_plan(compiled_queries)
+
+        self.query_names = list(compiled_queries)
+        self.merged = {k: [self.query_names.index(x) for x in v] for k, v in MERGED_QUERIES.items()
+                       if all(x in compiled_queries for x in v)}
+        self.kept = [i for i, x in enumerate(self.query_names) if not any(x in v for v in MERGED_QUERIES.values())]
+        self.hit_names = [self.query_names[i] for i in self.kept] + list(self.merged)
+
+        # (class query, [(container query, chain, queries refined by it, possible groups)]) per BA class
+        # chain queries that are not run (e.g. 3-OH) pass, as in the evaluation
+        self.chains = []
+        for group, group_container in containers.items():
+            chains = []
+            for _group, (massql_groups, group_ls) in group_container.items():
+                if _group not in self.hit_names:
+                    continue
+                chain = [x for x in dict.fromkeys([_group] + massql_groups) if x in self.hit_names]
+                chains.append((_group, chain, set(chain) - {_group}, group_ls))
+            self.chains.append((get_query_names(group, group_container)[0], chains))
+
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.n_spectra = 0
+        self.n_batches = 0
+        self.busy_seconds = 0.0
+        self.batch_latency = deque(maxlen=latency_window)
+        self.spectrum_latency = deque(maxlen=latency_window)
+
+    def get_hits(self, spectra):
+        """
+        Spectrum x hit_names matrix (uint8)
+        """
+        hits = run_plan(spectra, self.plan, per_spectrum=True)
+        merged = [np.bitwise_or.reduce(hits[:, ids], axis=1) for ids in self.merged.values()]
+        return np.column_stack([hits[:, self.kept]] + merged)
+
+    def get_classes(self, hits):
+        """
+        Hierarchical class of one spectrum from its hits (dict): the BA classes hit, each with the most
+        specific group container queries whose whole chain hits
+        """
+        classes = []
+        for class_name, chains in self.chains:
+            if not hits.get(class_name):
+                continue
+            chain_hits = [x for x in chains if all(hits.get(q) for q in x[1])]
+            refined = set().union(*[x[2] for x in chain_hits])
+            classes.append({'class': class_name,
+                            'isomers': [{'query': x[0], 'groups': x[3]} for x in chain_hits if x[0] not in refined]})
+        return classes
+
+    def classify(self, records):
+        """
+        Hits and classes of a batch of JSON spectra
+        """
+        start = time.perf_counter()
+
+        spectra = records_to_spectra(records)
+        hit_matrix = self.get_hits(spectra)
+
+        out = []
+        for record, row in zip(records, hit_matrix.tolist()):
+            hits = dict(zip(self.hit_names, row))
+            out.append({'scan': record.get('scan'), 'hits': hits, 'classes': self.get_classes(hits)})
+
+        latency = time.perf_counter() - start
+        with self.lock:
+            self.n_spectra += len(records)
+            self.n_batches += 1
+            self.busy_seconds += latency
+            self.batch_latency.append(latency)
+            if records:
+                self.spectrum_latency.append(latency / len(records))
+
+        return out
+
+    def stats(self):
+        """
+        Throughput and latency counters (latency percentiles over the last batches, in ms)
+        """
+        with self.lock:
+            batch_latency = np.array(self.batch_latency) * 1000
+            spectrum_latency = np.array(self.spectrum_latency) * 1000
+            out = {
+                'n_spectra': self.n_spectra,
+                'n_batches': self.n_batches,
+                'uptime_s': time.perf_counter() - self.started,
+                'busy_s': self.busy_seconds,
+                'spectra_per_s': self.n_spectra / self.busy_seconds if self.busy_seconds else 0.0,
+                'mean_spectrum_ms': self.busy_seconds / self.n_spectra * 1000 if self.n_spectra else 0.0,
+            }
+        for name, values in [('batch_ms', batch_latency), ('spectrum_ms', spectrum_latency)]:
+            if len(values):
+                p50, p99 = np.percentile(values, [50, 99])
+                out[name] = {'p50': float(p50), 'p99': float(p99), 'max': float(values.max())}
+        return out
+
+
+def iter_line_groups(file, max_lines=256):
+    """
+    Lines of a text file in groups: the next line, then the lines already read behind it (up to max_lines),
+    so that spectra queued while the last group was classified are classified together
+    """
+    lines = queue.Queue(maxsize=max_lines * 4)
+
+    def read():
+        for line in file:
+            lines.put(line)
+        lines.put(None)
+
+    threading.Thread(target=read, daemon=True).start()
+
+    while True:
+        line = lines.get()
+        if line is None:
+            return
+        group = [line]
+        while len(group) < max_lines:
+            try:
+                line = lines.get_nowait()
+            except queue.Empty:
+                break
+            if line is None:
+                yield group
+                return
+            group.append(line)
+        yield group
+
+
+def _parse_line(line):
+    """
+    ('spectra', records, is_batch), ('command', name, None) or ('error', message, None)
+    """
+    try:
+        request = json.loads(line)
+    except ValueError as e:
+        return 'error', f'invalid JSON: {e}', None
+    if isinstance(request, dict) and 'command' in request:
+        return 'command', request['command'], None
+    if isinstance(request, list):
+        return 'spectra', request, True
+    return 'spectra', [request], False
+
+
+def handle_lines(classifier, line_groups, write):
+    """
+    Answer groups of JSON lines, in order: a spectrum, a list of spectra, or {"command": "stats" | "queries"}.
+    The spectra of all lines of a group are classified as one batch.
+    """
+    for group in line_groups:
+        requests = [_parse_line(x) for x in group if x.strip()]
+
+        spectra_requests = [x for x in requests if x[0] == 'spectra']
+        records = [record for x in spectra_requests for record in x[1]]
+        try:
+            results = iter(classifier.classify(records)) if records else None
+        except (KeyError, TypeError, ValueError, AttributeError):
+            # one bad line, classify the lines one by one
+            results = None
+
+        for kind, value, is_batch in requests:
+            if kind == 'error':
+                write({'error': value})
+            elif kind == 'command':
+                if value == 'stats':
+                    write(classifier.stats())
+                elif value == 'queries':
+                    write({'queries': classifier.hit_names})
+                else:
+                    write({'error': f'unknown command: {value}'})
+            else:
+                if results is not None:
+                    line_results = [next(results) for _ in value]
+                else:
+                    try:
+                        line_results = classifier.classify(value)
+                    except (KeyError, TypeError, ValueError, AttributeError) as e:
+                        write({'error': f'invalid spectrum: {e!r}'})
+                        continue
+                write(line_results if is_batch else line_results[0])
+
+
+def serve_stdin(classifier=None):
+    """
+    Classify JSON lines from stdin, answers on stdout in order, counters on stderr at the end
+    """
+    classifier = classifier or Classifier()
+
+    def write(obj):
+        sys.stdout.write(json.dumps(obj) + '\n')
+        sys.stdout.flush()
+
+    handle_lines(classifier, iter_line_groups(sys.stdin), write)
+    print(json.dumps(classifier.stats()), file=sys.stderr)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        def write(obj):
+            self.wfile.write((json.dumps(obj) + '\n').encode())
+            self.wfile.flush()
+
+        handle_lines(self.server.classifier, iter_line_groups(io.TextIOWrapper(self.rfile, encoding='utf-8')), write)
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def serve_socket(classifier=None, host='127.0.0.1', port=8765):
+    """
+    Classify JSON lines from local TCP connections, one answer line per request line
+    """
+    with _Server((host, port), _Handler) as server:
+        server.classifier = classifier or Classifier()
+        print(f'classifying on {host}:{port}', file=sys.stderr)
+        server.serve_forever()
+
+
+if __name__ == '__main__':
+    serve_stdin()
+
+    # or on a local socket
+    # serve_socket(port=8765)
@@ -0,0 +1,16 @@
+"""
+Fixtures shared by the tests. Run from evaluation/: python -m pytest -q
+"""
+import pytest
+
+from benchmark import generate_library
+
+
+@pytest.fixture(scope='session')
+def library_mgf(tmp_path_factory):
+    """
+    Tiny seeded synthetic library (mgf file)
+    """
+    input_mgf = str(tmp_path_factory.mktemp('library') / 'library.mgf')
+    generate_library(input_mgf, 200, seed=0)
+    return input_mgf
@@ -0,0 +1,96 @@
+"""
+Vectorized confusion counts for the query evaluation.
+
+Ground truth and predictions are integer-coded once into row x query matrices
+(0 = negative, 1 = positive, 2 = row not evaluated), then the TP/FP/TN/FN counts of
+all queries and datasets come out of a single np.bincount over the encoded pairs.
+"""
+import numpy as np
+import pandas as pd
+
+
+# bincount slot of each (gt, pred) pair is gt * 3 + pred
+TP_SLOT, FP_SLOT, TN_SLOT, FN_SLOT = 4, 1, 0, 3
+CONFUSION_SLOTS = [TP_SLOT, FP_SLOT, TN_SLOT, FN_SLOT]
+
+
+def encode_binary(values):
+    """
+    0 / 1 codes of a label or prediction array, 2 for anything else (e.g. NaN), which is never counted
+    """
+    values = np.asarray(values)
+    codes = np.full(values.shape, 2, dtype=np.int8)
+    codes[values == 0] = 0
+    codes[values == 1] = 1
+    return codes
+
+
+def group_ground_truth(groups, group_lists, substring=False):
+    """
+    Row x query ground truth (uint8) from the group labels.
+    group_lists: list of possible groups of each query
+    substring: a row matches if any group is a substring of its label, otherwise the label must equal one
+    """
+    # match the distinct labels only, then index by the label codes
+    codes, uniques = pd.factorize(pd.Series(groups, dtype=object), use_na_sentinel=False)
+    uniques = [str(x) for x in uniques]
+
+    label_gt = np.zeros((len(uniques) + 1, len(group_lists)), dtype=np.uint8)
+    for j, group_ls in enumerate(group_lists):
+        for i, label in enumerate(uniques):
+            if substring:
+                label_gt[i, j] = any(g in label for g in group_ls)
+            else:
+                label_gt[i, j] = label in group_ls
+
+    return label_gt[codes]
+
+
+def slot_counts(slots, dataset=None, n_datasets=1):
+    """
+    Counts of all 9 (gt, pred) slots of every query (and dataset) in one bincount.
+    slots: row x query matrix of gt * 3 + pred
+    dataset: dataset index of each row
+    Returns an int64 array of shape (n_datasets, n_queries, 9)
+    """
+    slots = np.asarray(slots, dtype=np.int64)
+    n_rows, n_queries = slots.shape
+    if dataset is None:
+        dataset = np.zeros(n_rows, dtype=np.int64)
+
+    slots = slots + (np.asarray(dataset, dtype=np.int64)[:, None] * n_queries + np.arange(n_queries)) * 9
+    counts = np.bincount(slots.ravel(), minlength=n_datasets * n_queries * 9)
+
+    return counts.reshape(n_datasets, n_queries, 9)
+
+
+def confusion_counts(gt, pred, dataset=None, n_datasets=1):
+    """
+    TP, FP, TN, FN of every query (and dataset) in one bincount.
+    gt, pred: row x query code matrices (see encode_binary)
+    dataset: dataset index of each row
+    Returns an int64 array of shape (n_datasets, n_queries, 4)
+    """
+    slots = np.asarray(gt, dtype=np.int64) * 3 + np.asarray(pred, dtype=np.int64)
+
+    return slot_counts(slots, dataset, n_datasets)[:, :, CONFUSION_SLOTS]
+
+
+def fn_adduct_counts(adducts, gt, pred):
+    """
+    Adduct counts of the false negatives of each query, as value_counts().to_dict()
+    (descending count, ties in order of first appearance, missing adducts dropped)
+    """
+    adduct_codes, adduct_names = pd.factorize(pd.Series(adducts, dtype=object))
+    fn = (np.asarray(gt) == 1) & (np.asarray(pred) == 0) & (adduct_codes >= 0)[:, None]
+
+    out = []
+    for j in range(fn.shape[1]):
+        codes = adduct_codes[fn[:, j]]
+        counts = np.bincount(codes, minlength=len(adduct_names))
+        first_pos = np.full(len(adduct_names), len(codes))
+        np.minimum.at(first_pos, codes, np.arange(len(codes)))
+        order = np.lexsort((first_pos, -counts))
+        out.append({adduct_names[k]: int(counts[k]) for k in order if counts[k] > 0})
+
+    return out
@@ -0,0 +1,211 @@
+"""
+Incremental runs for libraries that grow by small appends.
+
+Fingerprints of the spectra (scan, precursor m/z and peaks) and of the compiled queries are kept in one file
+with the scans and the last hit matrix, so only new or changed spectra and new or edited queries are run again.
+The confusion counts of main_evaluation are updated the same way: the counts of the label table rows that
+were removed or changed since the last run are subtracted, and only the new rows are scored and added.
+"""
+import os
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+from query_engine import load_spectra, compile_plan, run_plan
+from evaluation_core import CONFUSION_SLOTS, slot_counts, fn_adduct_counts
+from main_evaluation import group_containers, load_label_tables, get_adduct_masks, get_eval_matrices, \
+    get_query_names, evaluation_table, evaluation_out_name
+
+
+def spectrum_fingerprints(spectra):
+    """
+    64-bit fingerprint of every spectrum of a FlatSpectra, from its scan, precursor m/z and peaks
+    """
+    counts = np.diff(spectra.offsets)
+    position = np.arange(len(spectra.mz)) - np.repeat(spectra.offsets[:-1], counts)
+    peak_hash = (pd.util.hash_array(spectra.mz) ^ pd.util.hash_array(spectra.intensity) * np.uint64(3)
+                 ^ pd.util.hash_array(position) * np.uint64(5))
+
+    summed = np.zeros(spectra.n_spectra, dtype=np.uint64)
+    non_empty = counts > 0
+    if non_empty.any():
+        summed[non_empty] = np.add.reduceat(peak_hash, spectra.offsets[:-1][non_empty])
+
+    return (summed ^ pd.util.hash_array(spectra.scans.astype(object)) * np.uint64(7)
+            ^ pd.util.hash_array(spectra.precmz) * np.uint64(11) ^ pd.util.hash_array(counts) * np.uint64(13))
+
+
+def query_fingerprint(conditions):
+    """
+    Fingerprint of a compiled query
+    """
+    return hashlib.sha256(repr(conditions).encode()).hexdigest()[:16]
+
+
+def _save_npz(path, **arrays):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as file:
+        np.savez(file, **arrays)
+    os.replace(tmp_path, path)
+
+
+def _load_hit_state(state_dir):
+    """
+    (fingerprints, hits, query fingerprints) of the last run, Nones if there is none
+    """
+    hits_path = os.path.join(state_dir, 'hits.npz')
+    if not os.path.exists(hits_path):
+        return None, None, {}
+
+    with np.load(hits_path) as data:
+        return data['fingerprints'], data['hits'], dict(zip(data['query_names'].tolist(),
+                                                            data['query_fps'].tolist()))
+
+
+def update_hits(source, compiled_queries, state_dir):
+    """
+    Spectrum x query hit matrix of the library (bundle directory or mgf file) as run_plan, but only new or
+    changed spectra and new or edited queries are evaluated, the other hits come from the last run in state_dir.
+    Variable (MS2PREC=X) queries depend on the whole library, they are run again whenever it changes.
+    Returns (scans, hits)
+    """
+    spectra = load_spectra(source)
+    fingerprints = spectrum_fingerprints(spectra)
+    query_fps = {k: query_fingerprint(v) for k, v in compiled_queries.items()}
+
+    old_fingerprints, old_hits, old_query_fps = _load_hit_state(state_dir)
+
+    # row of each spectrum in the last run, -1 if new or changed (identical spectra share a row)
+    if old_fingerprints is None:
+        prev = np.full(spectra.n_spectra, -1, dtype=np.int64)
+        library_changed = True
+    else:
+        old_index = pd.Index(old_fingerprints)
+        first = ~old_index.duplicated()
+        prev = old_index[first].get_indexer(fingerprints)
+        prev = np.where(prev >= 0, np.flatnonzero(first)[prev], -1)
+        library_changed = not np.array_equal(np.sort(old_fingerprints), np.sort(fingerprints))
+    reused = prev >= 0
+    changed = np.flatnonzero(~reused)
+
+    old_columns = {name: j for j, name in enumerate(old_query_fps)}
+    hits = np.zeros((spectra.n_spectra, len(compiled_queries)), dtype=np.uint8)
+    rerun_all = []
+    rerun_changed = []
+    for j, (query_name, conditions) in enumerate(compiled_queries.items()):
+        variable = any(c['x_offset'] is not None for c in conditions)
+        if old_query_fps.get(query_name) != query_fps[query_name] or (variable and library_changed):
+            rerun_all.append(j)
+            continue
+        hits[reused, j] = old_hits[prev[reused], old_columns[query_name]]
+        rerun_changed.append(j)
+
+    names = list(compiled_queries)
+    if rerun_all:
+        plan = compile_plan({names[j]: compiled_queries[names[j]] for j in rerun_all})
+        hits[:, rerun_all] = run_plan(spectra, plan)
+    if rerun_changed and len(changed):
+        plan = compile_plan({names[j]: compiled_queries[names[j]] for j in rerun_changed})
+        hits[np.ix_(changed, rerun_changed)] = run_plan(spectra.take(changed), plan)
+
+    print(f'{len(changed)} new or changed spectra of {spectra.n_spectra}, '
+          f'{len(rerun_all)} of {len(names)} queries run on the whole library')
+
+    # one file replaced at once, the hits never go out of step with the fingerprints
+    os.makedirs(state_dir, exist_ok=True)
+    _save_npz(os.path.join(state_dir, 'hits.npz'), fingerprints=fingerprints, scans=spectra.scans, hits=hits,
+              query_names=np.array(names, dtype=str), query_fps=np.array([query_fps[x] for x in names], dtype=str))
+
+    return spectra.scans, hits
+
+
+def _row_keys(df_ls):
+    """
+    (dataset, row hash, occurrence) of every label table row, identical rows are told apart by occurrence
+    """
+    dataset = np.repeat(np.arange(len(df_ls)), [len(df) for df in df_ls])
+    row_hash = np.concatenate([pd.util.hash_pandas_object(df, index=False).values for df in df_ls])
+    occurrence = pd.DataFrame({'dataset': dataset, 'hash': row_hash}).groupby(['dataset', 'hash']).cumcount()
+
+    return dataset, row_hash, occurrence.values
+
+
+def incremental_evaluation(group='mono', adduct_filter=False, label_tables=None, state_dir='data/incremental'):
+    """
+    main_evaluation with delta confusion counts: rows of the label tables are matched to the last run by
+    content, only new or changed rows are scored, and the counts of removed or changed rows are subtracted
+    """
+    group_container = group_containers[group]
+
+    if label_tables is None:
+        label_tables = load_label_tables()
+    masks = get_adduct_masks(*label_tables, adduct_filter)
+    query_names = get_query_names(group, group_container)
+
+    dataset, row_hash, occurrence = _row_keys(label_tables)
+    keys = pd.MultiIndex.from_arrays([dataset, row_hash, occurrence])
+
+    # the state is only valid for the same queries, group container and table columns
+    config = repr((query_names, group_container, adduct_filter, [list(df.columns) for df in label_tables]))
+    config = hashlib.sha256(config.encode()).hexdigest()
+
+    state_path = os.path.join(state_dir, f'{group}_{"H" if adduct_filter else "all"}_evaluation.npz')
+    state = None
+    if os.path.exists(state_path):
+        with np.load(state_path) as data:
+            if str(data['config']) == config:
+                state = {k: data[k] for k in data.files}
+
+    slots = np.zeros((len(keys), len(query_names)), dtype=np.int8)
+    if state is None:
+        prev = np.full(len(keys), -1, dtype=np.int64)
+        counts = np.zeros((len(label_tables), len(query_names), 9), dtype=np.int64)
+    else:
+        old_keys = pd.MultiIndex.from_arrays([state['dataset'], state['row_hash'], state['occurrence']])
+        prev = old_keys.get_indexer(keys)
+        kept = np.zeros(len(old_keys), dtype=bool)
+        kept[prev[prev >= 0]] = True
+        slots[prev >= 0] = state['slots'][prev[prev >= 0]]
+        # subtract the rows that are gone
+        counts = state['counts'] - slot_counts(state['slots'][~kept], state['dataset'][~kept], len(label_tables))
+
+    # score the new rows only, BILELIB19 groups must match exactly, new core groups may be part of the name
+    new_rows = np.flatnonzero(prev < 0)
+    start = 0
+    for df, substring, mask in zip(label_tables, [False, True], masks):
+        rows = new_rows[(new_rows >= start) & (new_rows < start + len(df))] - start
+        if len(rows):
+            gt, pred = get_eval_matrices(df.iloc[rows].reset_index(drop=True), group, group_container, substring,
+                                         mask[rows])
+            slots[rows + start] = gt * 3 + pred
+        start += len(df)
+    counts += slot_counts(slots[new_rows], dataset[new_rows], len(label_tables))
+
+    print(f'{group}: {len(new_rows)} new or changed rows of {len(keys)} scored')
+
+    os.makedirs(state_dir, exist_ok=True)
+    _save_npz(state_path, config=np.array(config), dataset=dataset, row_hash=row_hash, occurrence=occurrence,
+              slots=slots, counts=counts)
+
+    # FN adduct forms value_counts, from the stored codes
+    fn_adducts = []
+    start = 0
+    for df in label_tables:
+        this_slots = slots[start:start + len(df)]
+        fn_adducts.append(fn_adduct_counts(df['ADDUCT'].values, this_slots // 3, this_slots % 3))
+        start += len(df)
+
+    out_df = evaluation_table(query_names, counts[:, :, CONFUSION_SLOTS], *fn_adducts)
+
+    out_df.to_csv(evaluation_out_name(group, adduct_filter), sep='\t', index=False)
+
+    return out_df
+
+
+if __name__ == '__main__':
+    label_tables = load_label_tables()
+
+    for adduct_filter in [False, True]:
+        for group in ['mono', 'di', 'tri']:
+            incremental_evaluation(group, adduct_filter=adduct_filter, label_tables=label_tables)
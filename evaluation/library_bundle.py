@@ -0,0 +1,239 @@
+"""
+Columnar spectral library bundle: a directory with the metadata table as Parquet and the peaks as
+memory-mapped .npy arrays with CSR-style offsets, converted once from the mgf file.
+
+    metadata.parquet   one row per non-empty spectrum, same table as the library TSV (values as in the mgf file)
+    offsets.npy        int64, peaks of spectrum i are [offsets[i], offsets[i + 1])
+    mz.npy             float64
+    intensity.npy      float64
+    precmz.npy         float64, PEPMASS (0 if missing)
+    index.npy          int64, 0-based position of each spectrum in the mgf file
+    scans.parquet      SCANS as in the mgf file (1-based position if missing)
+
+and, once preprocessed (preprocess_bundle), the peaks as the queries read them:
+
+    pp_offsets.npy, pp_mz.npy, pp_intensity.npy
+                       zero-intensity peaks dropped, noise filtered if asked, sorted by m/z in each spectrum
+    pp_i_norm.npy      float64, intensity relative to the base peak of the spectrum
+    pp_mz_order.npy    int64, order of all peaks by m/z (the global m/z index of query_engine)
+    preprocess.json    noise filter parameters and peak counts
+"""
+import os
+import json
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from mgf_reader import iter_mgf_batches, scan_mgf_keys, get_param
+
+
+NPY_HEADER_LEN = 128
+
+PREPROCESSED = ['offsets', 'mz', 'intensity', 'i_norm', 'mz_order']
+
+
+def _write_npy_header(file, dtype, n):
+    """
+    .npy (v1.0) header of a 1-D array, padded to a fixed length so it can be rewritten in place
+    """
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (np.dtype(dtype).str, n)
+    header = header.ljust(NPY_HEADER_LEN - 10 - 1) + '\n'
+    file.seek(0)
+    file.write(b'\x93NUMPY\x01\x00' + np.uint16(len(header)).tobytes() + header.encode('latin1'))
+
+
+def _open_npy(path, dtype):
+    file = open(path, 'wb')
+    _write_npy_header(file, dtype, 0)
+    return file
+
+
+def _close_npy(file, dtype):
+    n = (file.tell() - NPY_HEADER_LEN) // np.dtype(dtype).itemsize
+    _write_npy_header(file, dtype, n)
+    file.close()
+
+
+def mgf_to_bundle(input_mgf, bundle_dir=None, batch_size=10000, rules=None):
+    """
+    Convert the mgf file into a library bundle, streaming the peaks and the metadata batch by batch.
+    The metadata columns are collected in a first pass over the headers, the values are kept as strings.
+    rules: header rewrite rules (mgf_reader.scans_rule, charge_rule) applied while reading,
+    so a raw mgf can be converted without writing a corrected copy first
+    """
+    if bundle_dir is None:
+        bundle_dir = input_mgf.replace('.mgf', '.bundle')
+    os.makedirs(bundle_dir, exist_ok=True)
+    # the preprocessed peaks are stale once the peaks are rewritten
+    _drop_preprocessed(bundle_dir)
+
+    dtypes = {'offsets': np.int64, 'mz': np.float64, 'intensity': np.float64, 'precmz': np.float64,
+              'index': np.int64}
+    files = {name: _open_npy(os.path.join(bundle_dir, f'{name}.npy'), dtype) for name, dtype in dtypes.items()}
+
+    scans_schema = pa.schema([('scan', pa.string())])
+    scans_writer = pq.ParquetWriter(os.path.join(bundle_dir, 'scans.parquet'), scans_schema)
+    # every batch is written with the columns of the whole file
+    columns = scan_mgf_keys(input_mgf, rules=rules)
+    metadata_schema = pa.schema([(x, pa.string()) for x in columns])
+    metadata_writer = pq.ParquetWriter(os.path.join(bundle_dir, 'metadata.parquet'), metadata_schema)
+
+    n_peaks = 0
+    files['offsets'].write(np.zeros(1, dtype=np.int64).tobytes())
+    for batch in iter_mgf_batches(input_mgf, batch_size=batch_size, rules=rules):
+        files['offsets'].write((batch['offsets'][1:] + n_peaks).tobytes())
+        files['mz'].write(batch['mz'].astype(np.float64, copy=False).tobytes())
+        files['intensity'].write(batch['intensity'].astype(np.float64, copy=False).tobytes())
+        files['index'].write(batch['index'].tobytes())
+        files['precmz'].write(np.array([_get_precmz(x) for x in batch['records']], dtype=np.float64).tobytes())
+        n_peaks += batch['offsets'][-1]
+
+        scans = [_get_scan(x, i) for x, i in zip(batch['records'], batch['index'])]
+        scans_writer.write_table(pa.table({'scan': pa.array(scans, pa.string())}, schema=scans_schema))
+        metadata_writer.write_table(pa.table({x: pa.array([r.get(x) for r in batch['records']], pa.string())
+                                              for x in columns}, schema=metadata_schema))
+
+    for name, dtype in dtypes.items():
+        _close_npy(files[name], dtype)
+    scans_writer.close()
+    metadata_writer.close()
+
+    return bundle_dir
+
+
+def _get_precmz(record):
+    try:
+        return float(get_param(record, 'PEPMASS').split()[0])
+    except (AttributeError, IndexError, ValueError):
+        return 0.0
+
+
+def _get_scan(record, index):
+    # massql falls back to the 1-based spectrum index if SCANS is missing
+    scan = get_param(record, 'SCANS')
+    return scan.strip() if scan is not None else str(index + 1)
+
+
+def preprocess_peaks(offsets, mz, intensity, top_n=None, min_rel_intensity=None):
+    """
+    Batched preprocessing of flat peak arrays, with segment-wise reductions over the offsets:
+    zero-intensity peaks dropped (massql ignores them), intensities relative to the base peak of each spectrum,
+    optional noise filter, and peaks sorted by m/z within each spectrum (ties in peak order).
+    top_n: keep the top_n most intense peaks of each spectrum
+    min_rel_intensity: keep the peaks of at least this fraction of the base peak
+    Returns (offsets, mz, intensity, i_norm)
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    mz = np.asarray(mz, dtype=np.float64)
+    intensity = np.asarray(intensity, dtype=np.float64)
+    counts = np.diff(offsets)
+    n_spectra = len(counts)
+    spec_idx = np.repeat(np.arange(n_spectra), counts)
+
+    keep = intensity != 0
+    base_peak = np.full(n_spectra, np.nan)
+    non_empty = counts > 0
+    base_peak[non_empty] = np.maximum.reduceat(np.where(keep, intensity, -np.inf), offsets[:-1][non_empty])
+    i_norm = intensity / base_peak[spec_idx]
+
+    if min_rel_intensity is not None:
+        keep &= i_norm >= min_rel_intensity
+    if top_n is not None:
+        # rank by decreasing intensity within the spectrum, zero-intensity peaks last
+        order = np.lexsort((-np.where(keep, intensity, -np.inf), spec_idx))
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order)) - offsets[spec_idx[order]]
+        keep &= rank < top_n
+
+    spec_idx = spec_idx[keep]
+    order = np.lexsort((mz[keep], spec_idx))
+    offsets = np.zeros(n_spectra + 1, dtype=np.int64)
+    np.cumsum(np.bincount(spec_idx, minlength=n_spectra), out=offsets[1:])
+
+    return offsets, mz[keep][order], intensity[keep][order], i_norm[keep][order]
+
+
+def _drop_preprocessed(bundle_dir):
+    for name in ['preprocess.json'] + [f'pp_{x}.npy' for x in PREPROCESSED]:
+        path = os.path.join(bundle_dir, name)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def preprocess_bundle(bundle_dir, top_n=None, min_rel_intensity=None, chunk_peaks=2 ** 24):
+    """
+    One-time preprocessing of the peaks of a bundle (see preprocess_peaks), in chunks of about chunk_peaks,
+    stored in the bundle with the global m/z order of the peaks. load_bundle_peaks reads them from then on,
+    so the queries skip the normalization and the m/z sort of every load.
+    Without noise filter the query results are unchanged.
+    """
+    _drop_preprocessed(bundle_dir)
+    bundle = open_bundle(bundle_dir, columns=[])
+    offsets = bundle['offsets']
+    n_spectra = len(offsets) - 1
+
+    dtypes = {'offsets': np.int64, 'mz': np.float64, 'intensity': np.float64, 'i_norm': np.float64}
+    files = {name: _open_npy(os.path.join(bundle_dir, f'pp_{name}.npy'), dtype) for name, dtype in dtypes.items()}
+
+    n_peaks = 0
+    files['offsets'].write(np.zeros(1, dtype=np.int64).tobytes())
+    start = 0
+    while start < n_spectra:
+        end = int(min(max(np.searchsorted(offsets, offsets[start] + chunk_peaks, side='left'), start + 1),
+                      n_spectra))
+        chunk_offsets = offsets[start:end + 1]
+        pp_offsets, mz, intensity, i_norm = preprocess_peaks(
+            chunk_offsets - chunk_offsets[0], bundle['mz'][chunk_offsets[0]:chunk_offsets[-1]],
+            bundle['intensity'][chunk_offsets[0]:chunk_offsets[-1]], top_n, min_rel_intensity)
+
+        files['offsets'].write((pp_offsets[1:] + n_peaks).tobytes())
+        files['mz'].write(mz.tobytes())
+        files['intensity'].write(intensity.tobytes())
+        files['i_norm'].write(i_norm.tobytes())
+        n_peaks += pp_offsets[-1]
+        start = end
+
+    for name, dtype in dtypes.items():
+        _close_npy(files[name], dtype)
+
+    mz_order = np.argsort(np.load(os.path.join(bundle_dir, 'pp_mz.npy')), kind='stable')
+    np.save(os.path.join(bundle_dir, 'pp_mz_order.npy'), mz_order)
+
+    # written last, the preprocessed peaks are only used once it exists
+    params = {'top_n': top_n, 'min_rel_intensity': min_rel_intensity, 'n_peaks': int(offsets[-1]),
+              'n_peaks_kept': int(n_peaks)}
+    with open(os.path.join(bundle_dir, 'preprocess.json'), 'w') as file:
+        json.dump(params, file, indent=1)
+
+    print(f'{n_peaks} of {offsets[-1]} peaks kept')
+    return params
+
+
+def is_bundle(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, 'offsets.npy'))
+
+
+def open_bundle(bundle_dir, mmap_mode='r', columns=None):
+    """
+    Open a library bundle. Peak arrays are memory-mapped (zero-copy) unless mmap_mode is None.
+    Returns a dict with the metadata DataFrame (only the given columns, if any) and the arrays
+    (the preprocessed ones under 'preprocessed', if any).
+    """
+    bundle = {name: np.load(os.path.join(bundle_dir, f'{name}.npy'), mmap_mode=mmap_mode)
+              for name in ['offsets', 'mz', 'intensity', 'precmz', 'index']}
+    bundle['scans'] = pd.read_parquet(os.path.join(bundle_dir, 'scans.parquet'))['scan'].values.astype(str)
+    if os.path.exists(os.path.join(bundle_dir, 'preprocess.json')):
+        bundle['preprocessed'] = {name: np.load(os.path.join(bundle_dir, f'pp_{name}.npy'), mmap_mode=mmap_mode)
+                                  for name in PREPROCESSED}
+
+    metadata_path = os.path.join(bundle_dir, 'metadata.parquet')
+    if columns is not None:
+        # columns missing in the library are skipped
+        names = pq.ParquetFile(metadata_path).schema_arrow.names
+        columns = [x for x in columns if x in names]
+    bundle['metadata'] = pd.read_parquet(metadata_path, columns=columns)
+
+    return bundle
+
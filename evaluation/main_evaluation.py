@@ -1,5 +1,9 @@
+import numpy as np
 import pandas as pd
 
+from evaluation_core import encode_binary, group_ground_truth, confusion_counts, fn_adduct_counts
+from profiling import profile, report
+
 #######
 # only use M+H and M+H-H2O spectra ##########
 
@@ -48,151 +52,168 @@ tri_group_container = {
 }
 
 
-def main_evaluation(group='mono', adduct_filter=False):
+group_containers = {'mono': mono_group_container, 'di': di_group_container, 'tri': tri_group_container}
 
-    if group == 'mono':
-        group_container = mono_group_container
-    elif group == 'di':
-        group_container = di_group_container
-    elif group == 'tri':
-        group_container = tri_group_container
 
+def load_label_tables():
+    """
+    Labeled library tables (BILELIB19 positive mode, new core), read once for all evaluations
+    """
     bile19_df = pd.read_csv('data/label/bilelib19_df.tsv', sep='\t')
     new_core_df = pd.read_csv('data/label/new_core_df.tsv', sep='\t')
 
     # ion mode
     bile19_df = bile19_df[bile19_df['IONMODE'] == 'Positive'].reset_index(drop=True)
 
-    # adduct
+    return bile19_df, new_core_df
+
+
+def get_adduct_masks(bile19_df, new_core_df, adduct_filter):
+    """
+    Rows to evaluate, only M+H and M+H-H2O spectra with adduct_filter
+    """
     if adduct_filter:
-        bile19_df = bile19_df[bile19_df['ADDUCT'].isin(['M+H', 'M-H2O+H'])].reset_index(drop=True)
-        new_core_df = new_core_df[new_core_df['ADDUCT'].isin(['[M+H]+', '[M-H2O+H]+'])].reset_index(drop=True)
+        bile19_mask = bile19_df['ADDUCT'].isin(['M+H', 'M-H2O+H']).values
+        new_core_mask = new_core_df['ADDUCT'].isin(['[M+H]+', '[M-H2O+H]+']).values
+    else:
+        bile19_mask = np.ones(len(bile19_df), dtype=bool)
+        new_core_mask = np.ones(len(new_core_df), dtype=bool)
 
+    return bile19_mask, new_core_mask
+
+
+def get_eval_matrices(df, group, group_container, substring, row_mask):
+    """
+    Encoded row x query ground truth and predictions of one dataset.
+    Rows outside row_mask are not counted; the queries after the class query only count the rows
+    predicted to be in the class.
+    """
     group_name = f'{group}hydroxy'
     group_name = group_name[0].upper() + group_name[1:]
 
-    out_list = []
-    # Mono, Di, Tri queries
-    bile19_gt = bile19_df[f'{group}_gt'].values
-    bile19_pred = bile19_df[group_name].values
-    new_core_gt = new_core_df[f'{group}_gt'].values
-    new_core_pred = new_core_df[group_name].values
-
-    bile19_TP = sum((bile19_gt == 1) & (bile19_pred == 1))
-    bile19_FP = sum((bile19_gt == 0) & (bile19_pred == 1))
-    bile19_TN = sum((bile19_gt == 0) & (bile19_pred == 0))
-    bile19_FN = sum((bile19_gt == 1) & (bile19_pred == 0))
-    bile19_FN_adduct = bile19_df['ADDUCT'][(bile19_gt == 1) & (bile19_pred == 0)].value_counts()
-    bile19_FN_adduct = bile19_FN_adduct.to_dict()
-
-    new_core_TP = sum((new_core_gt == 1) & (new_core_pred == 1))
-    new_core_FP = sum((new_core_gt == 0) & (new_core_pred == 1))
-    new_core_TN = sum((new_core_gt == 0) & (new_core_pred == 0))
-    new_core_FN = sum((new_core_gt == 1) & (new_core_pred == 0))
-    new_core_FN_adduct = new_core_df['ADDUCT'][(new_core_gt == 1) & (new_core_pred == 0)].value_counts()
-    new_core_FN_adduct = new_core_FN_adduct.to_dict()
-
-    out_list.append([group_name, bile19_TP, bile19_FP, bile19_TN, bile19_FN, bile19_FN_adduct,
-                     new_core_TP, new_core_FP, new_core_TN, new_core_FN, new_core_FN_adduct,
-                     bile19_TP + new_core_TP, bile19_FP + new_core_FP, bile19_TN + new_core_TN,
-                     bile19_FN + new_core_FN])
-
-    # for other MassQL queries
-    bile19_df = bile19_df[bile19_df[group_name] == 1].reset_index(drop=True)
-    new_core_df = new_core_df[new_core_df[group_name] == 1].reset_index(drop=True)
+    gt_ls = [encode_binary(df[f'{group}_gt'].values)]
+    pred_ls = [encode_binary(df[group_name].values)]
 
     # 1-OH-Sidechain; 1-OH-core
     if group == 'di':
-        bile19_gt = bile19_df['di_1_sc_oh'].values
-        bile19_pred = bile19_df['1-OH-Sidechain; 1-OH-core'].values
-        new_core_gt = new_core_df['di_1_sc_oh'].values
-        new_core_pred = new_core_df['1-OH-Sidechain; 1-OH-core'].values
-
-        bile19_TP = sum((bile19_gt == 1) & (bile19_pred == 1))
-        bile19_FP = sum((bile19_gt == 0) & (bile19_pred == 1))
-        bile19_TN = sum((bile19_gt == 0) & (bile19_pred == 0))
-        bile19_FN = sum((bile19_gt == 1) & (bile19_pred == 0))
-        bile19_FN_adduct = bile19_df['ADDUCT'][(bile19_gt == 1) & (bile19_pred == 0)].value_counts()
-        bile19_FN_adduct = bile19_FN_adduct.to_dict()
-
-        new_core_TP = sum((new_core_gt == 1) & (new_core_pred == 1))
-        new_core_FP = sum((new_core_gt == 0) & (new_core_pred == 1))
-        new_core_TN = sum((new_core_gt == 0) & (new_core_pred == 0))
-        new_core_FN = sum((new_core_gt == 1) & (new_core_pred == 0))
-        new_core_FN_adduct = new_core_df['ADDUCT'][(new_core_gt == 1) & (new_core_pred == 0)].value_counts()
-        new_core_FN_adduct = new_core_FN_adduct.to_dict()
-
-        out_list.append(['1-OH-Sidechain; 1-OH-core', bile19_TP, bile19_FP, bile19_TN, bile19_FN, bile19_FN_adduct,
-                         new_core_TP, new_core_FP, new_core_TN, new_core_FN, new_core_FN_adduct,
-                         bile19_TP + new_core_TP, bile19_FP + new_core_FP, bile19_TN + new_core_TN,
-                         bile19_FN + new_core_FN])
-
-    for _group, _group_items in group_container.items():
-
-        massql_groups, group_ls = _group_items
-
-        if not isinstance(group_ls, list):
-            group_ls = [group_ls]
-
-        bile19_ground_truth = bile19_df['group'].apply(
-            lambda x: 1 if x and any(g == str(x) for g in group_ls) else 0).values
-
-        bile19_prediction = bile19_df[_group].values
-        for msql_group in massql_groups:
-            bile19_prediction = bile19_df[msql_group].values & bile19_prediction
-
-        bile19_TP = sum((bile19_ground_truth == 1) & (bile19_prediction == 1))
-        bile19_FP = sum((bile19_ground_truth == 0) & (bile19_prediction == 1))
-        bile19_TN = sum((bile19_ground_truth == 0) & (bile19_prediction == 0))
-        bile19_FN = sum((bile19_ground_truth == 1) & (bile19_prediction == 0))
-
-        # FN adduct forms value_counts
-        bile19_FN_adduct = bile19_df['ADDUCT'][(bile19_ground_truth == 1) & (bile19_prediction == 0)].value_counts()
-        bile19_FN_adduct = bile19_FN_adduct.to_dict()
-
-        new_core_ground_truth = new_core_df['group'].apply(lambda x: 1 if any(g in str(x) for g in group_ls) else 0)
-
-        new_core_prediction = new_core_df[_group].values
-        for msql_group in massql_groups:
-            new_core_prediction = new_core_df[msql_group].values & new_core_prediction
-
-        new_core_TP = sum((new_core_ground_truth == 1) & (new_core_prediction == 1))
-        new_core_FP = sum((new_core_ground_truth == 0) & (new_core_prediction == 1))
-        new_core_TN = sum((new_core_ground_truth == 0) & (new_core_prediction == 0))
-        new_core_FN = sum((new_core_ground_truth == 1) & (new_core_prediction == 0))
-
-        # FN adduct forms value_counts
-        new_core_FN_adduct = new_core_df['ADDUCT'][(new_core_ground_truth == 1) & (new_core_prediction == 0)].value_counts()
-        new_core_FN_adduct = new_core_FN_adduct.to_dict()
-
-        out_list.append([_group, bile19_TP, bile19_FP, bile19_TN, bile19_FN, bile19_FN_adduct,
-                         new_core_TP, new_core_FP, new_core_TN, new_core_FN, new_core_FN_adduct,
-                         bile19_TP + new_core_TP, bile19_FP + new_core_FP, bile19_TN + new_core_TN,
-                         bile19_FN + new_core_FN])
-
-    out_df = pd.DataFrame(out_list, columns=['group', 'bile19_TP', 'bile19_FP', 'bile19_TN', 'bile19_FN', 'bile19_FN_adduct',
-                                             'new_core_TP', 'new_core_FP', 'new_core_TN', 'new_core_FN', 'new_core_FN_adduct',
-                                             'total_TP', 'total_FP', 'total_TN', 'total_FN'])
+        gt_ls.append(encode_binary(df['di_1_sc_oh'].values))
+        pred_ls.append(encode_binary(df['1-OH-Sidechain; 1-OH-core'].values))
+
+    group_lists = []
+    for _group, (massql_groups, group_ls) in group_container.items():
+        group_lists.append(group_ls if isinstance(group_ls, list) else [group_ls])
+        prediction = np.bitwise_and.reduce([df[x].values for x in [_group] + massql_groups])
+        pred_ls.append(encode_binary(prediction))
+    group_gt = group_ground_truth(df['group'].values, group_lists, substring=substring)
+    gt_ls.extend(group_gt.T)
+
+    gt = np.stack(gt_ls, axis=1)
+    pred = np.stack(pred_ls, axis=1)
+
+    # other MassQL queries only for the spectra passing the class query
+    gt[~(df[group_name].values == 1), 1:] = 2
+    gt[~row_mask, :] = 2
+
+    return gt, pred
+
+
+def get_query_names(group, group_container):
+    """
+    Evaluated queries in row order: the class query (and 1-OH-core for di), then the group container
+    """
+    group_name = f'{group}hydroxy'
+    group_name = group_name[0].upper() + group_name[1:]
+    return [group_name] + (['1-OH-Sidechain; 1-OH-core'] if group == 'di' else []) + list(group_container)
+
+
+def get_query_gates(containers=group_containers):
+    """
+    Class query of every other evaluated query (query name -> list of class queries): their predictions
+    only count for the spectra passing it
+    """
+    gates = {}
+    for group, group_container in containers.items():
+        query_names = get_query_names(group, group_container)
+        for x in query_names[1:]:
+            gates.setdefault(x, []).append(query_names[0])
+
+    return gates
+
+
+def evaluation_table(query_names, counts, bile19_FN_adduct, new_core_FN_adduct):
+    """
+    Result table from the (dataset, query, TP/FP/TN/FN) counts and the FN adduct counts
+    """
+    total = counts.sum(axis=0)
+    out_df = pd.DataFrame({
+        'group': query_names,
+        'bile19_TP': counts[0, :, 0], 'bile19_FP': counts[0, :, 1], 'bile19_TN': counts[0, :, 2],
+        'bile19_FN': counts[0, :, 3], 'bile19_FN_adduct': bile19_FN_adduct,
+        'new_core_TP': counts[1, :, 0], 'new_core_FP': counts[1, :, 1], 'new_core_TN': counts[1, :, 2],
+        'new_core_FN': counts[1, :, 3], 'new_core_FN_adduct': new_core_FN_adduct,
+        'total_TP': total[:, 0], 'total_FP': total[:, 1], 'total_TN': total[:, 2], 'total_FN': total[:, 3],
+    })
     out_df['total_FDR'] = out_df['total_FP'] / (out_df['total_FP'] + out_df['total_TP'])
     out_df['total_FNR'] = out_df['total_FN'] / (out_df['total_FN'] + out_df['total_TP'])
 
+    return out_df
+
+
+def evaluation_out_name(group, adduct_filter):
     if adduct_filter:
-        out_name = f'data/result/{group}_evaluation_H_adducts.tsv'
-    else:
-        out_name = f'data/result/{group}_evaluation_all_adducts.tsv'
+        return f'data/result/{group}_evaluation_H_adducts.tsv'
+    return f'data/result/{group}_evaluation_all_adducts.tsv'
+
+
+def main_evaluation(group='mono', adduct_filter=False, label_tables=None):
+
+    group_container = group_containers[group]
+
+    if label_tables is None:
+        with profile('load label tables'):
+            label_tables = load_label_tables()
+    bile19_df, new_core_df = label_tables
+    n_rows = len(bile19_df) + len(new_core_df)
+
+    bile19_mask, new_core_mask = get_adduct_masks(bile19_df, new_core_df, adduct_filter)
 
-    out_df.to_csv(out_name, sep='\t', index=False)
+    query_names = get_query_names(group, group_container)
+
+    # BILELIB19 groups must match exactly, new core groups may be part of the name
+    with profile('ground truth and predictions', n_spectra=n_rows):
+        bile19_gt, bile19_pred = get_eval_matrices(bile19_df, group, group_container, False, bile19_mask)
+        new_core_gt, new_core_pred = get_eval_matrices(new_core_df, group, group_container, True, new_core_mask)
+
+    # confusion counts of both datasets and all queries at once
+    with profile('confusion counts', n_spectra=n_rows):
+        dataset = np.repeat([0, 1], [len(bile19_df), len(new_core_df)])
+        counts = confusion_counts(np.vstack([bile19_gt, new_core_gt]), np.vstack([bile19_pred, new_core_pred]),
+                                  dataset=dataset, n_datasets=2)
+
+    # FN adduct forms value_counts
+    with profile('FN adducts', n_spectra=n_rows):
+        bile19_FN_adduct = fn_adduct_counts(bile19_df['ADDUCT'].values, bile19_gt, bile19_pred)
+        new_core_FN_adduct = fn_adduct_counts(new_core_df['ADDUCT'].values, new_core_gt, new_core_pred)
+
+    out_df = evaluation_table(query_names, counts, bile19_FN_adduct, new_core_FN_adduct)
+
+    with profile('write tsv'):
+        out_df.to_csv(evaluation_out_name(group, adduct_filter), sep='\t', index=False)
+
+    report(f'main_evaluation_{group}_{"H" if adduct_filter else "all"}_adducts')
 
 
 if __name__ == '__main__':
-    main_evaluation('mono')
+    label_tables = load_label_tables()
+
+    main_evaluation('mono', label_tables=label_tables)
 
-    main_evaluation('di')
+    main_evaluation('di', label_tables=label_tables)
 
-    main_evaluation('tri')
+    main_evaluation('tri', label_tables=label_tables)
 
-    main_evaluation('mono', adduct_filter=True)
+    main_evaluation('mono', adduct_filter=True, label_tables=label_tables)
 
-    main_evaluation('di', adduct_filter=True)
+    main_evaluation('di', adduct_filter=True, label_tables=label_tables)
 
-    main_evaluation('tri', adduct_filter=True)
+    main_evaluation('tri', adduct_filter=True, label_tables=label_tables)
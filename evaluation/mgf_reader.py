@@ -0,0 +1,328 @@
+"""
+Streaming mgf reader: spectra are read in fixed-size batches, with the peaks of a batch in contiguous
+NumPy buffers and CSR-style offsets, so memory stays flat no matter how big the file is.
+"""
+import re
+import itertools
+from contextlib import nullcontext
+
+import numpy as np
+import pandas as pd
+
+
+# line ends of a file read in text mode: CRLF, CR or LF
+LINE_END = re.compile(rb'\r\n|\r|\n')
+BEGIN_IONS = re.compile(r'^BEGIN IONS', re.M)
+END_IONS = re.compile(r'^END IONS', re.M)
+
+
+def _decode(data):
+    """
+    Decode a block with the line ends of a file read in text mode (CRLF and CR become LF)
+    """
+    if b'\r' in data:
+        data = data.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+    return data.decode()
+
+
+def scans_rule(start=0, indented=False):
+    """
+    Header rule: renumber SCANS as start, start + 1, ... in file order
+    indented: also rewrite indented SCANS lines, without their indentation (only column 0 otherwise)
+    """
+    def make_rule():
+        counter = itertools.count(start)
+        return lambda value: str(next(counter))
+    return 'SCANS', make_rule, indented
+
+
+def charge_rule(charge=1, indented=False):
+    """
+    Header rule: force CHARGE to the given value
+    indented: also rewrite indented CHARGE lines, without their indentation (only column 0 otherwise)
+    """
+    return 'CHARGE', lambda: (lambda value: str(charge)), indented
+
+
+def _make_rewriter(rules):
+    """
+    Block rewriter for a list of (key, rule factory, indented) header rules, with fresh rule state
+    """
+    rule_funcs = {key: make_rule() for key, make_rule, _ in rules}
+    indented_keys = {key for key, _, indented in rules if indented}
+    pattern = re.compile(r'^([^\S\n]*)(%s)=(.*)$' % '|'.join(re.escape(x) for x in rule_funcs), re.M)
+
+    def replace(m):
+        # indented lines are left as they are, unless the rule takes them
+        if m.group(1) and m.group(2) not in indented_keys:
+            return m.group(0)
+        return f'{m.group(2)}={rule_funcs[m.group(2)](m.group(3))}'
+
+    def rewrite(block):
+        return pattern.sub(replace, block)
+
+    return rewrite
+
+
+def iter_mgf_blocks(input_mgf, start=0, end=None, block_bytes=1024 * 1024, rules=None):
+    """
+    Text blocks of about block_bytes that hold whole spectra, optionally restricted to the byte range [start, end).
+    input_mgf: path or binary file object (e.g. sys.stdin.buffer)
+    rules: header rewrite rules (see scans_rule, charge_rule) applied on the fly
+    """
+    rewrite = _make_rewriter(rules) if rules else None
+
+    if hasattr(input_mgf, 'read'):
+        # the caller keeps ownership of the stream
+        file = nullcontext(input_mgf)
+    else:
+        file = open(input_mgf, 'rb')
+        file.seek(start)
+
+    with file as file:
+        remaining = None if end is None else end - start
+        carry = b''
+        while True:
+            size = block_bytes if remaining is None else min(block_bytes, remaining)
+            data = file.read(size) if size > 0 else b''
+            if remaining is not None:
+                remaining -= len(data)
+            if not data:
+                if carry:
+                    block = _decode(carry)
+                    yield rewrite(block) if rewrite else block
+                return
+
+            data = carry + data
+            # cut after the line end of the last END IONS line
+            cut = max(data.rfind(b'\nEND IONS'), data.rfind(b'\rEND IONS'))
+            line_end = LINE_END.search(data, cut + 1) if cut != -1 else None
+            # a CR at the end of the data may be the first half of a CRLF
+            if line_end is None or line_end.end() == len(data) and data.endswith(b'\r'):
+                carry = data
+                continue
+            cut = line_end.end()
+            carry = data[cut:]
+            block = _decode(data[:cut])
+            yield rewrite(block) if rewrite else block
+
+
+def correct_mgf(input_mgf, out_name, rules):
+    """
+    Stream the mgf file through the header rewrite rules into out_name (path or text file object)
+    """
+    out_file = out_name if hasattr(out_name, 'write') else open(out_name, 'w')
+    try:
+        for block in iter_mgf_blocks(input_mgf, rules=rules):
+            out_file.write(block)
+    finally:
+        if out_file is not out_name:
+            out_file.close()
+
+
+def iter_mgf_spectra(input_mgf, start=0, end=None, rules=None):
+    """
+    Lines of each complete spectrum (between BEGIN IONS and END IONS) in the mgf file
+    """
+    for block in iter_mgf_blocks(input_mgf, start, end, rules=rules):
+        # BEGIN IONS and END IONS lines start at column 0
+        for spec_text in BEGIN_IONS.split(block)[1:]:
+            spec_text = END_IONS.split(spec_text, 1)
+            if len(spec_text) == 1:
+                # not terminated
+                continue
+            yield spec_text[0].split('\n')
+
+
+def index_mgf_chunks(input_mgf, chunk_bytes):
+    """
+    Split the mgf file into chunks of about chunk_bytes at BEGIN IONS boundaries.
+    Returns a list of (start byte, end byte, number of spectra before the chunk)
+    """
+    chunks = []
+    chunk_start = 0
+    chunk_first_spectrum = 0
+    spec_cnt = 0
+    pos = 0
+    with open(input_mgf, 'rb') as file:
+        for line in file:
+            if line.startswith(b'BEGIN IONS'):
+                if pos - chunk_start >= chunk_bytes:
+                    chunks.append((chunk_start, pos, chunk_first_spectrum))
+                    chunk_start = pos
+                    chunk_first_spectrum = spec_cnt
+                spec_cnt += 1
+            pos += len(line)
+    chunks.append((chunk_start, pos, chunk_first_spectrum))
+
+    return chunks
+
+
+def _has_mz(line):
+    """
+    Whether the m/z of a peak line can be read, generate_library_df kept the spectra with such a line even if
+    none of their intensities could be read
+    """
+    tokens = line.split()
+    try:
+        float(tokens[0])
+    except (IndexError, ValueError):
+        return False
+    return len(tokens) >= 2
+
+
+def _parse_peak_lines(peak_lines, counts):
+    """
+    Parse the peak lines of a batch into mz and intensity buffers, return (mz, intensity, counts, has_mz),
+    has_mz telling the spectra with a peak line whose m/z can be read
+    """
+    split_lines = [x.split() for x in peak_lines]
+    # fast path: every line is an m/z and an intensity
+    if all(len(x) == 2 for x in split_lines):
+        try:
+            values = np.fromiter(map(float, itertools.chain.from_iterable(split_lines)), dtype=np.float64,
+                                 count=2 * len(split_lines))
+            return values[0::2], values[1::2], counts, counts > 0
+        except ValueError:
+            pass
+
+    # slow path: extra columns or lines that are not numbers
+    mz = np.zeros(len(peak_lines))
+    intensity = np.zeros(len(peak_lines))
+    valid = np.zeros(len(peak_lines), dtype=bool)
+    for i, tokens in enumerate(split_lines):
+        try:
+            this_mz, this_int = tokens[:2]
+            mz[i] = float(this_mz)
+            intensity[i] = float(this_int)
+            valid[i] = True
+        except ValueError:
+            continue
+
+    line_spec = np.repeat(np.arange(len(counts)), counts)
+    has_mz = np.bincount(line_spec[np.array([_has_mz(x) for x in peak_lines], dtype=bool)],
+                         minlength=len(counts)) > 0
+    counts = np.bincount(line_spec[valid], minlength=len(counts))
+
+    return mz[valid], intensity[valid], counts, has_mz
+
+
+def _make_batch(records, index, peak_lines, counts, skip_empty, dtype):
+    """
+    Assemble one batch of spectra
+    """
+    mz, intensity, counts, has_mz = _parse_peak_lines(peak_lines, np.asarray(counts, dtype=np.int64))
+    index = np.asarray(index, dtype=np.int64)
+
+    if skip_empty and not has_mz.all():
+        records = [x for x, keep in zip(records, has_mz) if keep]
+        index = index[has_mz]
+        counts = counts[has_mz]
+
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    return {
+        'records': records,
+        'index': index,
+        'offsets': offsets,
+        'mz': mz.astype(dtype, copy=False),
+        'intensity': intensity.astype(dtype, copy=False),
+    }
+
+
+def iter_mgf_batches(input_mgf, batch_size=10000, start=0, end=None, first_spectrum=0, skip_empty=True,
+                     dtype=np.float64, rules=None):
+    """
+    Stream the mgf file as batches of at most batch_size spectra. Each batch is a dict of
+        records: metadata dicts of the key=value lines
+        index: 0-based position of each spectrum in the file
+        offsets: CSR peak offsets, len(records) + 1
+        mz, intensity: peak buffers
+    skip_empty: drop spectra without a peak line whose m/z can be read, as generate_library_df did (a spectrum
+    whose lines only have an m/z, e.g. 'nan abc', is kept with no peaks)
+    rules: header rewrite rules applied while reading
+    """
+    records = []
+    index = []
+    peak_lines = []
+    counts = []
+
+    spec_cnt = first_spectrum
+    for lines in iter_mgf_spectra(input_mgf, start, end, rules=rules):
+        # key=value pairs, split by first '='
+        records.append(dict(x.strip().split('=', 1) for x in lines if '=' in x))
+        # blank lines that slip in here are dropped when the peaks are parsed
+        peaks = [x for x in lines if x and '=' not in x]
+        peak_lines.extend(peaks)
+        counts.append(len(peaks))
+        index.append(spec_cnt)
+        spec_cnt += 1
+
+        if len(records) >= batch_size:
+            yield _make_batch(records, index, peak_lines, counts, skip_empty, dtype)
+            records = []
+            index = []
+            peak_lines = []
+            counts = []
+
+    if records:
+        yield _make_batch(records, index, peak_lines, counts, skip_empty, dtype)
+
+
+def scan_mgf_keys(input_mgf, keep_peaks=False, rules=None):
+    """
+    Metadata columns of the non-empty spectra in order of first appearance, as pd.DataFrame(records)
+    would order them. With keep_peaks, mz_ls and intensity_ls follow the keys of the first spectrum.
+    """
+    columns = {}
+    peaks_added = not keep_peaks
+    for lines in iter_mgf_spectra(input_mgf, rules=rules):
+        if not any('=' not in x and _has_mz(x) for x in lines):
+            continue
+        for x in lines:
+            if '=' in x:
+                columns.setdefault(x.strip().split('=', 1)[0], None)
+        if not peaks_added:
+            columns.setdefault('mz_ls', None)
+            columns.setdefault('intensity_ls', None)
+            peaks_added = True
+
+    return list(columns)
+
+
+def get_param(record, key):
+    """
+    Case-insensitive metadata lookup, as pyteomics lowercases mgf keys
+    """
+    if key in record:
+        return record[key]
+    for this_key, value in record.items():
+        if this_key.upper() == key:
+            return value
+    return None
+
+
+def write_library_tsv(library_mgf, out_name, keep_peaks=False, batch_size=10000, rules=None):
+    """
+    Write the metadata table of the mgf file batch by batch.
+    keep_peaks: also write the peaks as mz_ls and intensity_ls list columns
+    rules: header rewrite rules applied while reading, no corrected mgf copy needed
+    """
+    columns = scan_mgf_keys(library_mgf, keep_peaks=keep_peaks, rules=rules)
+
+    first_batch = True
+    for batch in iter_mgf_batches(library_mgf, batch_size=batch_size, rules=rules):
+        records = batch['records']
+        if keep_peaks:
+            offsets = batch['offsets']
+            for i, record in enumerate(records):
+                record['mz_ls'] = batch['mz'][offsets[i]:offsets[i + 1]].tolist()
+                record['intensity_ls'] = batch['intensity'][offsets[i]:offsets[i + 1]].tolist()
+
+        df = pd.DataFrame(records, columns=columns)
+        df.to_csv(out_name, sep='\t', index=False, header=first_batch, mode='w' if first_batch else 'a')
+        first_batch = False
+
+    if first_batch:
+        pd.DataFrame(columns=columns).to_csv(out_name, sep='\t', index=False)
@@ -0,0 +1,194 @@
+"""
+MassQL filtering shared by the library scripts (bile19_msql, new_core_db_msql): the passed scans of every
+query (native engine, massql, cache, incremental state, gates) and the library table with one hit column
+per query.
+"""
+import os
+from importlib.metadata import version
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from massql import msql_engine
+
+from library_bundle import is_bundle, open_bundle
+from query_cache import library_hash, get_cached, put_cached
+from query_engine import ENGINE_VERSION, load_spectra, compile_query, compile_plan, run_plan, run_plan_parallel, \
+    attach_hits, compile_gated_plan, run_gated_plan, run_gated_plan_parallel
+from incremental import update_hits
+from main_evaluation import get_query_gates
+from profiling import profile, report
+
+
+# hit columns merged into one in the library table
+MERGED_QUERIES = {
+    '1-OH-Sidechain; 1-OH-core': ['1-OH-Sidechain; 1-OH-core_1', '1-OH-Sidechain; 1-OH-core_2',
+                                  '1-OH-Sidechain; 1-OH-core_3'],
+}
+
+
+def get_filter_gates(massql_queries):
+    """
+    Gate queries of every query to run (see main_evaluation.get_query_gates), the merged queries are gated as
+    their merge
+    """
+    gates = get_query_gates()
+    for merged_name, query_names in MERGED_QUERIES.items():
+        for x in query_names:
+            gates[x] = gates.get(merged_name, [])
+    return {k: [x for x in v if x in massql_queries] for k, v in gates.items() if k in massql_queries}
+
+
+def get_passed_scans(input_mgf, massql_queries, engine='native', n_workers=1, max_memory_mb=None,
+                     cache_dir=None, cache_mb=512, state_dir=None, gates=None):
+    """
+    Run the queries on the mgf file, return a dict of query name -> list of passed scans (str)
+    engine: 'native' (vectorized engine in query_engine.py) or 'massql' (msql_engine.process_query)
+    n_workers: > 1 to shard the library chunks (native) and the queries (massql) over a process pool
+    max_memory_mb: memory ceiling for the library chunks loaded by the workers
+    cache_dir: cache the results there by (hash of the library read, engine and its version, query), only new or
+    edited queries are run (off by default)
+    state_dir: keep spectrum and query fingerprints with the hits there, and only run the native queries on new
+    or changed spectra (see incremental.update_hits)
+    gates: query name -> list of gate queries (see query_engine.compile_gated_plan), the gated queries are only
+    run on the spectra passing a gate (native engine, serial or parallel); their scans only hold behind the
+    gates, they are not cached. The incremental state (state_dir) and massql keep ungated hits: there the
+    gated queries run on all spectra, and only the mask of massql_filter gates them.
+    """
+    passed_scans = {}
+
+    # compile the queries, those not supported by the native engine go through massql
+    compiled_queries = {}
+    if engine == 'native':
+        with profile('compile queries'):
+            for query_name, input_query in massql_queries.items():
+                try:
+                    compiled_queries[query_name] = compile_query(input_query)
+                except ValueError as e:
+                    print(f'{query_name}: {e}, use massql instead')
+
+    # the native engine reads the library bundle if it has been converted, massql the mgf file
+    bundle_dir = input_mgf.replace('.mgf', '.bundle')
+    source = bundle_dir if engine == 'native' and is_bundle(bundle_dir) else input_mgf
+    if cache_dir is not None:
+        with profile('query cache lookup'):
+            # keyed on the engine and on what the queries read: a bundle may be older than the mgf, or its
+            # peaks noise-filtered
+            cache_keys = {}
+            if compiled_queries:
+                cache_keys['native'] = (library_hash(source, cache_dir), f'native {ENGINE_VERSION}')
+            if len(compiled_queries) < len(massql_queries):
+                cache_keys['massql'] = (library_hash(input_mgf, cache_dir), f'massql {version("massql")}')
+            query_keys = {x: cache_keys['native' if x in compiled_queries else 'massql'] for x in massql_queries}
+            for query_name, input_query in massql_queries.items():
+                cached = get_cached(cache_dir, *query_keys[query_name], input_query)
+                if cached is not None:
+                    passed_scans[query_name] = cached
+        cached_names = set(passed_scans)
+        massql_queries = {k: v for k, v in massql_queries.items() if k not in cached_names}
+        compiled_queries = {k: v for k, v in compiled_queries.items() if k not in cached_names}
+        if cached_names:
+            print(f'{len(cached_names)} queries from cache, {len(massql_queries)} to run')
+
+    if compiled_queries:
+        plan = compile_gated_plan(compiled_queries, gates) if gates else compile_plan(compiled_queries)
+        if state_dir is not None:
+            if gates:
+                print('gates with state_dir: the incremental run evaluates the gated queries on all new or '
+                      'changed spectra, the gates only mask their hits')
+            with profile('incremental update'):
+                scans, hits = update_hits(source, compiled_queries, state_dir)
+        elif n_workers > 1:
+            with profile('native queries (parallel)'):
+                run_parallel = run_gated_plan_parallel if gates else run_plan_parallel
+                scans, hits = run_parallel(source, plan, n_workers=n_workers, max_memory_mb=max_memory_mb)
+        else:
+            with profile('load spectra') as record:
+                spectra = load_spectra(source)
+                record['n_spectra'] = spectra.n_spectra
+            with profile('native queries', n_spectra=spectra.n_spectra):
+                if gates:
+                    hits = run_gated_plan(spectra, plan)
+                else:
+                    hits = run_plan(spectra, plan)
+            scans = spectra.scans
+        for i, query_name in enumerate(compiled_queries):
+            passed_scans[query_name] = scans[hits[:, i] == 1].tolist()
+
+    massql_query_names = [x for x in massql_queries if x not in compiled_queries]
+    if n_workers > 1 and len(massql_query_names) > 1:
+        with profile(f'massql queries on {n_workers} workers'):
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                results_ls = list(executor.map(msql_engine.process_query,
+                                               [massql_queries[x] for x in massql_query_names],
+                                               [input_mgf] * len(massql_query_names)))
+    else:
+        results_ls = []
+        for x in massql_query_names:
+            with profile(x, kind='query'):
+                results_ls.append(msql_engine.process_query(massql_queries[x], input_mgf))
+
+    for query_name, results_df in zip(massql_query_names, results_ls):
+        if len(results_df) == 0:
+            passed_scans[query_name] = []
+            continue
+        passed_scans[query_name] = [str(x) for x in results_df['scan'].values.tolist()]
+
+    if cache_dir is not None:
+        with profile('query cache write'):
+            for query_name, input_query in massql_queries.items():
+                if gates and query_name in gates:
+                    continue
+                put_cached(cache_dir, *query_keys[query_name], input_query, passed_scans[query_name],
+                           max_mb=cache_mb)
+
+    return passed_scans
+
+
+def massql_filter(input_mgf, massql_queries, engine='native', n_workers=1, max_memory_mb=None,
+                  cache_dir=None, state_dir=None, gated=False):
+    """
+    Filter the library for BA
+    cache_dir: cache the passed scans of every query there, e.g. 'data/cache' (see get_passed_scans)
+    gated: the isomer queries only hit spectra passing their class query (see main_evaluation.get_query_gates),
+    and the native engine only runs them on those (serial or n_workers > 1; not with state_dir or massql,
+    where they run on all spectra and are masked afterwards)
+    """
+    gates = get_filter_gates(massql_queries) if gated else None
+
+    # read the library
+    bundle_dir = input_mgf.replace('.mgf', '.bundle')
+    with profile('read library table') as record:
+        if is_bundle(bundle_dir):
+            df = open_bundle(bundle_dir)['metadata']
+        else:
+            # values as written, like the bundle metadata
+            df = pd.read_csv(input_mgf.replace('.mgf', '.tsv'), sep='\t', dtype=str, keep_default_na=False)
+        record['n_spectra'] = len(df)
+
+    with profile('get passed scans'):
+        passed_scans = get_passed_scans(input_mgf, massql_queries, engine=engine, n_workers=n_workers,
+                                        max_memory_mb=max_memory_mb, cache_dir=cache_dir, state_dir=state_dir,
+                                        gates=gates)
+
+    # attach all query columns at once
+    with profile('attach hits', n_spectra=len(df)):
+        query_names = list(massql_queries)
+        df[query_names] = attach_hits(df['SCANS'], {x: passed_scans[x] for x in query_names})
+        # the same gated hits whichever engine or cache the scans came from
+        for query_name, query_gates in (gates or {}).items():
+            if query_gates:
+                df[query_name] = df[query_name].values & df[query_gates].values.max(axis=1)
+
+    # merge 1-OH-Sidechain; 1-OH-core_1 and 1-OH-Sidechain; 1-OH-core_2 and 1-OH-Sidechain; 1-OH-core_3
+    for merged_name, query_names in MERGED_QUERIES.items():
+        df[merged_name] = df[query_names].values.max(axis=1)
+        df.drop(query_names, axis=1, inplace=True)
+
+    # save the result
+    out_name = input_mgf.replace('.mgf', '_massql.tsv')
+    with profile('write tsv', n_spectra=len(df)):
+        df.to_csv(out_name, sep='\t', index=False)
+
+    report(f'massql_filter_{os.path.basename(input_mgf).replace(".mgf", "")}')
+
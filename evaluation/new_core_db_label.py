@@ -1,53 +1,113 @@
+import os
+
 import pandas as pd
 
 
-def get_label():
+# number of OH counted for each token of the group name (case-insensitive)
+OH_TOKENS = {'alpha': 1, 'beta': 1, 'delta': 1, 'keto': 2}
+# patterns as strings, so that the str accessor runs them natively on arrow-backed strings
+OH_PATTERNS = [(f'(?i){token}', n) for token, n in OH_TOKENS.items()]
+# everything from the first '_'
+SUFFIX_PATTERN = '(?s)_.*'
+
+
+def label_names(names):
     """
-    Get the label of the library
+    _NAME, group, oh_gt and the mono / di / tri ground truths for a Series of library names, all in one go
     """
-    # read the library
-    df = pd.read_csv('data/new_core_corrected_massql.tsv', sep='\t')
+    out = pd.DataFrame(index=names.index)
 
     # for the NAME column, romove '_NCE45' if it exists
-    df['_NAME'] = df['NAME'].apply(lambda x: x.replace('_NCE45', ''))
-
-    df['group'] = df['_NAME'].apply(lambda x: x.split('_')[0] if '_' in x else x)
+    out['_NAME'] = names.str.replace('_NCE45', '', regex=False)
 
-    # rename 3keta7a to 3keto7a
-    df['group'] = df['group'].apply(lambda x: x.replace('keta', 'keto'))
+    # group is the name up to the first '_', rename 3keta7a to 3keto7a
+    group = out['_NAME'].str.replace(SUFFIX_PATTERN, '', regex=True).str.replace('keta', 'keto', regex=False)
 
     # label ground truths for mono, di, tri
-    def get_oh_gt(name):
-        total = 0
-        # Convert to lowercase for case-insensitive matching
-        text = name.lower()
-        # Count occurrences using string methods
-        total += text.count('alpha')
-        total += text.count('beta')
-        total += text.count('delta')
-        total += 2 * text.count('keto')
-        return total
-
-    df['oh_gt'] = df['group'].apply(lambda x: get_oh_gt(x))
+    oh_gt = 0
+    for pattern, n in OH_PATTERNS:
+        oh_gt = oh_gt + n * group.str.count(pattern)
+    out['oh_gt'] = oh_gt
 
-    # label ground truths for mono, di, tri
-    df['mono_gt'] = df['oh_gt'].apply(lambda x: 1 if x == 1 else 0)
-    df['di_gt'] = df['oh_gt'].apply(lambda x: 1 if x == 2 else 0)
-    df['tri_gt'] = df['oh_gt'].apply(lambda x: 1 if x == 3 else 0)
+    out['mono_gt'] = (out['oh_gt'] == 1).astype(int)
+    out['di_gt'] = (out['oh_gt'] == 2).astype(int)
+    out['tri_gt'] = (out['oh_gt'] == 3).astype(int)
+
+    out['group'] = group.str.replace('beta', 'b', regex=False).str.replace('alpha', 'a', regex=False)
+
+    return out
+
+
+def label_batch(df):
+    """
+    Label one table (or batch) of the library, keeping mono/di/tri BAs only
+    """
+    labels = label_names(df['NAME'])
+
+    df = df.copy()
+    df['_NAME'] = labels['_NAME']
+    df['group'] = labels['group']
+    for col in ['oh_gt', 'mono_gt', 'di_gt', 'tri_gt']:
+        df[col] = labels[col]
 
     # should be either mono/di/tri BAs
     df = df[(df['mono_gt'] == 1) | (df['di_gt'] == 1) | (df['tri_gt'] == 1)].reset_index(drop=True)
 
-    df['group'] = df['group'].apply(lambda x: x.replace('beta', 'b'))
-    df['group'] = df['group'].apply(lambda x: x.replace('alpha', 'a'))
-
     # remove 3a7b, trihydroxy
     df = df[~((df['group'] == '3a7b') & (df['Trihydroxy'] == 1))]
 
     df['di_1_sc_oh'] = 0
 
+    return df
+
+
+def label_batches(batches):
+    """
+    Label batches of the library as they arrive (any iterable of DataFrames, e.g. read_csv chunks)
+    """
+    for df in batches:
+        yield label_batch(df)
+
+
+def _labeled_rows(out_tsv):
+    """
+    Header and rows (as written) of an existing labeled table
+    """
+    with open(out_tsv) as file:
+        header = file.readline().rstrip('\n')
+        return header, {x.rstrip('\n') for x in file}
+
+
+def get_label(input_tsv='data/new_core_corrected_massql.tsv', out_tsv='data/label/new_core_df.tsv',
+              chunksize=None, append=False):
+    """
+    Get the label of the library
+    chunksize: label the library in chunks of rows, without reading it all at once (each chunk is typed
+    separately by read_csv, so numeric columns with missing values may be written as float in some chunks)
+    append: add the labeled rows to an existing out_tsv, e.g. for a new export of the library. The columns must
+    be the same, and rows already in out_tsv (same values as written) are skipped.
+    """
+    # read the library
+    if chunksize is None:
+        batches = [pd.read_csv(input_tsv, sep='\t')]
+    else:
+        batches = pd.read_csv(input_tsv, sep='\t', chunksize=chunksize)
+
+    labeled = _labeled_rows(out_tsv) if append and os.path.exists(out_tsv) else None
+
     # save the result
-    df.to_csv('data/label/new_core_df.tsv', sep='\t', index=False)
+    header = labeled is None
+    for df in label_batches(batches):
+        if labeled is None:
+            df.to_csv(out_tsv, sep='\t', index=False, header=header, mode='w' if header else 'a')
+            header = False
+            continue
+
+        lines = df.to_csv(sep='\t', index=False, lineterminator='\n').split('\n')[:-1]
+        if lines[0] != labeled[0]:
+            raise ValueError(f'{out_tsv} has other columns than the labeled library, cannot append')
+        with open(out_tsv, 'a') as file:
+            file.writelines(x + '\n' for x in lines[1:] if x not in labeled[1])
 
 
 if __name__ == '__main__':
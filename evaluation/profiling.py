@@ -0,0 +1,165 @@
+"""
+Opt-in profiling of the pipeline stages and of every named query.
+
+Enabled by the BA_PROFILE environment variable or by enable(): BA_PROFILE=1 records wall time, CPU time,
+allocations (tracemalloc, which slows down the Python-heavy stages several times) and spectra processed,
+BA_PROFILE=time the same without allocations. massql_filter and main_evaluation then end with a report:
+a JSON file in data/profile and a summary table on stdout.
+When disabled, a hook is one check returning a shared no-op context.
+
+    with profile('load spectra') as record:
+        spectra = load_spectra(source)
+        record['n_spectra'] = spectra.n_spectra
+"""
+import os
+import time
+import json
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+
+PROFILE_ENV = 'BA_PROFILE'
+
+# writes to the record of a disabled hook are discarded
+_NULL_PROFILE = nullcontext({})
+
+
+class Profiler:
+    """
+    Records of the stages and queries run since the last report
+    """
+
+    def __init__(self, allocations=True):
+        self.allocations = allocations
+        if allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.reset()
+
+    def reset(self):
+        self.records = []
+        self.stack = []
+        self.started = time.perf_counter()
+        self.started_cpu = time.process_time()
+
+    @contextmanager
+    def profile(self, name, kind='stage', n_spectra=None):
+        record = {'name': name, 'kind': kind, 'depth': len(self.stack), 'n_spectra': n_spectra}
+        self.records.append(record)
+
+        if self.allocations:
+            current, peak = tracemalloc.get_traced_memory()
+            # keep the peak of the enclosing stage before the inner one resets it
+            if self.stack:
+                self.stack[-1]['_peak'] = max(self.stack[-1]['_peak'], peak)
+            tracemalloc.reset_peak()
+            record['_start_memory'] = current
+            record['_peak'] = current
+        self.stack.append(record)
+
+        start_cpu = time.process_time()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['wall_s'] = time.perf_counter() - start
+            record['cpu_s'] = time.process_time() - start_cpu
+            self.stack.pop()
+
+            if self.allocations:
+                current, peak = tracemalloc.get_traced_memory()
+                peak = max(peak, record.pop('_peak'))
+                start_memory = record.pop('_start_memory')
+                record['alloc_mb'] = (current - start_memory) / 2 ** 20
+                record['peak_alloc_mb'] = (peak - start_memory) / 2 ** 20
+                if self.stack:
+                    self.stack[-1]['_peak'] = max(self.stack[-1]['_peak'], peak)
+
+            if record['n_spectra'] and record['wall_s'] > 0:
+                record['spectra_per_s'] = record['n_spectra'] / record['wall_s']
+
+    def summary(self):
+        """
+        Summary table of the records, nested stages indented
+        """
+        lines = [f'{"stage / query":<48} {"wall s":>9} {"cpu s":>9} {"alloc MB":>9} {"peak MB":>9} '
+                 f'{"spectra":>9} {"spectra/s":>11}']
+        for x in self.records:
+            name = '  ' * x['depth'] + x['name']
+            lines.append(f'{name[:48]:<48} {x["wall_s"]:>9.3f} {x["cpu_s"]:>9.3f} {_cell(x, "alloc_mb", 9, 1)} '
+                         f'{_cell(x, "peak_alloc_mb", 9, 1)} {_cell(x, "n_spectra", 9, 0)} '
+                         f'{_cell(x, "spectra_per_s", 11, 0)}')
+        return '\n'.join(lines)
+
+    def report(self, run_name, out_dir='data/profile'):
+        """
+        Save the records as JSON, print the summary table and start over
+        """
+        out = {
+            'run': run_name,
+            'wall_s': time.perf_counter() - self.started,
+            'cpu_s': time.process_time() - self.started_cpu,
+            'allocations': self.allocations,
+            'records': self.records,
+        }
+        if self.allocations:
+            out['peak_traced_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+
+        os.makedirs(out_dir, exist_ok=True)
+        out_json = os.path.join(out_dir, f'{run_name}_{time.strftime("%Y%m%d_%H%M%S")}.json')
+        with open(out_json, 'w') as file:
+            json.dump(out, file, indent=1)
+
+        print(f'profile of {run_name}: {out["wall_s"]:.3f} s wall, {out["cpu_s"]:.3f} s CPU, saved to {out_json}')
+        print(self.summary())
+        self.reset()
+
+        return out
+
+
+def _cell(record, key, width, digits):
+    value = record.get(key)
+    return ' ' * width if value is None else f'{value:>{width}.{digits}f}'
+
+
+_profiler = None
+
+
+def enable(allocations=True):
+    """
+    Profile from now on (allocations: trace them with tracemalloc)
+    """
+    global _profiler
+    _profiler = Profiler(allocations)
+
+
+def disable():
+    global _profiler
+    if _profiler is not None and _profiler.allocations:
+        tracemalloc.stop()
+    _profiler = None
+
+
+def is_enabled():
+    return _profiler is not None
+
+
+def profile(name, kind='stage', n_spectra=None):
+    """
+    Context of a profiled stage or query (kind='query'), yields its record (a dict, e.g. to set n_spectra)
+    """
+    if _profiler is None:
+        return _NULL_PROFILE
+    return _profiler.profile(name, kind, n_spectra)
+
+
+def report(run_name, out_dir='data/profile'):
+    """
+    Report of the stages and queries since the last report, None if profiling is disabled
+    """
+    if _profiler is None:
+        return None
+    return _profiler.report(run_name, out_dir)
+
+
+if os.environ.get(PROFILE_ENV, '0') not in ('', '0'):
+    enable(allocations=os.environ[PROFILE_ENV] != 'time')
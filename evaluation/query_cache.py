@@ -0,0 +1,119 @@
+"""
+On-disk cache of per-query results (passed scans), keyed by the content hash of the library, the engine
+(name and version) and the normalized query text, so that only new or edited queries are run again.
+Size-bounded, least recently used entries are evicted first.
+"""
+import os
+import json
+import hashlib
+
+import numpy as np
+
+
+def normalize_query(input_query):
+    """
+    Query text with whitespace collapsed
+    """
+    return ' '.join(input_query.split())
+
+
+def _write_json(path, obj):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(obj, file)
+    os.replace(tmp_path, path)
+
+
+def _hash_file(path, sha):
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            sha.update(block)
+
+
+def library_hash(path, cache_dir):
+    """
+    Content hash of the library (mgf file or bundle directory). Hashes are remembered by
+    (path, size, mtime), so an unchanged library is not read again.
+    """
+    if os.path.isdir(path):
+        files = [os.path.join(path, x) for x in sorted(os.listdir(path))]
+    else:
+        files = [path]
+    stamp = [[os.path.basename(x), os.path.getsize(x), os.stat(x).st_mtime_ns] for x in files]
+
+    index_path = os.path.join(cache_dir, 'library_hashes.json')
+    index = {}
+    # a broken index only costs hashing the library again
+    try:
+        with open(index_path) as file:
+            index = json.load(file)
+    except (OSError, ValueError):
+        pass
+
+    path_key = os.path.abspath(path)
+    if path_key in index and index[path_key]['stamp'] == stamp:
+        return index[path_key]['hash']
+
+    sha = hashlib.sha256()
+    for x in files:
+        sha.update(os.path.basename(x).encode())
+        _hash_file(x, sha)
+
+    index[path_key] = {'stamp': stamp, 'hash': sha.hexdigest()}
+    os.makedirs(cache_dir, exist_ok=True)
+    _write_json(index_path, index)
+
+    return index[path_key]['hash']
+
+
+def _entry_path(cache_dir, library_key, engine_key, input_query):
+    key = hashlib.sha256(f'{library_key}\n{engine_key}\n{normalize_query(input_query)}'.encode()).hexdigest()
+    return os.path.join(cache_dir, f'{key}.npy')
+
+
+def get_cached(cache_dir, library_key, engine_key, input_query):
+    """
+    Cached passed scans (list of str) of the query, None if not cached
+    engine_key: name and version of the engine running the query, e.g. 'native 1'
+    """
+    path = _entry_path(cache_dir, library_key, engine_key, input_query)
+    try:
+        scans = np.load(path, allow_pickle=False)
+    except (OSError, ValueError):
+        return None
+
+    # mark as recently used
+    os.utime(path)
+    return scans.tolist()
+
+
+def put_cached(cache_dir, library_key, engine_key, input_query, passed_scans, max_mb=512):
+    """
+    Store the passed scans of the query, then evict the least recently used entries above max_mb
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    path = _entry_path(cache_dir, library_key, engine_key, input_query)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as file:
+        np.save(file, np.array(passed_scans, dtype=str))
+    os.replace(tmp_path, path)
+
+    evict(cache_dir, max_mb)
+
+
+def evict(cache_dir, max_mb=512):
+    """
+    Delete the least recently used entries until the cache is within max_mb
+    """
+    entries = []
+    for x in os.scandir(cache_dir):
+        if x.name.endswith('.npy'):
+            stat = x.stat()
+            entries.append((stat.st_mtime_ns, stat.st_size, x.path))
+
+    total = sum(x[1] for x in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_mb * 1024 * 1024:
+            break
+        os.remove(path)
+        total -= size
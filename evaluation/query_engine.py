@@ -0,0 +1,1115 @@
+"""
+Native vectorized engine for the diagnostic-ion MassQL queries used in BA classification.
+
+Peaks of the whole library are loaded once into flat NumPy arrays, and every query is
+evaluated with array operations, following the semantics of massql.msql_engine
+(product-ion windows, INTENSITYPERCENT, INTENSITYMATCH references, MS2PREC=X variables).
+"""
+import os
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from massql import msql_parser
+from pyteomics import mzml
+
+from mgf_reader import index_mgf_chunks, iter_mgf_batches, get_param
+from library_bundle import open_bundle, is_bundle
+from profiling import profile
+
+
+# bump whenever a change of the engine may change query results (part of the query cache key)
+ENGINE_VERSION = 1
+
+
+class FlatSpectra:
+    """
+    MS2 spectra stored as flat peak arrays with CSR-style offsets
+    """
+
+    def __init__(self, scans, precmz, offsets, mz, intensity, i_norm=None):
+        self.scans = np.asarray(scans, dtype=str)
+        self.precmz = np.asarray(precmz, dtype=np.float64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.mz = np.asarray(mz, dtype=np.float64)
+        self.intensity = np.asarray(intensity, dtype=np.float64)
+
+        # spectrum index of every peak
+        self.spec_idx = np.repeat(np.arange(self.n_spectra), np.diff(self.offsets))
+
+        # relative intensity to the base peak, as massql i_norm (given by preprocessed bundles)
+        if i_norm is not None:
+            self.i_norm = np.asarray(i_norm, dtype=np.float64)
+            return
+        base_peak = np.zeros(self.n_spectra)
+        non_empty = np.diff(self.offsets) > 0
+        base_peak[non_empty] = np.maximum.reduceat(self.intensity, self.offsets[:-1][non_empty])
+        self.i_norm = self.intensity / base_peak[self.spec_idx]
+
+    @property
+    def n_spectra(self):
+        return len(self.offsets) - 1
+
+    def take(self, spec_ids):
+        """
+        New FlatSpectra with the given spectra only
+        """
+        spec_ids = np.asarray(spec_ids, dtype=np.int64)
+        peak_ids = _expand_ranges(self.offsets[spec_ids], self.offsets[spec_ids + 1])
+        offsets = np.concatenate([[0], np.cumsum(np.diff(self.offsets)[spec_ids])])
+        return FlatSpectra(self.scans[spec_ids], self.precmz[spec_ids], offsets, self.mz[peak_ids],
+                           self.intensity[peak_ids])
+
+
+def concat_spectra(spectra_ls):
+    """
+    Concatenate FlatSpectra in order
+    """
+    offsets = [np.zeros(1, dtype=np.int64)]
+    n_peaks = 0
+    for spectra in spectra_ls:
+        offsets.append(spectra.offsets[1:] + n_peaks)
+        n_peaks += spectra.offsets[-1]
+
+    return FlatSpectra(np.concatenate([x.scans for x in spectra_ls]) if spectra_ls else [],
+                       np.concatenate([x.precmz for x in spectra_ls]) if spectra_ls else [],
+                       np.concatenate(offsets),
+                       np.concatenate([x.mz for x in spectra_ls]) if spectra_ls else [],
+                       np.concatenate([x.intensity for x in spectra_ls]) if spectra_ls else [])
+
+
+def load_mgf_peaks(input_mgf, start=0, end=None, first_spectrum=0, batch_size=10000):
+    """
+    Load all MS2 spectra of an mgf file (or of the byte range [start, end)) into flat arrays,
+    skipping spectra without peaks
+    """
+    scans = []
+    precmz = []
+    counts = []
+    mz = []
+    intensity = []
+
+    for batch in iter_mgf_batches(input_mgf, batch_size=batch_size, start=start, end=end,
+                                  first_spectrum=first_spectrum):
+        # zero-intensity peaks are ignored by massql
+        keep = batch['intensity'] != 0
+        batch_counts = _segment_counts(keep, batch['offsets'])
+        non_empty = batch_counts > 0
+
+        records = [x for x, keep_spec in zip(batch['records'], non_empty) if keep_spec]
+        for record, index in zip(records, batch['index'][non_empty]):
+            # massql falls back to the 1-based spectrum index if SCANS is missing
+            scan = get_param(record, 'SCANS')
+            scans.append(scan.strip() if scan is not None else str(index + 1))
+            try:
+                precmz.append(float(get_param(record, 'PEPMASS').split()[0]))
+            except (AttributeError, IndexError, ValueError):
+                precmz.append(0.0)
+
+        counts.append(batch_counts[non_empty])
+        mz.append(batch['mz'][keep])
+        intensity.append(batch['intensity'][keep])
+
+    counts = np.concatenate(counts) if counts else np.zeros(0, dtype=np.int64)
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    return FlatSpectra(scans, precmz, offsets,
+                       np.concatenate(mz) if mz else [], np.concatenate(intensity) if intensity else [])
+
+
+def _segment_counts(keep, offsets):
+    """
+    Number of kept peaks of each spectrum, spectra without peaks included (np.add.reduceat does not count those)
+    """
+    kept = np.zeros(len(keep) + 1, dtype=np.int64)
+    np.cumsum(keep, out=kept[1:])
+    return kept[offsets[1:]] - kept[offsets[:-1]]
+
+
+def load_bundle_peaks(bundle_dir, start=0, end=None):
+    """
+    Load the spectra [start, end) of a library bundle, the peak arrays stay memory-mapped where possible.
+    The preprocessed peaks are used if the bundle has them (see library_bundle.preprocess_bundle).
+    """
+    bundle = open_bundle(bundle_dir, columns=[])
+    end = len(bundle['offsets']) - 1 if end is None else end
+    if 'preprocessed' in bundle:
+        return _load_preprocessed_peaks(bundle, start, end)
+    offsets = bundle['offsets'][start:end + 1]
+    mz = bundle['mz'][offsets[0]:offsets[-1]]
+    intensity = bundle['intensity'][offsets[0]:offsets[-1]]
+    offsets = offsets - offsets[0]
+    scans = bundle['scans'][start:end]
+    precmz = bundle['precmz'][start:end]
+
+    # zero-intensity peaks are ignored by massql
+    keep = intensity != 0
+    if keep.all() and np.diff(offsets).all():
+        return FlatSpectra(scans, precmz, offsets, mz, intensity)
+
+    counts = _segment_counts(keep, offsets)
+    non_empty = counts > 0
+    offsets = np.zeros(non_empty.sum() + 1, dtype=np.int64)
+    np.cumsum(counts[non_empty], out=offsets[1:])
+
+    return FlatSpectra(scans[non_empty], precmz[non_empty], offsets, mz[keep], intensity[keep])
+
+
+def _load_preprocessed_peaks(bundle, start, end):
+    """
+    Spectra [start, end) from the preprocessed peaks of a bundle, with the global m/z index if all are loaded
+    """
+    peaks = bundle['preprocessed']
+    offsets = peaks['offsets'][start:end + 1]
+    peak_range = slice(offsets[0], offsets[-1])
+    offsets = offsets - offsets[0]
+    scans = bundle['scans'][start:end]
+    precmz = bundle['precmz'][start:end]
+
+    # spectra left without peaks are dropped, as in load_bundle_peaks
+    counts = np.diff(offsets)
+    non_empty = counts > 0
+    if not non_empty.all():
+        offsets = np.zeros(non_empty.sum() + 1, dtype=np.int64)
+        np.cumsum(counts[non_empty], out=offsets[1:])
+        scans = scans[non_empty]
+        precmz = precmz[non_empty]
+
+    spectra = FlatSpectra(scans, precmz, offsets, peaks['mz'][peak_range], peaks['intensity'][peak_range],
+                          peaks['i_norm'][peak_range])
+    if start == 0 and end == len(peaks['offsets']) - 1:
+        order = np.asarray(peaks['mz_order'])
+        spectra._mz_index = (spectra.mz[order], spectra.spec_idx[order], spectra.intensity[order],
+                             spectra.i_norm[order])
+
+    return spectra
+
+
+def iter_mzml_batches(input_mzml, batch_peaks=2 ** 22):
+    """
+    MS2 spectra of an mzML file in batches of about batch_peaks peaks, read as a stream.
+    As in massql, zero-intensity peaks are kept and the scan is the scan number of the spectrum id.
+    """
+    scans = []
+    precmz = []
+    counts = []
+    mz = []
+    intensity = []
+    n_peaks = 0
+    n_batches = 0
+
+    def make_batch():
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return FlatSpectra(scans, precmz, offsets, np.concatenate(mz) if mz else [],
+                           np.concatenate(intensity) if intensity else [])
+
+    with mzml.read(input_mzml) as reader:
+        for spectrum in reader:
+            if not len(spectrum.get('intensity array', [])) or 'm/z array' not in spectrum:
+                continue
+            if spectrum.get('ms level') != 2:
+                continue
+            try:
+                selected_ion = spectrum['precursorList']['precursor'][0]['selectedIonList']['selectedIon'][0]
+                spectrum_precmz = float(selected_ion['selected ion m/z'])
+            except (KeyError, IndexError):
+                continue
+
+            scan = spectrum['id'].replace('scanId=', '').split('scan=')[-1]
+            scans.append(str(int(scan)) if scan.strip().isdigit() else spectrum['id'])
+            precmz.append(spectrum_precmz)
+            counts.append(len(spectrum['m/z array']))
+            mz.append(np.asarray(spectrum['m/z array'], dtype=np.float64))
+            intensity.append(np.asarray(spectrum['intensity array'], dtype=np.float64))
+
+            n_peaks += counts[-1]
+            if n_peaks >= batch_peaks:
+                yield make_batch()
+                n_batches += 1
+                scans, precmz, counts, mz, intensity = [], [], [], [], []
+                n_peaks = 0
+
+    # an empty batch for a file without MS2 spectra
+    if counts or not n_batches:
+        yield make_batch()
+
+
+def load_mzml_peaks(input_mzml):
+    """
+    Load all MS2 spectra of an mzML file into flat arrays
+    """
+    return concat_spectra(list(iter_mzml_batches(input_mzml)))
+
+
+def load_spectra(path):
+    """
+    Load spectra from a library bundle directory, an mgf or an mzML file
+    """
+    if is_bundle(path):
+        return load_bundle_peaks(path)
+    if path.lower().endswith('.mzml'):
+        return load_mzml_peaks(path)
+    return load_mgf_peaks(path)
+
+
+def iter_spectra_chunks(path, chunk_bytes=64 * 1024 * 1024):
+    """
+    Spectra of a library bundle, an mgf or an mzML file in consecutive chunks of about chunk_bytes
+    """
+    if is_bundle(path):
+        for start, end, _ in _bundle_chunks(path, chunk_bytes):
+            yield load_bundle_peaks(path, start, end)
+    elif path.lower().endswith('.mzml'):
+        # mz + intensity per peak
+        yield from iter_mzml_batches(path, max(chunk_bytes // 16, 1))
+    else:
+        for start, end, first_spectrum in index_mgf_chunks(path, chunk_bytes):
+            yield load_mgf_peaks(path, start, end, first_spectrum)
+
+
+def _parse_variable_value(value):
+    """
+    Parse 'X', 'X-c' or 'X+c' into the offset added to X
+    """
+    value = value.replace(' ', '')
+    if value == 'X':
+        return 0.0
+    if value.startswith('X-'):
+        return -float(value[2:])
+    if value.startswith('X+'):
+        return float(value[2:])
+    raise ValueError(f'Unsupported variable expression: {value}')
+
+
+def _parse_match_expression(expression):
+    """
+    Parse an intensity match expression such as 'Y' or 'Y*0.8' into (variable, factor)
+    """
+    expression = expression.replace(' ', '')
+    variable = expression[0]
+    if len(expression) == 1:
+        return variable, 1.0
+    if expression[1] != '*':
+        raise ValueError(f'Unsupported intensity match expression: {expression}')
+    return variable, float(expression[2:])
+
+
+def compile_query(input_query):
+    """
+    Compile a MassQL query string into a list of condition dicts for the native engine.
+    Raises ValueError for clauses that the native engine does not support.
+    """
+    parsed_dict = msql_parser.parse_msql(input_query)
+
+    querytype = parsed_dict['querytype']
+    if querytype['function'] != 'functionscaninfo' or querytype['datatype'] != 'datams2data':
+        raise ValueError('Only scaninfo(MS2DATA) queries are supported')
+
+    supported_qualifiers = {'type', 'qualifiermztolerance', 'qualifierppmtolerance', 'qualifierintensitypercent',
+                            'qualifierintensitymatch', 'qualifierintensityreference',
+                            'qualifierintensitytolpercent'}
+
+    conditions = []
+    for condition in parsed_dict['conditions']:
+        if condition['conditiontype'] != 'where':
+            raise ValueError('Only WHERE conditions are supported')
+        if condition['type'] not in ('ms2productcondition', 'ms2precursorcondition'):
+            raise ValueError(f'Unsupported condition: {condition["type"]}')
+        if len(condition['value']) != 1:
+            raise ValueError('Only single-valued conditions are supported')
+
+        qualifiers = condition.get('qualifiers', {})
+        unsupported = set(qualifiers) - supported_qualifiers
+        if unsupported:
+            raise ValueError(f'Unsupported qualifiers: {sorted(unsupported)}')
+
+        value = condition['value'][0]
+        compiled = {
+            'type': 'prod' if condition['type'] == 'ms2productcondition' else 'prec',
+            'mz': None,
+            'x_offset': None,
+            'tol_ppm': None,
+            'tol_mz': None,
+            'min_i_norm': None,
+            'ref_var': None,
+            'match_var': None,
+            'match_factor': None,
+            'match_tol_percent': None,
+        }
+        if isinstance(value, str):
+            if value == 'ANY':
+                raise ValueError('ANY conditions are not supported')
+            compiled['x_offset'] = _parse_variable_value(value)
+        else:
+            compiled['mz'] = float(value)
+
+        if 'qualifierppmtolerance' in qualifiers:
+            compiled['tol_ppm'] = float(qualifiers['qualifierppmtolerance']['value'])
+        elif 'qualifiermztolerance' in qualifiers:
+            compiled['tol_mz'] = float(qualifiers['qualifiermztolerance']['value'])
+
+        if 'qualifierintensitypercent' in qualifiers:
+            if qualifiers['qualifierintensitypercent'].get('comparator', 'greaterthan') != 'equal':
+                raise ValueError('Only INTENSITYPERCENT=value is supported')
+            compiled['min_i_norm'] = float(qualifiers['qualifierintensitypercent']['value']) / 100
+
+        if 'qualifierintensitymatch' in qualifiers:
+            variable, factor = _parse_match_expression(qualifiers['qualifierintensitymatch']['value'])
+            if 'qualifierintensityreference' in qualifiers:
+                compiled['ref_var'] = variable
+            elif 'qualifierintensitytolpercent' in qualifiers:
+                compiled['match_var'] = variable
+                compiled['match_factor'] = factor
+                compiled['match_tol_percent'] = float(qualifiers['qualifierintensitytolpercent']['value'])
+
+        if compiled['x_offset'] is not None and (compiled['ref_var'] or compiled['match_var']):
+            raise ValueError('Intensity matching on variable conditions is not supported')
+        if compiled['type'] == 'prec' and (compiled['min_i_norm'] is not None or compiled['ref_var']
+                                           or compiled['match_var']):
+            raise ValueError('Intensity qualifiers on MS2PREC are not supported')
+
+        conditions.append(compiled)
+
+    variable_conditions = [c for c in conditions if c['x_offset'] is not None]
+    if variable_conditions and not any(c['type'] == 'prec' and c['x_offset'] == 0 for c in variable_conditions):
+        raise ValueError('Variable queries need an MS2PREC=X condition')
+
+    return conditions
+
+
+def _mz_tolerance(condition, mz):
+    """
+    m/z tolerance of a condition at mz, 0.1 if not given (massql default)
+    """
+    if condition['tol_ppm'] is not None:
+        return np.abs(condition['tol_ppm'] * mz / 1000000)
+    if condition['tol_mz'] is not None:
+        return condition['tol_mz']
+    return 0.1
+
+
+def _probe_key(condition):
+    """
+    A fixed m/z probe: (m/z, ppm tolerance, m/z tolerance, min relative intensity)
+    """
+    return condition['mz'], condition['tol_ppm'], condition['tol_mz'], condition['min_i_norm']
+
+
+def compile_plan(compiled_queries):
+    """
+    Deduplicate the fixed product-ion probes of all compiled queries into a shared lookup plan.
+    Each probe is searched once per library, and the conditions refer to it by index.
+    """
+    probes = {}
+    queries = {}
+    for query_name, conditions in compiled_queries.items():
+        planned_conditions = []
+        for condition in conditions:
+            if condition['type'] == 'prod' and condition['x_offset'] is None:
+                condition = dict(condition, probe=probes.setdefault(_probe_key(condition), len(probes)))
+            planned_conditions.append(condition)
+        queries[query_name] = planned_conditions
+
+    return {'probes': list(probes), 'queries': queries}
+
+
+# fewer probes are searched by linear scans of the peaks
+SCAN_PROBES = 8
+
+
+def _mz_index(spectra):
+    """
+    Global m/z index: all peaks sorted by m/z, with their spectrum index and relative intensity
+    """
+    if not hasattr(spectra, '_mz_index'):
+        order = np.argsort(spectra.mz, kind='stable')
+        spectra._mz_index = (spectra.mz[order], spectra.spec_idx[order], spectra.intensity[order],
+                             spectra.i_norm[order])
+    return spectra._mz_index
+
+
+def _scan_probe_peaks(spectra, probe_mz, mz_tol):
+    """
+    Peaks of each probe by a linear scan of the peak arrays, in the order of the global m/z index
+    (by m/z, ties in peak order). Returns (probe of each peak, peak ids).
+    """
+    peak_probe_ls = []
+    peak_ids_ls = []
+    for i, (mz, tol) in enumerate(zip(probe_mz, mz_tol)):
+        peak_ids = np.flatnonzero((spectra.mz > mz - tol) & (spectra.mz < mz + tol))
+        peak_ids = peak_ids[np.argsort(spectra.mz[peak_ids], kind='stable')]
+        peak_probe_ls.append(np.full(len(peak_ids), i))
+        peak_ids_ls.append(peak_ids)
+
+    return np.concatenate(peak_probe_ls), np.concatenate(peak_ids_ls)
+
+
+def run_probes(spectra, probes):
+    """
+    Search all probes at once by binary search on the global m/z index, or by linear scans of the peaks
+    for fewer than SCAN_PROBES probes while the index is not built (cheaper than sorting all peaks).
+    Returns a list of (spectrum ids, summed matched intensity) per probe.
+    """
+    n_probes = len(probes)
+    if n_probes == 0:
+        return []
+
+    probe_mz = np.array([x[0] for x in probes], dtype=np.float64)
+    mz_tol = np.array([_mz_tolerance({'tol_ppm': x[1], 'tol_mz': x[2]}, x[0]) for x in probes], dtype=np.float64)
+    min_i_norm = np.array([np.nan if x[3] is None else x[3] for x in probes], dtype=np.float64)
+
+    if n_probes < SCAN_PROBES and not hasattr(spectra, '_mz_index'):
+        peak_probe, peak_ids = _scan_probe_peaks(spectra, probe_mz, mz_tol)
+        sorted_spec_idx, sorted_intensity, sorted_i_norm = spectra.spec_idx, spectra.intensity, spectra.i_norm
+    else:
+        sorted_mz, sorted_spec_idx, sorted_intensity, sorted_i_norm = _mz_index(spectra)
+
+        # peaks strictly inside (mz - tol, mz + tol) of each probe, in m/z order
+        lo = np.searchsorted(sorted_mz, probe_mz - mz_tol, side='right')
+        hi = np.maximum(np.searchsorted(sorted_mz, probe_mz + mz_tol, side='left'), lo)
+        peak_probe = np.repeat(np.arange(n_probes), hi - lo)
+        peak_ids = _expand_ranges(lo, hi)
+
+    keep = sorted_intensity[peak_ids] > 0
+    has_min = ~np.isnan(min_i_norm)
+    if has_min.any():
+        keep &= ~has_min[peak_probe] | (sorted_i_norm[peak_ids] >= min_i_norm[peak_probe])
+
+    # sum per (probe, spectrum), in the same order as a search per probe
+    keys = peak_probe[keep] * spectra.n_spectra + sorted_spec_idx[peak_ids[keep]]
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    summed = np.bincount(inverse, weights=sorted_intensity[peak_ids[keep]], minlength=len(unique_keys))
+    bounds = np.searchsorted(unique_keys, np.arange(n_probes + 1) * spectra.n_spectra)
+
+    return [(unique_keys[bounds[i]:bounds[i + 1]] - i * spectra.n_spectra, summed[bounds[i]:bounds[i + 1]])
+            for i in range(n_probes)]
+
+
+def _eval_fixed_conditions(spectra, conditions, probe_results):
+    """
+    Evaluate the conditions without variables from the probe results, return the boolean mask over spectra
+    """
+    n = spectra.n_spectra
+    passed = np.ones(n, dtype=bool)
+
+    # reference conditions first, so that intensity matches can read the register
+    ref_conditions = [c for c in conditions if c['ref_var'] is not None]
+    other_conditions = [c for c in conditions if c['ref_var'] is None]
+
+    register = {}
+    for condition in ref_conditions + other_conditions:
+        if condition['type'] == 'prec':
+            mz_tol = _mz_tolerance(condition, condition['mz'])
+            passed &= (spectra.precmz > condition['mz'] - mz_tol) & (spectra.precmz < condition['mz'] + mz_tol)
+            continue
+
+        spec_ids, summed = probe_results[condition['probe']]
+
+        if condition['ref_var'] is not None:
+            # a later reference on the same variable overwrites the earlier one, as in massql
+            register[condition['ref_var']] = (spec_ids, summed)
+        elif condition['match_var'] is not None:
+            ref_spec_ids, ref_summed = register.get(condition['match_var'], (spec_ids[:0], summed[:0]))
+            # spectra with both the reference and the matched ion
+            common, ref_pos, pos = np.intersect1d(ref_spec_ids, spec_ids, assume_unique=True,
+                                                  return_indices=True)
+            match_intensity = ref_summed[ref_pos] * condition['match_factor']
+            tol_value = condition['match_tol_percent'] / 100 * match_intensity
+            matched = (summed[pos] > match_intensity - tol_value) & (summed[pos] < match_intensity + tol_value)
+            spec_ids = common[matched]
+
+        hit = np.zeros(n, dtype=bool)
+        hit[spec_ids] = True
+        passed &= hit
+
+    return passed
+
+
+def _determine_mz_max(mz, ppm_tol, da_tol):
+    """
+    Same X binning as massql: consider one X per half-tolerance window
+    """
+    da_tol = da_tol if da_tol < 10000 else 0
+    ppm_tol = ppm_tol if ppm_tol < 10000 else 0
+    half_delta = max(mz * ppm_tol / 1000000, da_tol) / 2
+
+    half_delta = half_delta if half_delta > 0 else 0.05
+
+    return mz + half_delta
+
+
+def _x_tolerances(variable_conditions):
+    """
+    (ppm, m/z) tolerances of the X binning, the smallest of the variable conditions
+    """
+    ppm_tol = 100000
+    da_tol = 100000
+    for condition in variable_conditions:
+        if condition['tol_ppm'] is not None:
+            ppm_tol = min(ppm_tol, condition['tol_ppm'])
+        if condition['tol_mz'] is not None:
+            da_tol = min(da_tol, condition['tol_mz'])
+
+    return ppm_tol, da_tol
+
+
+def _candidate_x(spectra, passed, variable_conditions):
+    """
+    X values massql would substitute, from the precursors of spectra passing the fixed conditions
+    """
+    ppm_tol, da_tol = _x_tolerances(variable_conditions)
+
+    x_values = []
+    running_max_mz = 0
+    for mz_val in np.unique(spectra.precmz[passed]):
+        if running_max_mz > mz_val:
+            continue
+        x_values.append(mz_val)
+        running_max_mz = _determine_mz_max(mz_val, ppm_tol, da_tol)
+
+    return np.asarray(x_values, dtype=np.float64)
+
+
+def _eval_variable_conditions(spectra, passed, variable_conditions):
+    """
+    Evaluate MS2PREC=X / MS2PROD=X-c conditions on the spectra passing the fixed conditions
+    """
+    # few spectra passing: evaluate on them only rather than scanning all peaks (same X values and pairs)
+    spec_ids = np.flatnonzero(passed)
+    if len(spec_ids) < spectra.n_spectra // 2:
+        out = np.zeros(spectra.n_spectra, dtype=bool)
+        if len(spec_ids):
+            out[spec_ids] = _eval_variable_conditions(spectra.take(spec_ids), np.ones(len(spec_ids), dtype=bool),
+                                                      variable_conditions)
+        return out
+
+    x_values = _candidate_x(spectra, passed, variable_conditions)
+    out = np.zeros(spectra.n_spectra, dtype=bool)
+    if len(x_values) == 0:
+        return out
+    n_x = len(x_values)
+
+    # (spectrum, X) pairs allowed by the precursor condition
+    prec_condition = [c for c in variable_conditions if c['type'] == 'prec' and c['x_offset'] == 0][0]
+    prec = spectra.precmz[spec_ids]
+    slack = _mz_tolerance(prec_condition, prec + 1)
+    lo = np.searchsorted(x_values, prec - slack * 1.01, side='left')
+    hi = np.searchsorted(x_values, prec + slack * 1.01, side='right')
+    pair_spec = np.repeat(spec_ids, hi - lo)
+    pair_x = _expand_ranges(lo, hi)
+    pair_keys = pair_spec * n_x + pair_x
+
+    pair_ok = np.ones(len(pair_keys), dtype=bool)
+    for condition in variable_conditions:
+        x_target = x_values[pair_x] + condition['x_offset']
+        if condition['type'] == 'prec':
+            mz_tol = _mz_tolerance(condition, x_target)
+            pair_ok &= (spectra.precmz[pair_spec] > x_target - mz_tol) & \
+                       (spectra.precmz[pair_spec] < x_target + mz_tol)
+            continue
+
+        # candidate (peak, X) pairs by binary search on X, then the exact massql window check
+        peak_ok = passed[spectra.spec_idx] & (spectra.intensity > 0)
+        if condition['min_i_norm'] is not None:
+            peak_ok &= spectra.i_norm >= condition['min_i_norm']
+        peak_ids = np.nonzero(peak_ok)[0]
+        peak_mz = spectra.mz[peak_ids]
+        slack = _mz_tolerance(condition, peak_mz + 1) * 1.01
+        lo = np.searchsorted(x_values, peak_mz - condition['x_offset'] - slack, side='left')
+        hi = np.searchsorted(x_values, peak_mz - condition['x_offset'] + slack, side='right')
+        cand_peak = np.repeat(peak_ids, hi - lo)
+        cand_x = _expand_ranges(lo, hi)
+
+        x_target = x_values[cand_x] + condition['x_offset']
+        mz_tol = _mz_tolerance(condition, x_target)
+        cand_mz = spectra.mz[cand_peak]
+        cand_ok = (cand_mz > x_target - mz_tol) & (cand_mz < x_target + mz_tol)
+        cand_keys = spectra.spec_idx[cand_peak[cand_ok]] * n_x + cand_x[cand_ok]
+
+        pair_ok &= np.isin(pair_keys, cand_keys)
+
+    out[pair_spec[pair_ok]] = True
+    return out
+
+
+def _eval_variable_own_precursor(spectra, passed, variable_conditions):
+    """
+    Evaluate MS2PREC=X / MS2PROD=X-c conditions with X the precursor m/z of each spectrum itself,
+    as massql on a file holding that spectrum only
+    """
+    out = passed.copy()
+    for condition in variable_conditions:
+        x_target = spectra.precmz + condition['x_offset']
+        if condition['type'] == 'prec':
+            mz_tol = _mz_tolerance(condition, x_target)
+            out &= (spectra.precmz > x_target - mz_tol) & (spectra.precmz < x_target + mz_tol)
+            continue
+
+        peak_target = x_target[spectra.spec_idx]
+        mz_tol = _mz_tolerance(condition, peak_target)
+        peak_ok = out[spectra.spec_idx] & (spectra.intensity > 0)
+        if condition['min_i_norm'] is not None:
+            peak_ok &= spectra.i_norm >= condition['min_i_norm']
+        peak_ok &= (spectra.mz > peak_target - mz_tol) & (spectra.mz < peak_target + mz_tol)
+
+        hit = np.zeros(spectra.n_spectra, dtype=bool)
+        hit[spectra.spec_idx[peak_ok]] = True
+        out &= hit
+
+    return out
+
+
+def _expand_ranges(lo, hi):
+    """
+    Concatenate np.arange(lo[i], hi[i]) for all i
+    """
+    counts = hi - lo
+    total = counts.sum()
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    starts = np.repeat(lo - np.cumsum(counts) + counts, counts)
+    return starts + np.arange(total)
+
+
+def eval_query(spectra, conditions, probe_results, per_spectrum=False):
+    """
+    Evaluate a planned query, return the boolean mask over spectra
+    per_spectrum: X of variable queries is the precursor of each spectrum, so that the result of a spectrum
+    does not depend on the others (as if each was queried on its own)
+    """
+    fixed_conditions = [c for c in conditions if c['x_offset'] is None]
+    variable_conditions = [c for c in conditions if c['x_offset'] is not None]
+
+    passed = _eval_fixed_conditions(spectra, fixed_conditions, probe_results)
+    if variable_conditions and per_spectrum:
+        passed = _eval_variable_own_precursor(spectra, passed, variable_conditions)
+    elif variable_conditions:
+        passed = _eval_variable_conditions(spectra, passed, variable_conditions)
+
+    return passed
+
+
+def run_plan(spectra, plan, per_spectrum=False):
+    """
+    Evaluate a query plan on all spectra, return the spectrum x query hit matrix (uint8)
+    per_spectrum: see eval_query
+    """
+    with profile('peak search', n_spectra=spectra.n_spectra):
+        probe_results = run_probes(spectra, plan['probes'])
+
+    hits = np.zeros((spectra.n_spectra, len(plan['queries'])), dtype=np.uint8)
+    for i, (query_name, conditions) in enumerate(plan['queries'].items()):
+        with profile(query_name, kind='query', n_spectra=spectra.n_spectra):
+            hits[:, i] = eval_query(spectra, conditions, probe_results, per_spectrum=per_spectrum)
+
+    return hits
+
+
+def _precursor_index(spectra):
+    """
+    Precursor index: the precursor m/z of all spectra in ascending order (NaN last), with their spectrum ids
+    """
+    if not hasattr(spectra, '_precursor_index'):
+        order = np.argsort(spectra.precmz, kind='stable')
+        spectra._precursor_index = (spectra.precmz[order], order)
+    return spectra._precursor_index
+
+
+def _min_precursor(spectra, conditions):
+    """
+    Precursor m/z at or below which no spectrum can pass a variable query: the windows of its MS2PROD=X-c
+    conditions lie below the smallest m/z of the library. -inf for queries without variables.
+    """
+    variable_products = [c for c in conditions if c['type'] == 'prod' and c['x_offset'] is not None]
+    if not variable_products or len(spectra.mz) == 0 or np.isnan(spectra.precmz).all():
+        return -np.inf
+
+    # X is within the MS2PREC tolerance of the precursor, the largest one if it is in ppm
+    prec_condition = [c for c in conditions if c['type'] == 'prec' and c['x_offset'] == 0][0]
+    prec_tol = _mz_tolerance(prec_condition, np.nanmax(spectra.precmz))
+    min_mz = spectra.mz.min()
+
+    return max(min_mz - c['x_offset'] - prec_tol - _mz_tolerance(c, min_mz) for c in variable_products)
+
+
+def _gate_spectra(spectra, gate_queries):
+    """
+    Spectra the gate queries are evaluated on, from the precursor index: those above the lowest precursor
+    any of them can pass, extended down to a gap in the precursors wider than the X binning window, so
+    that the X values substituted on these spectra are the same as on the whole library
+    """
+    bound = min([_min_precursor(spectra, x) for x in gate_queries.values()], default=-np.inf)
+    if not np.isfinite(bound):
+        return np.arange(spectra.n_spectra)
+
+    sorted_prec, order = _precursor_index(spectra)
+    max_prec = np.nanmax(spectra.precmz)
+    half_window = 0.0
+    slack = 0.0
+    for conditions in gate_queries.values():
+        variable_conditions = [c for c in conditions if c['x_offset'] is not None]
+        if not variable_conditions:
+            continue
+        half_window = max(half_window, _determine_mz_max(bound, *_x_tolerances(variable_conditions)) - bound)
+        prec_condition = [c for c in variable_conditions if c['type'] == 'prec' and c['x_offset'] == 0][0]
+        slack = max(slack, _mz_tolerance(prec_condition, max_prec + 1) * 1.01)
+
+    # X values below the gap cannot be paired with spectra above the bound, nor change their binning
+    limit = np.searchsorted(sorted_prec, bound - slack, side='right')
+    gaps = np.flatnonzero(np.diff(sorted_prec[:limit]) > half_window)
+    start = gaps[-1] + 1 if len(gaps) else 0
+
+    return np.sort(order[start:])
+
+
+def compile_gated_plan(compiled_queries, gates):
+    """
+    Hierarchical query plan: the gate queries (e.g. the BA class queries) run first, on the spectra the
+    precursor index leaves them, then the queries behind them on the spectra passing one of their gates only.
+    gates: query name -> list of gate query names
+    Queries without gates, and variable queries (their X values come from the whole library), run on all spectra.
+    """
+    gate_names = list(dict.fromkeys(g for x in compiled_queries for g in gates.get(x, []) if g in compiled_queries))
+    gate_of = {}
+    for query_name, conditions in compiled_queries.items():
+        query_gates = [g for g in gates.get(query_name, []) if g in compiled_queries and g != query_name]
+        if query_name not in gate_names and query_gates and all(c['x_offset'] is None for c in conditions):
+            gate_of[query_name] = query_gates
+    ungated_names = [x for x in compiled_queries if x not in gate_names and x not in gate_of]
+
+    return {
+        'names': list(compiled_queries),
+        'gates': compile_plan({x: compiled_queries[x] for x in gate_names}),
+        'gated': compile_plan({x: compiled_queries[x] for x in gate_of}),
+        'ungated': compile_plan({x: compiled_queries[x] for x in ungated_names}),
+        'gate_of': gate_of,
+    }
+
+
+def run_gated_plan(spectra, plan):
+    """
+    Evaluate a gated plan (see compile_gated_plan), return the spectrum x query hit matrix (uint8).
+    Hits of the gated queries are only set for the spectra passing one of their gates.
+    """
+    columns = {x: i for i, x in enumerate(plan['names'])}
+    hits = np.zeros((spectra.n_spectra, len(columns)), dtype=np.uint8)
+
+    gate_queries = plan['gates']['queries']
+    if gate_queries:
+        with profile('gate queries') as record:
+            spec_ids = _gate_spectra(spectra, gate_queries)
+            record['n_spectra'] = len(spec_ids)
+            subset = spectra if len(spec_ids) == spectra.n_spectra else spectra.take(spec_ids)
+            hits[np.ix_(spec_ids, [columns[x] for x in gate_queries])] = run_plan(subset, plan['gates'])
+
+    gate_of = plan['gate_of']
+    if gate_of:
+        gate_columns = [columns[x] for x in gate_queries]
+        with profile('gated queries') as record:
+            spec_ids = np.flatnonzero(hits[:, gate_columns].any(axis=1))
+            record['n_spectra'] = len(spec_ids)
+            gated_hits = run_plan(spectra.take(spec_ids), plan['gated'])
+            for j, (query_name, query_gates) in enumerate(gate_of.items()):
+                passed_gate = hits[np.ix_(spec_ids, [columns[x] for x in query_gates])].any(axis=1)
+                hits[spec_ids, columns[query_name]] = gated_hits[:, j] & passed_gate
+
+    if plan['ungated']['queries']:
+        hits[:, [columns[x] for x in plan['ungated']['queries']]] = run_plan(spectra, plan['ungated'])
+
+    return hits
+
+
+def _sweep_conditions(spectra, planned_conditions, probe_results, ratio_values, percent_values):
+    """
+    Hits of one planned query over the ratio x percent grid, from the probe results of its plan.
+    Returns the spectrum x ratio x percent hit array (bool)
+    """
+    n_percent = 1 if percent_values is None else len(percent_values)
+
+    # everything but the intensity matches, which are compared on the grid below
+    passed = _eval_fixed_conditions(spectra, [c for c in planned_conditions if c['match_var'] is None],
+                                    probe_results)
+    passed = np.repeat(passed[:, None, None], len(ratio_values), axis=1).repeat(n_percent, axis=2)
+
+    # a later reference on the same variable overwrites the earlier one
+    register = {c['ref_var']: probe_results[c['probe']] for c in planned_conditions if c['ref_var'] is not None}
+    for condition in planned_conditions:
+        if condition['match_var'] is None:
+            continue
+        spec_ids, summed = probe_results[condition['probe']]
+        ref_spec_ids, ref_summed = register.get(condition['match_var'], (spec_ids[:0], summed[:0]))
+        common, ref_pos, pos = np.intersect1d(ref_spec_ids, spec_ids, assume_unique=True, return_indices=True)
+
+        # (spectrum, ratio, percent), same arithmetic as _eval_fixed_conditions
+        match_intensity = (ref_summed[ref_pos][:, None] * (condition['match_factor'] * ratio_values))[:, :, None]
+        if percent_values is None:
+            tol_value = condition['match_tol_percent'] / 100 * match_intensity
+        else:
+            tol_value = (percent_values / 100)[None, None, :] * match_intensity
+        this_summed = summed[pos][:, None, None]
+        matched = (this_summed > match_intensity - tol_value) & (this_summed < match_intensity + tol_value)
+
+        hit = np.zeros(passed.shape, dtype=bool)
+        hit[common] = matched
+        passed &= hit
+
+    return passed
+
+
+def sweep_queries(spectra, compiled_queries, ppm_grid=None, ratio_grid=(1.0,), percent_grid=None):
+    """
+    Hits of queries without variables over a grid of thresholds. The probes of all queries are planned
+    together and searched once per ppm value, and the intensity matches are compared for all ratios and
+    percents at once.
+    ppm_grid: TOLERANCEPPM of the ppm conditions (None keeps the query values)
+    ratio_grid: scales of the INTENSITYMATCH factors (1 keeps the query values)
+    percent_grid: INTENSITYMATCHPERCENT of the intensity matches (None keeps the query values)
+    Returns (grid DataFrame with ppm, ratio, percent columns, dict of query name -> spectrum x grid hit
+    matrix (uint8))
+    """
+    for query_name, conditions in compiled_queries.items():
+        if any(c['x_offset'] is not None for c in conditions):
+            raise ValueError(f'{query_name}: threshold sweeps only support queries without variables')
+
+    ppm_values = [None] if ppm_grid is None else list(ppm_grid)
+    ratio_values = np.asarray(ratio_grid, dtype=np.float64)
+    percent_values = None if percent_grid is None else np.asarray(percent_grid, dtype=np.float64)
+
+    hits_ls = {x: [] for x in compiled_queries}
+    for ppm in ppm_values:
+        swept = compiled_queries
+        if ppm is not None:
+            swept = {k: [dict(c, tol_ppm=ppm) if c['tol_ppm'] is not None else c for c in v]
+                     for k, v in compiled_queries.items()}
+        plan = compile_plan(swept)
+        probe_results = run_probes(spectra, plan['probes'])
+
+        for query_name, planned_conditions in plan['queries'].items():
+            passed = _sweep_conditions(spectra, planned_conditions, probe_results, ratio_values, percent_values)
+            hits_ls[query_name].append(passed.reshape(spectra.n_spectra, -1))
+
+    grid = pd.DataFrame(list(itertools.product(ppm_values, ratio_values,
+                                               [None] if percent_values is None else percent_values)),
+                        columns=['ppm', 'ratio', 'percent'])
+
+    return grid, {k: np.concatenate(v, axis=1).astype(np.uint8) for k, v in hits_ls.items()}
+
+
+def attach_hits(library_scans, passed_scans):
+    """
+    Join the passed scans of all queries onto the library rows at once (sorted join on the scans).
+    library_scans: SCANS column of the library table
+    passed_scans: dict of query name -> list of passed scans (str)
+    Returns the row x query hit matrix (uint8), a row hits if str(its scan) is among the passed scans
+    """
+    names = list(passed_scans)
+    query_ids = np.repeat(np.arange(len(names)), [len(passed_scans[x]) for x in names])
+    keys = np.array([x for name in names for x in passed_scans[name]], dtype=str)
+
+    library_scans = pd.Series(library_scans)
+    if pd.api.types.is_integer_dtype(library_scans):
+        # join on integers, passed scans not written as an int ('05', '5.0') cannot match
+        row_keys = library_scans.to_numpy(dtype=np.int64)
+        values = pd.to_numeric(pd.Series(keys, dtype=object), errors='coerce')
+        valid = values.notna().to_numpy(copy=True)
+        int_keys = np.zeros(len(keys), dtype=np.int64)
+        int_keys[valid] = values[valid]
+        valid &= int_keys.astype(str) == keys
+        keys, query_ids = int_keys[valid], query_ids[valid]
+    else:
+        row_keys = np.array([str(x) for x in library_scans], dtype=str)
+
+    order = np.argsort(row_keys, kind='stable')
+    sorted_keys = row_keys[order]
+    lo = np.searchsorted(sorted_keys, keys, side='left')
+    hi = np.searchsorted(sorted_keys, keys, side='right')
+
+    hits = np.zeros((len(row_keys), len(names)), dtype=np.uint8)
+    hits[order[_expand_ranges(lo, hi)], np.repeat(query_ids, hi - lo)] = 1
+
+    return hits
+
+
+def _load_chunk(input_mgf, start, end, first_spectrum):
+    """
+    Spectra of one byte range of the mgf file, or one spectrum range of a bundle
+    """
+    if is_bundle(input_mgf):
+        return load_bundle_peaks(input_mgf, start, end)
+    return load_mgf_peaks(input_mgf, start, end, first_spectrum)
+
+
+def _run_plan_chunk(input_mgf, start, end, first_spectrum, plan):
+    """
+    Worker: evaluate a query plan on one chunk of the library
+    """
+    return _run_fixed_conditions(_load_chunk(input_mgf, start, end, first_spectrum), plan)
+
+
+def _run_gated_chunk(input_mgf, start, end, first_spectrum, plan):
+    """
+    Worker: evaluate the gate and ungated queries of a gated plan on one chunk of the library, and keep the
+    spectra passing the fixed conditions of a gate query, the only ones the gated queries can hit
+    """
+    spectra = _load_chunk(input_mgf, start, end, first_spectrum)
+    gate_result = _run_fixed_conditions(spectra, plan['gates'])
+    pool_ids = np.flatnonzero(gate_result[1].any(axis=1))
+
+    return gate_result, _run_fixed_conditions(spectra, plan['ungated']), pool_ids, spectra.take(pool_ids)
+
+
+def _run_fixed_conditions(spectra, plan):
+    """
+    Evaluate a query plan on one chunk of the library.
+    Variable queries need the X values of the whole library, so for them only the fixed conditions are
+    evaluated here, and the spectra passing them are returned for the final step.
+    """
+    probe_results = run_probes(spectra, plan['probes'])
+
+    hits = np.zeros((spectra.n_spectra, len(plan['queries'])), dtype=np.uint8)
+    for i, conditions in enumerate(plan['queries'].values()):
+        fixed_conditions = [c for c in conditions if c['x_offset'] is None]
+        hits[:, i] = _eval_fixed_conditions(spectra, fixed_conditions, probe_results)
+
+    variable_cols = [i for i, conditions in enumerate(plan['queries'].values())
+                     if any(c['x_offset'] is not None for c in conditions)]
+    candidate_ids = np.nonzero(hits[:, variable_cols].any(axis=1))[0] if variable_cols else np.zeros(0, int)
+
+    return spectra.scans, hits, candidate_ids, spectra.take(candidate_ids)
+
+
+def _finish_variable_queries(results, plan):
+    """
+    Merge the chunk results (in chunk order) and finish the variable queries on the spectra passing their
+    fixed conditions, library-wide. Returns (scans, hit matrix).
+    """
+    scans = np.concatenate([x[0] for x in results])
+    hits = np.concatenate([x[1] for x in results])
+
+    chunk_starts = np.cumsum([0] + [len(x[0]) for x in results])[:-1]
+    candidate_ids = np.concatenate([x[2] + chunk_start for x, chunk_start in zip(results, chunk_starts)])
+    candidates = concat_spectra([x[3] for x in results])
+    for i, (query_name, conditions) in enumerate(plan['queries'].items()):
+        variable_conditions = [c for c in conditions if c['x_offset'] is not None]
+        if not variable_conditions:
+            continue
+        with profile(f'{query_name} (variable conditions)', kind='query', n_spectra=len(candidate_ids)):
+            passed = hits[candidate_ids, i] == 1
+            hits[:, i] = 0
+            hits[candidate_ids, i] = _eval_variable_conditions(candidates, passed, variable_conditions)
+
+    return scans, hits
+
+
+def _bundle_chunks(bundle_dir, chunk_bytes):
+    """
+    Split a library bundle into spectrum ranges of about chunk_bytes of peaks (mz + intensity)
+    """
+    offsets = open_bundle(bundle_dir, columns=[])['offsets']
+    n_spectra = len(offsets) - 1
+    chunk_peaks = max(chunk_bytes // 16, 1)
+
+    chunks = []
+    start = 0
+    while start < n_spectra:
+        end = np.searchsorted(offsets, offsets[start] + chunk_peaks, side='left')
+        end = int(min(max(end, start + 1), n_spectra))
+        chunks.append((start, end, start))
+        start = end
+
+    return chunks or [(0, 0, 0)]
+
+
+def _library_chunks(input_mgf, n_workers, max_memory_mb, chunk_mb):
+    """
+    Chunks of the mgf file (or library bundle) for the workers, (start, end, first spectrum)
+    """
+    chunk_bytes = chunk_mb * 1024 * 1024
+    if max_memory_mb is not None:
+        # parsed peaks take several times the size of the mgf text
+        chunk_bytes = min(chunk_bytes, max_memory_mb * 1024 * 1024 // (8 * n_workers))
+    if is_bundle(input_mgf):
+        return _bundle_chunks(input_mgf, max(chunk_bytes, 1))
+    return index_mgf_chunks(input_mgf, max(chunk_bytes, 1))
+
+
+def _run_chunks(worker, input_mgf, plan, n_workers, max_memory_mb, chunk_mb):
+    """
+    Results of a worker on every chunk of the library, in chunk order
+    """
+    n_workers = n_workers or os.cpu_count()
+    chunks = _library_chunks(input_mgf, n_workers, max_memory_mb, chunk_mb)
+
+    # the queries are timed as a whole here, they run in the workers
+    with profile(f'chunks on {n_workers} workers'):
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(worker, input_mgf, start, end, first_spectrum, plan)
+                       for start, end, first_spectrum in chunks]
+            return [future.result() for future in futures]
+
+
+def run_plan_parallel(input_mgf, plan, n_workers=None, max_memory_mb=None, chunk_mb=64):
+    """
+    Evaluate a query plan with a process pool over chunks of the mgf file (or library bundle).
+    Returns (scans, hit matrix), identical to run_plan on the whole file.
+    n_workers: number of processes, default os.cpu_count()
+    max_memory_mb: memory ceiling for the chunks loaded at the same time, caps the chunk size
+    """
+    results = _run_chunks(_run_plan_chunk, input_mgf, plan, n_workers, max_memory_mb, chunk_mb)
+
+    # finish the variable queries on the spectra passing their fixed conditions, library-wide
+    return _finish_variable_queries(results, plan)
+
+
+def run_gated_plan_parallel(input_mgf, plan, n_workers=None, max_memory_mb=None, chunk_mb=64):
+    """
+    Evaluate a gated plan (see compile_gated_plan) with a process pool over chunks of the mgf file (or library
+    bundle). The gate and ungated queries run in the workers, the gated queries then on the spectra passing
+    one of their gates only. Returns (scans, hit matrix), identical to run_gated_plan on the whole file.
+    """
+    results = _run_chunks(_run_gated_chunk, input_mgf, plan, n_workers, max_memory_mb, chunk_mb)
+
+    scans, gate_hits = _finish_variable_queries([x[0] for x in results], plan['gates'])
+    _, ungated_hits = _finish_variable_queries([x[1] for x in results], plan['ungated'])
+
+    columns = {x: i for i, x in enumerate(plan['names'])}
+    gate_columns = {x: j for j, x in enumerate(plan['gates']['queries'])}
+    hits = np.zeros((len(scans), len(columns)), dtype=np.uint8)
+    hits[:, [columns[x] for x in gate_columns]] = gate_hits
+    hits[:, [columns[x] for x in plan['ungated']['queries']]] = ungated_hits
+
+    gate_of = plan['gate_of']
+    if gate_of:
+        with profile('gated queries') as record:
+            chunk_starts = np.cumsum([0] + [len(x[0][0]) for x in results])[:-1]
+            pool_ids = np.concatenate([x[2] + chunk_start for x, chunk_start in zip(results, chunk_starts)])
+            passed = gate_hits[pool_ids].any(axis=1)
+            spec_ids = pool_ids[passed]
+            record['n_spectra'] = len(spec_ids)
+            gated_hits = run_plan(concat_spectra([x[3] for x in results]).take(np.flatnonzero(passed)),
+                                  plan['gated'])
+            for j, (query_name, query_gates) in enumerate(gate_of.items()):
+                passed_gate = gate_hits[np.ix_(spec_ids, [gate_columns[x] for x in query_gates])].any(axis=1)
+                hits[spec_ids, columns[query_name]] = gated_hits[:, j] & passed_gate
+
+    return scans, hits
+
+
+def run_plan_out_of_core(path, plan, chunk_mb=64):
+    """
+    Evaluate a query plan on a library bundle, mgf or mzML file chunk by chunk in this process, holding one
+    chunk of peaks at a time (and the spectra passing the fixed conditions of the variable queries).
+    Returns (scans, precursor m/z, hit matrix), identical to run_plan on the whole file.
+    """
+    results = []
+    precmz = []
+    for spectra in iter_spectra_chunks(path, max(chunk_mb * 1024 * 1024, 1)):
+        results.append(_run_fixed_conditions(spectra, plan))
+        precmz.append(spectra.precmz)
+
+    scans, hits = _finish_variable_queries(results, plan)
+    return scans, np.concatenate(precmz), hits
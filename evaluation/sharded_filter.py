@@ -0,0 +1,291 @@
+"""
+Sharded, out-of-core MassQL filtering of whole repositories of mgf / mzML files (or library bundles).
+
+A shard is one file, queried on its own as massql would (MS2PREC=X values come from the same file). Shards
+run on a process pool, each read chunk by chunk (query_engine.run_plan_out_of_core), so a worker holds one
+chunk of peaks at a time. A finished shard writes its hit table (the spectra hitting at least one query) and
+is recorded in the checkpoint, so an interrupted job resumes with the shards left. The hit tables are then
+merged into one Parquet dataset partitioned by dataset (the first directory of the file under the root).
+
+    out_dir/
+        checkpoint.jsonl   one line per finished shard: file, size, mtime, query key, counts, seconds
+        shards/            hit table of every shard (<shard key>.parquet)
+        hits/              merged output, hits/dataset=<dataset>/*.parquet
+"""
+import os
+import json
+import time
+import shutil
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.dataset as ds
+
+from library_bundle import is_bundle
+from query_cache import normalize_query
+from query_engine import compile_query, compile_plan, run_plan_out_of_core
+from msql_common import MERGED_QUERIES, get_filter_gates
+from profiling import profile, report
+
+
+SHARD_SUFFIXES = ('.mgf', '.mzml')
+
+
+def list_shards(source, suffixes=SHARD_SUFFIXES):
+    """
+    Files of a collection: a directory (walked recursively, bundle directories are one shard each) or a
+    manifest, a text file with one path per line (relative to the manifest, '#' for comments).
+    Returns (root, sorted paths), root being the directory the dataset names are taken from
+    """
+    if os.path.isdir(source):
+        paths = []
+        for dir_path, dir_names, file_names in os.walk(source):
+            bundles = [x for x in dir_names if is_bundle(os.path.join(dir_path, x))]
+            paths += [os.path.join(dir_path, x) for x in bundles]
+            dir_names[:] = sorted(x for x in dir_names if x not in bundles)
+            paths += [os.path.join(dir_path, x) for x in file_names if x.lower().endswith(suffixes)]
+        return source, sorted(paths)
+
+    manifest_dir = os.path.dirname(os.path.abspath(source))
+    with open(source) as file:
+        lines = [x.strip() for x in file]
+    paths = [os.path.normpath(os.path.join(manifest_dir, x)) for x in lines if x and not x.startswith('#')]
+    paths = sorted(dict.fromkeys(paths))
+    root = os.path.commonpath([os.path.dirname(x) for x in paths]) if paths else manifest_dir
+
+    return root, paths
+
+
+def _dataset_of(rel_path, root):
+    """
+    First directory of a file under the collection root, the root name for the files right in it
+    """
+    parts = rel_path.split(os.sep)
+    return parts[0] if len(parts) > 1 else os.path.basename(os.path.abspath(root))
+
+
+def _file_state(path):
+    """
+    (size, mtime) of a shard file, summed / latest over the files of a bundle
+    """
+    if os.path.isdir(path):
+        stats = [os.stat(os.path.join(path, x)) for x in sorted(os.listdir(path))]
+        return sum(x.st_size for x in stats), max([x.st_mtime_ns for x in stats], default=0)
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def queries_key(massql_queries, gated=False):
+    """
+    Hash of the query texts, shards run with other queries are run again
+    """
+    sha = hashlib.sha1()
+    for query_name, input_query in massql_queries.items():
+        sha.update(f'{query_name}\t{normalize_query(input_query)}\n'.encode())
+    sha.update(f'gated={gated}'.encode())
+    return sha.hexdigest()
+
+
+def load_checkpoint(out_dir):
+    """
+    Finished shards (relative path -> record) in the order of their latest record, which is the one that counts
+    """
+    records = {}
+    checkpoint = os.path.join(out_dir, 'checkpoint.jsonl')
+    if not os.path.exists(checkpoint):
+        return records
+    with open(checkpoint) as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # the last line of an interrupted write
+                continue
+            records.pop(record['file'], None)
+            records[record['file']] = record
+    return records
+
+
+def _end_partial_line(checkpoint):
+    """
+    Terminate the last line of an interrupted write, so that the next record starts on a line of its own
+    """
+    if not os.path.exists(checkpoint) or not os.path.getsize(checkpoint):
+        return
+    with open(checkpoint, 'rb+') as file:
+        file.seek(-1, os.SEEK_END)
+        if file.read(1) != b'\n':
+            file.write(b'\n')
+
+
+def _hit_schema(hit_names):
+    return pa.schema([('dataset', pa.string()), ('file', pa.string()), ('scan', pa.string()),
+                      ('precursor_mz', pa.float64())] + [(x, pa.uint8()) for x in hit_names])
+
+
+def _run_shard(path, rel_path, dataset, plan, hit_columns, gate_columns, chunk_mb, out_path):
+    """
+    Worker: query one file chunk by chunk and write the spectra hitting any query to out_path
+    hit_columns: (output name, query columns merged into it)
+    gate_columns: query column -> class query columns, the query only hits spectra passing one of them
+    """
+    start = time.perf_counter()
+    scans, precmz, hits = run_plan_out_of_core(path, plan, chunk_mb)
+
+    for i, gates in gate_columns.items():
+        hits[:, i] &= hits[:, gates].max(axis=1)
+    hits = np.column_stack([np.bitwise_or.reduce(hits[:, columns], axis=1) for _, columns in hit_columns]) \
+        if len(hits) else np.zeros((0, len(hit_columns)), dtype=np.uint8)
+
+    rows = np.flatnonzero(hits.any(axis=1))
+    columns = [pa.array(np.full(len(rows), dataset), pa.string()),
+               pa.array(np.full(len(rows), rel_path), pa.string()),
+               pa.array(scans[rows], pa.string()), pa.array(precmz[rows], pa.float64())]
+    columns += [pa.array(hits[rows, j], pa.uint8()) for j in range(len(hit_columns))]
+    table = pa.Table.from_arrays(columns, schema=_hit_schema([x for x, _ in hit_columns]))
+
+    # a shard file is either complete or absent
+    pq.write_table(table, out_path + '.tmp')
+    os.replace(out_path + '.tmp', out_path)
+
+    return {'n_spectra': len(scans), 'n_hit_spectra': len(rows),
+            'n_hits': dict(zip([x for x, _ in hit_columns], hits.sum(axis=0).tolist())),
+            'seconds': time.perf_counter() - start}
+
+
+def sharded_filter(source, massql_queries, out_dir, n_workers=None, max_memory_mb=None, chunk_mb=64,
+                   gated=False, merge=True):
+    """
+    Run the queries on every file of a collection (directory or manifest, see list_shards) on a process
+    pool, resuming from the checkpoint in out_dir, then merge the hit tables into out_dir/hits
+    max_memory_mb: memory ceiling for the chunks loaded at the same time, caps the chunk size
+    gated: the isomer queries only hit spectra passing their class query, as massql_filter(..., gated=True)
+    """
+    n_workers = n_workers or os.cpu_count()
+    if max_memory_mb is not None:
+        # parsed peaks take several times the size of the file text
+        chunk_mb = min(chunk_mb, max(max_memory_mb // (8 * n_workers), 1))
+
+    root, paths = list_shards(source)
+    key = queries_key(massql_queries, gated)
+    shard_dir = os.path.join(out_dir, 'shards')
+    os.makedirs(shard_dir, exist_ok=True)
+
+    with profile('compile queries'):
+        compiled_queries = {}
+        for query_name, input_query in massql_queries.items():
+            try:
+                compiled_queries[query_name] = compile_query(input_query)
+            except ValueError as e:
+                print(f'{query_name}: {e}, skipped')
+        plan = compile_plan(compiled_queries)
+
+    query_names = list(compiled_queries)
+    merged = {k: v for k, v in MERGED_QUERIES.items() if all(x in compiled_queries for x in v)}
+    hit_columns = [(x, [i]) for i, x in enumerate(query_names) if not any(x in v for v in merged.values())]
+    hit_columns += [(k, [query_names.index(x) for x in v]) for k, v in merged.items()]
+
+    gate_columns = {}
+    if gated:
+        for query_name, query_gates in get_filter_gates(compiled_queries).items():
+            query_gates = [query_names.index(x) for x in query_gates]
+            if query_gates:
+                gate_columns[query_names.index(query_name)] = query_gates
+
+    # shards not finished with these queries, or changed since
+    checkpoint = load_checkpoint(out_dir)
+    shards = []
+    for path in paths:
+        rel_path = os.path.relpath(path, root)
+        shard_key = hashlib.sha1(rel_path.encode()).hexdigest()[:20]
+        size, mtime = _file_state(path)
+        record = checkpoint.get(rel_path)
+        done = record is not None and record['query_key'] == key and record['size'] == size and \
+            record['mtime_ns'] == mtime and os.path.exists(os.path.join(shard_dir, f'{shard_key}.parquet'))
+        shards.append((path, rel_path, shard_key, size, mtime, done))
+
+    todo = [x for x in shards if not x[5]]
+    print(f'{len(shards)} shards, {len(shards) - len(todo)} done, {len(todo)} to run on {n_workers} workers')
+
+    failed = []
+    _end_partial_line(os.path.join(out_dir, 'checkpoint.jsonl'))
+    with profile(f'shards on {n_workers} workers') as record, \
+            open(os.path.join(out_dir, 'checkpoint.jsonl'), 'a') as checkpoint_file, \
+            ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {executor.submit(_run_shard, path, rel_path, _dataset_of(rel_path, root), plan, hit_columns,
+                                   gate_columns, chunk_mb, os.path.join(shard_dir, f'{shard_key}.parquet')):
+                   (rel_path, shard_key, size, mtime) for path, rel_path, shard_key, size, mtime, _ in todo}
+
+        n_spectra = 0
+        for n_done, future in enumerate(as_completed(futures), 1):
+            rel_path, shard_key, size, mtime = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                # an unreadable file does not stop the job, it is run again on resume
+                failed.append(rel_path)
+                print(f'[{n_done}/{len(todo)}] {rel_path}: failed, {e!r}')
+                continue
+
+            checkpoint_file.write(json.dumps({'file': rel_path, 'shard': shard_key, 'size': size, 'mtime_ns': mtime,
+                                              'query_key': key, **result}) + '\n')
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+            n_spectra += result['n_spectra']
+            print(f'[{n_done}/{len(todo)}] {rel_path}: {result["n_spectra"]} spectra, '
+                  f'{result["n_hit_spectra"]} hit, {result["seconds"]:.1f} s')
+        record['n_spectra'] = n_spectra
+
+    if failed:
+        print(f'{len(failed)} shards failed: {", ".join(failed[:10])}{" ..." if len(failed) > 10 else ""}')
+
+    if merge:
+        finished = [x[2] for x in shards if x[1] not in failed]
+        with profile('merge shards'):
+            merge_shards(out_dir, finished)
+
+    report(f'sharded_filter_{os.path.basename(os.path.normpath(out_dir))}')
+
+    return failed
+
+
+def merge_shards(out_dir, shard_keys=None):
+    """
+    Merge the shard hit tables into one Parquet dataset partitioned by dataset, out_dir/hits
+    shard_keys: shards to merge, in this order (default: all shards of the checkpoint run with the last queries)
+    """
+    if shard_keys is None:
+        records = list(load_checkpoint(out_dir).values())
+        last_key = records[-1]['query_key'] if records else None
+        shard_keys = [x['shard'] for x in sorted(records, key=lambda x: x['file']) if x['query_key'] == last_key]
+
+    files = [os.path.join(out_dir, 'shards', f'{x}.parquet') for x in shard_keys]
+    files = [x for x in files if os.path.exists(x)]
+    hits_dir = os.path.join(out_dir, 'hits')
+    if os.path.exists(hits_dir):
+        shutil.rmtree(hits_dir)
+    if not files:
+        return hits_dir
+
+    # streamed batch by batch, the shard tables are not loaded at once
+    dataset = ds.dataset(files, format='parquet', schema=pq.read_schema(files[0]))
+    ds.write_dataset(dataset, hits_dir, format='parquet',
+                     partitioning=ds.partitioning(pa.schema([('dataset', pa.string())]), flavor='hive'),
+                     preserve_order=True, existing_data_behavior='overwrite_or_ignore')
+
+    return hits_dir
+
+
+if __name__ == '__main__':
+    from bile19_msql import NEW_QUERIES
+
+    sharded_filter('data/repository', NEW_QUERIES, 'data/repository_hits', max_memory_mb=16000)
+
+    # or the files listed in a manifest (one path per line), isomer queries gated by their class query
+    # sharded_filter('data/repository_manifest.txt', NEW_QUERIES, 'data/repository_hits', gated=True)
+
+    # merge again the finished shards of an interrupted job
+    # merge_shards('data/repository_hits')
@@ -0,0 +1,65 @@
+"""
+Classification service against the evaluation rule of main_evaluation, on hand-made spectra and the synthetic
+library. Run from evaluation/: python -m pytest -q
+"""
+import numpy as np
+import pytest
+
+from bile19_msql import NEW_QUERIES
+from classify_service import Classifier
+from main_evaluation import group_containers
+from query_engine import load_spectra
+
+
+# Monohydroxy fragments (precursor X, X-358.2871) and the 3a-OH pair (109.101 at 0.8 of 107.086)
+PRECURSOR_MZ = 375.29
+MONO_3A_PEAKS = [[PRECURSOR_MZ - 358.2871, 20.0], [107.086, 100.0], [109.101, 80.0], [323.27, 50.0],
+                 [341.28, 60.0]]
+
+
+@pytest.fixture(scope='module')
+def classifier():
+    return Classifier()
+
+
+def _records(spectra):
+    return [{'scan': scan, 'precursor_mz': precmz, 'peaks': np.column_stack(
+                [spectra.mz[start:end], spectra.intensity[start:end]]).tolist()}
+            for scan, precmz, start, end in zip(spectra.scans.tolist(), spectra.precmz.tolist(),
+                                                spectra.offsets[:-1], spectra.offsets[1:])]
+
+
+def test_3a_oh_spectrum(classifier):
+    # 3-OH is in the 3a-OH chain but is not a query, it passes as in the evaluation
+    assert '3-OH' not in NEW_QUERIES and '3-OH' in group_containers['mono']['3a-OH'][0]
+
+    out = classifier.classify([{'scan': 'a', 'precursor_mz': PRECURSOR_MZ, 'peaks': MONO_3A_PEAKS}])
+    assert out[0]['hits']['Monohydroxy'] == 1 and out[0]['hits']['3a-OH'] == 1
+    assert out[0]['classes'] == [{'class': 'Monohydroxy', 'isomers': [{'query': '3a-OH', 'groups': ['3a']}]}]
+
+    # without the 3a-OH pair, the class only
+    peaks = [x for x in MONO_3A_PEAKS if x[0] not in (107.086, 109.101)]
+    out = classifier.classify([{'scan': 'b', 'precursor_mz': PRECURSOR_MZ, 'peaks': peaks}])
+    assert out[0]['classes'] == [{'class': 'Monohydroxy', 'isomers': []}]
+
+
+def test_library_classes(classifier, library_mgf):
+    out = classifier.classify(_records(load_spectra(library_mgf)))
+
+    n_isomers = 0
+    for spectrum in out:
+        hits = spectrum['hits']
+        classes = {x['class']: {y['query'] for y in x['isomers']} for x in spectrum['classes']}
+        for group, group_container in group_containers.items():
+            class_name = f'{group}hydroxy'.capitalize()
+            if not hits[class_name]:
+                assert class_name not in classes
+                continue
+            # a container query is reported when its chain hits (queries that are not run pass) and no
+            # query refining it is reported too
+            chain_hits = {k for k, (v, _) in group_container.items() if k in hits and
+                          all(hits.get(x, 1) for x in [k] + v)}
+            refined = {x for k in chain_hits for x in group_container[k][0] if x != k}
+            assert classes[class_name] == chain_hits - refined, spectrum['scan']
+            n_isomers += len(classes[class_name])
+    assert n_isomers
@@ -0,0 +1,147 @@
+"""
+main_evaluation (bincount confusion counts) and incremental_evaluation against the per-query loop they
+replaced, on synthetic label tables. Run from evaluation/: python -m pytest -q
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from main_evaluation import group_containers, main_evaluation, load_label_tables
+from incremental import incremental_evaluation
+
+
+def _confusion(df, gt, pred):
+    """
+    TP, FP, TN, FN and FN adduct counts, as the baseline wrote them out for every query
+    """
+    return [sum((gt == 1) & (pred == 1)), sum((gt == 0) & (pred == 1)), sum((gt == 0) & (pred == 0)),
+            sum((gt == 1) & (pred == 0)), df['ADDUCT'][(gt == 1) & (pred == 0)].value_counts().to_dict()]
+
+
+def baseline_main_evaluation(group='mono', adduct_filter=False):
+    """
+    main_evaluation before the bincount confusion counts
+    """
+    group_container = group_containers[group]
+
+    bile19_df = pd.read_csv('data/label/bilelib19_df.tsv', sep='\t')
+    new_core_df = pd.read_csv('data/label/new_core_df.tsv', sep='\t')
+    bile19_df = bile19_df[bile19_df['IONMODE'] == 'Positive'].reset_index(drop=True)
+    if adduct_filter:
+        bile19_df = bile19_df[bile19_df['ADDUCT'].isin(['M+H', 'M-H2O+H'])].reset_index(drop=True)
+        new_core_df = new_core_df[new_core_df['ADDUCT'].isin(['[M+H]+', '[M-H2O+H]+'])].reset_index(drop=True)
+
+    group_name = f'{group}hydroxy'
+    group_name = group_name[0].upper() + group_name[1:]
+
+    def row(name, bile19_gt, bile19_pred, new_core_gt, new_core_pred):
+        bile19 = _confusion(bile19_df, bile19_gt, bile19_pred)
+        new_core = _confusion(new_core_df, new_core_gt, new_core_pred)
+        return [name] + bile19 + new_core + [bile19[k] + new_core[k] for k in range(4)]
+
+    out_list = [row(group_name, bile19_df[f'{group}_gt'].values, bile19_df[group_name].values,
+                    new_core_df[f'{group}_gt'].values, new_core_df[group_name].values)]
+
+    bile19_df = bile19_df[bile19_df[group_name] == 1].reset_index(drop=True)
+    new_core_df = new_core_df[new_core_df[group_name] == 1].reset_index(drop=True)
+
+    if group == 'di':
+        out_list.append(row('1-OH-Sidechain; 1-OH-core', bile19_df['di_1_sc_oh'].values,
+                            bile19_df['1-OH-Sidechain; 1-OH-core'].values, new_core_df['di_1_sc_oh'].values,
+                            new_core_df['1-OH-Sidechain; 1-OH-core'].values))
+
+    for _group, (massql_groups, group_ls) in group_container.items():
+        bile19_gt = bile19_df['group'].apply(lambda x: 1 if x and any(g == str(x) for g in group_ls) else 0).values
+        bile19_pred = bile19_df[_group].values
+        for msql_group in massql_groups:
+            bile19_pred = bile19_df[msql_group].values & bile19_pred
+
+        new_core_gt = new_core_df['group'].apply(lambda x: 1 if any(g in str(x) for g in group_ls) else 0)
+        new_core_pred = new_core_df[_group].values
+        for msql_group in massql_groups:
+            new_core_pred = new_core_df[msql_group].values & new_core_pred
+
+        out_list.append(row(_group, bile19_gt, bile19_pred, new_core_gt, new_core_pred))
+
+    out_df = pd.DataFrame(out_list, columns=['group', 'bile19_TP', 'bile19_FP', 'bile19_TN', 'bile19_FN',
+                                             'bile19_FN_adduct', 'new_core_TP', 'new_core_FP', 'new_core_TN',
+                                             'new_core_FN', 'new_core_FN_adduct', 'total_TP', 'total_FP', 'total_TN',
+                                             'total_FN'])
+    out_df['total_FDR'] = out_df['total_FP'] / (out_df['total_FP'] + out_df['total_TP'])
+    out_df['total_FNR'] = out_df['total_FN'] / (out_df['total_FN'] + out_df['total_TP'])
+
+    if adduct_filter:
+        out_name = f'data/result/{group}_evaluation_H_adducts.tsv'
+    else:
+        out_name = f'data/result/{group}_evaluation_all_adducts.tsv'
+    out_df.to_csv(out_name, sep='\t', index=False)
+
+
+def _label_table(rng, n_rows, adducts, groups):
+    query_names = {x for c in group_containers.values() for k, (v, _) in c.items() for x in [k] + v}
+    query_names |= {'Monohydroxy', 'Dihydroxy', 'Trihydroxy', '1-OH-Sidechain; 1-OH-core'}
+
+    df = pd.DataFrame({'SCANS': np.arange(n_rows), 'ADDUCT': rng.choice(adducts, n_rows),
+                       'group': rng.choice(groups, n_rows)})
+    for x in ['mono_gt', 'di_gt', 'tri_gt', 'di_1_sc_oh']:
+        df[x] = rng.integers(0, 2, n_rows)
+    for x in sorted(query_names):
+        # mostly hits, so that the chains of several queries hit too
+        df[x] = (rng.random(n_rows) < 0.7).astype(int)
+    return df
+
+
+def _write_label_tables(work_dir, seed=0, n_rows=400):
+    rng = np.random.default_rng(seed)
+    groups = sorted({x for c in group_containers.values() for _, (_, v) in c.items() for x in v})
+    os.makedirs(os.path.join(work_dir, 'data', 'label'), exist_ok=True)
+    os.makedirs(os.path.join(work_dir, 'data', 'result'), exist_ok=True)
+
+    bile19_df = _label_table(rng, n_rows, ['M+H', 'M-H2O+H', 'M+Na', 'M+NH4'], groups + ['other', None])
+    bile19_df['IONMODE'] = rng.choice(['Positive', 'Negative'], n_rows, p=[0.8, 0.2])
+    bile19_df.to_csv(os.path.join(work_dir, 'data', 'label', 'bilelib19_df.tsv'), sep='\t', index=False)
+
+    new_core_groups = [f'{x}_{y}' for x in groups for y in ['a', 'b']] + ['3a7b12a', 'other']
+    new_core_df = _label_table(rng, n_rows, ['[M+H]+', '[M-H2O+H]+', '[M+Na]+', None], new_core_groups)
+    new_core_df.to_csv(os.path.join(work_dir, 'data', 'label', 'new_core_df.tsv'), sep='\t', index=False)
+
+
+def _read_text(path):
+    with open(path) as file:
+        return file.read()
+
+
+@pytest.mark.parametrize('adduct_filter', [False, True])
+@pytest.mark.parametrize('group', ['mono', 'di', 'tri'])
+def test_main_evaluation(tmp_path, monkeypatch, group, adduct_filter):
+    monkeypatch.chdir(tmp_path)
+    _write_label_tables(str(tmp_path))
+
+    baseline_main_evaluation(group, adduct_filter)
+    out_name = 'data/result/' + os.listdir('data/result')[0]
+    expected = _read_text(out_name)
+
+    main_evaluation(group, adduct_filter)
+    assert _read_text(out_name) == expected
+
+
+@pytest.mark.parametrize('group', ['mono', 'di', 'tri'])
+def test_incremental_evaluation(tmp_path, monkeypatch, group):
+    monkeypatch.chdir(tmp_path)
+    _write_label_tables(str(tmp_path))
+    out_name = f'data/result/{group}_evaluation_all_adducts.tsv'
+
+    # first run, then rows removed, edited and added
+    label_tables = load_label_tables()
+    incremental_evaluation(group, label_tables=label_tables)
+    bile19_df, new_core_df = label_tables
+    bile19_df = bile19_df.drop(index=range(0, 40)).reset_index(drop=True)
+    new_core_df.loc[10:30, 'Trihydroxy'] = 1 - new_core_df.loc[10:30, 'Trihydroxy']
+    new_core_df = pd.concat([new_core_df, new_core_df.iloc[:25]], ignore_index=True)
+
+    incremental_evaluation(group, label_tables=(bile19_df, new_core_df))
+    incremental_text = _read_text(out_name)
+    main_evaluation(group, label_tables=(bile19_df, new_core_df))
+    assert incremental_text == _read_text(out_name)
@@ -0,0 +1,199 @@
+"""
+Label scripts (bile19_label, new_core_db_label) against the row-wise versions they replaced, on small
+synthetic tables. Run from evaluation/: python -m pytest -q
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import bile19_label
+import new_core_db_label
+
+
+STEREO_COLUMNS = [
+    ('[1*]O_beta', '1b'), ('[2*]O_alpha', '2a'), ('[2*]O_beta', '2b'), ('[3*]=O', '3keto'),
+    ('[3*]O_alpha', '3a'), ('[3*]O_beta', '3b'), ('[4*]O_alpha', '4a'), ('[4*]O_beta', '4b'),
+    ('[6*]O_alpha', '6a'), ('[6*]O_beta', '6b'), ('[6*]=O', '6keto'), ('[7*]O_alpha', '7a'),
+    ('[7*]O_beta', '7b'), ('[7*]=O', '7keto'), ('[12*]O_alpha', '12a'), ('[12*]O_beta', '12b'),
+    ('[12*]=O', '12keto'), ('[14*]O_alpha', '14a'), ('[15*]O_alpha', '15a'), ('[15*]O_beta', '15b'),
+    ('[16*]O_alpha', '16a'), ('[16*]=O', '16keto'),
+]
+
+
+def baseline_process_unique_smiles():
+    """
+    process_unique_smiles of bile19_label before the table-driven labeler
+    """
+    df = pd.read_csv('data/label/BILELIB19_Names_ok_labaled_IM.csv')
+    df = df.drop_duplicates(subset=['SMILES']).reset_index(drop=True)
+    df = df.fillna(0)
+    df['[1*]O_beta'] = df['[1*]O_beta'].apply(lambda x: 1 if x == 1 else 0)
+
+    # gen_label_stereo, one row at a time
+    df['group'] = df.apply(lambda x: ''.join(label for col, label in STEREO_COLUMNS if x[col] > 0), axis=1)
+
+    df['mono_gt'] = df['[*]O'].apply(lambda x: 1 if x == 1 else 0)
+    df['di_gt'] = df['[*]O'].apply(lambda x: 1 if x == 2 else 0)
+    df['tri_gt'] = df['[*]O'].apply(lambda x: 1 if x == 3 else 0)
+    df['di_1_sc_oh'] = df['BA_Class'].apply(lambda x: 1 if x == 'Dihydroxy, 1_SC_OH' else 0)
+    df['amide'] = df['tail_has'].apply(lambda x: 1 if x == 'Amide' else 0)
+
+    df = df[['SMILES', 'group', 'mono_gt', 'di_gt', 'tri_gt', 'di_1_sc_oh', 'amide']]
+    df.to_csv('data/label/BILELIB19_SMILES_group.tsv', sep='\t', index=False)
+
+
+def baseline_bile19_get_label():
+    """
+    get_label of bile19_label before the keyed joins
+    """
+    df = pd.read_csv('data/BILELIB19_corrected_massql.tsv', sep='\t')
+    smiles_df = pd.read_csv('data/label/BILELIB19_SMILES_group.tsv', sep='\t')
+
+    for col in ['group', 'mono_gt', 'di_gt', 'tri_gt', 'di_1_sc_oh', 'amide']:
+        df[col] = df['SMILES'].map(dict(zip(smiles_df['SMILES'], smiles_df[col])))
+
+    df = df[(df['mono_gt'] == 1) | (df['di_gt'] == 1) | (df['tri_gt'] == 1)].reset_index(drop=True)
+    df = df[df['amide'] == 1].reset_index(drop=True)
+
+    corrected_df = pd.read_csv('data/label/bilelib19_df_corrected.tsv', sep='\t')
+    df['group'] = df['NAME'].map(dict(zip(corrected_df['NAME'], corrected_df['group'])))
+    df['ADDUCT'] = df['NAME'].apply(lambda x: x.split(' ')[-1])
+
+    df.to_csv('data/label/bilelib19_df.tsv', sep='\t', index=False)
+
+
+def baseline_new_core_get_label():
+    """
+    get_label of new_core_db_label before the vectorized tokenizer
+    """
+    df = pd.read_csv('data/new_core_corrected_massql.tsv', sep='\t')
+    df['_NAME'] = df['NAME'].apply(lambda x: x.replace('_NCE45', ''))
+    df['group'] = df['_NAME'].apply(lambda x: x.split('_')[0] if '_' in x else x)
+    df['group'] = df['group'].apply(lambda x: x.replace('keta', 'keto'))
+
+    def get_oh_gt(name):
+        text = name.lower()
+        return text.count('alpha') + text.count('beta') + text.count('delta') + 2 * text.count('keto')
+
+    df['oh_gt'] = df['group'].apply(lambda x: get_oh_gt(x))
+    df['mono_gt'] = df['oh_gt'].apply(lambda x: 1 if x == 1 else 0)
+    df['di_gt'] = df['oh_gt'].apply(lambda x: 1 if x == 2 else 0)
+    df['tri_gt'] = df['oh_gt'].apply(lambda x: 1 if x == 3 else 0)
+    df = df[(df['mono_gt'] == 1) | (df['di_gt'] == 1) | (df['tri_gt'] == 1)].reset_index(drop=True)
+    df['group'] = df['group'].apply(lambda x: x.replace('beta', 'b'))
+    df['group'] = df['group'].apply(lambda x: x.replace('alpha', 'a'))
+    df = df[~((df['group'] == '3a7b') & (df['Trihydroxy'] == 1))]
+    df['di_1_sc_oh'] = 0
+
+    df.to_csv('data/label/new_core_df.tsv', sep='\t', index=False)
+
+
+def _write_bile19_tables(work_dir, seed=0):
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.join(work_dir, 'data', 'label'), exist_ok=True)
+
+    n_smiles = 60
+    smiles = [f'C{i}O' for i in range(n_smiles)]
+    names_df = pd.DataFrame({'SMILES': smiles + smiles[:10] + [np.nan]})
+    for col, _ in STEREO_COLUMNS:
+        values = rng.choice([0, 1, 2, np.nan], len(names_df), p=[0.7, 0.15, 0.05, 0.1])
+        names_df[col] = values
+    names_df['[*]O'] = rng.integers(0, 5, len(names_df))
+    names_df['BA_Class'] = rng.choice(['Dihydroxy, 1_SC_OH', 'Monohydroxy', np.nan], len(names_df))
+    names_df['tail_has'] = rng.choice(['Amide', 'Acid', np.nan], len(names_df), p=[0.7, 0.2, 0.1])
+    names_df.to_csv(os.path.join(work_dir, 'data', 'label', 'BILELIB19_Names_ok_labaled_IM.csv'), index=False)
+
+    n_rows = 300
+    row_smiles = rng.choice(smiles + ['CCC', 'unlabeled'], n_rows)
+    names = [f'BA {rng.integers(0, 80)} {rng.choice(["M+H", "M+Na", "M+NH4"])}' for _ in range(n_rows)]
+    massql_df = pd.DataFrame({'SCANS': np.arange(n_rows), 'NAME': names, 'SMILES': row_smiles,
+                              'PEPMASS': np.round(rng.uniform(300, 600, n_rows), 4),
+                              '3a-OH': rng.integers(0, 2, n_rows)})
+    massql_df.to_csv(os.path.join(work_dir, 'data', 'BILELIB19_corrected_massql.tsv'), sep='\t', index=False)
+
+    corrected_names = sorted(set(names))[::2]
+    corrected_df = pd.DataFrame({'NAME': corrected_names + corrected_names[:3],
+                                 'group': rng.choice(['3a', '7b', '3a7a12a', '12a'], len(corrected_names) + 3)})
+    corrected_df.to_csv(os.path.join(work_dir, 'data', 'label', 'bilelib19_df_corrected.tsv'), sep='\t',
+                        index=False)
+
+
+NEW_CORE_NAMES = ['3alpha_NCE45', '3beta7alpha_x', '3keta7alpha_1', '3alpha7beta_2', '3alpha7beta12alpha_NCE45',
+                  'Delta3_y', '3alpha7alpha12alpha', 'keto_only', 'abc', '3Alpha7Beta_z']
+
+
+def _write_new_core_table(path, seed=0, n_rows=200):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({'SCANS': np.arange(n_rows), 'NAME': rng.choice(NEW_CORE_NAMES, n_rows),
+                       'PEPMASS': np.round(rng.uniform(300, 600, n_rows), 4),
+                       'Trihydroxy': rng.integers(0, 2, n_rows), '3a-OH': rng.integers(0, 2, n_rows)})
+    df.to_csv(path, sep='\t', index=False)
+
+
+def _read_text(path):
+    with open(path) as file:
+        return file.read()
+
+
+def test_bile19_labels(tmp_path, monkeypatch):
+    for name in ['baseline', 'new']:
+        _write_bile19_tables(str(tmp_path / name))
+
+    monkeypatch.chdir(tmp_path / 'baseline')
+    baseline_process_unique_smiles()
+    baseline_bile19_get_label()
+
+    monkeypatch.chdir(tmp_path / 'new')
+    bile19_label.process_unique_smiles()
+    # the second run reads the saved label index
+    for _ in range(2):
+        bile19_label.get_label()
+
+        for name in ['BILELIB19_SMILES_group.tsv', 'bilelib19_df.tsv']:
+            assert _read_text(f'data/label/{name}') == _read_text(f'../baseline/data/label/{name}'), name
+
+
+@pytest.mark.parametrize('chunksize', [None, 1000])
+def test_new_core_labels(tmp_path, monkeypatch, chunksize):
+    for name in ['baseline', 'new']:
+        os.makedirs(tmp_path / name / 'data' / 'label')
+        _write_new_core_table(str(tmp_path / name / 'data' / 'new_core_corrected_massql.tsv'))
+
+    monkeypatch.chdir(tmp_path / 'baseline')
+    baseline_new_core_get_label()
+    monkeypatch.chdir(tmp_path / 'new')
+    new_core_db_label.get_label(chunksize=chunksize)
+
+    assert _read_text('data/label/new_core_df.tsv') == _read_text('../baseline/data/label/new_core_df.tsv')
+
+
+def test_new_core_append(tmp_path):
+    first_tsv = str(tmp_path / 'first.tsv')
+    second_tsv = str(tmp_path / 'second.tsv')
+    out_tsv = str(tmp_path / 'new_core_df.tsv')
+    _write_new_core_table(first_tsv, seed=0)
+    # a new export: the first rows again, then new ones
+    _write_new_core_table(second_tsv, seed=1)
+    second_df = pd.concat([pd.read_csv(first_tsv, sep='\t').iloc[:50], pd.read_csv(second_tsv, sep='\t')])
+    second_df['SCANS'] = np.arange(len(second_df))
+    second_df.to_csv(second_tsv, sep='\t', index=False)
+
+    new_core_db_label.get_label(first_tsv, out_tsv)
+    first_text = _read_text(out_tsv)
+
+    # appending the same export again adds nothing
+    new_core_db_label.get_label(first_tsv, out_tsv, append=True)
+    assert _read_text(out_tsv) == first_text
+
+    # rows of the new export that were labeled before are skipped
+    new_core_db_label.get_label(second_tsv, out_tsv, chunksize=64, append=True)
+    expected = pd.concat([new_core_db_label.label_batch(pd.read_csv(x, sep='\t')) for x in [first_tsv, second_tsv]])
+    expected = expected[~expected.astype(str).duplicated()]
+    assert pd.read_csv(out_tsv, sep='\t').astype(str).values.tolist() == expected.astype(str).values.tolist()
+
+    # other columns cannot be appended
+    pd.read_csv(first_tsv, sep='\t').drop(columns='3a-OH').to_csv(first_tsv, sep='\t', index=False)
+    with pytest.raises(ValueError):
+        new_core_db_label.get_label(first_tsv, out_tsv, append=True)
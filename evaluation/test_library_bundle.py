@@ -0,0 +1,67 @@
+"""
+Library bundle against the library TSV and the mgf peaks. Run from evaluation/: python -m pytest -q
+"""
+import numpy as np
+import pandas as pd
+
+from mgf_reader import write_library_tsv
+from library_bundle import mgf_to_bundle, open_bundle
+from query_engine import load_spectra
+
+
+# the keys and value types change from batch to batch
+MGF_TEXT = '''BEGIN IONS
+PEPMASS=400.0
+SCANS=1
+FOO=007
+100.0 5.0
+END IONS
+
+BEGIN IONS
+PEPMASS=410.0
+SCANS=2
+END IONS
+
+BEGIN IONS
+PEPMASS=420.5
+SCANS=3
+RT=1.50
+FOO=abc
+200.0 10.0
+210.0 20.0
+END IONS
+
+BEGIN IONS
+SCANS=4
+RT=nan
+NAME=x
+300.0 1.0
+END IONS
+'''
+
+
+def test_metadata_matches_tsv(tmp_path):
+    input_mgf = str(tmp_path / 'library.mgf')
+    with open(input_mgf, 'w') as file:
+        file.write(MGF_TEXT)
+
+    write_library_tsv(input_mgf, str(tmp_path / 'library.tsv'), batch_size=1)
+    bundle = open_bundle(mgf_to_bundle(input_mgf, batch_size=1))
+
+    tsv_df = pd.read_csv(tmp_path / 'library.tsv', sep='\t', dtype=str, keep_default_na=False)
+    assert bundle['metadata'].fillna('').equals(tsv_df)
+    # no values retyped
+    metadata = bundle['metadata'].fillna('')
+    assert metadata['FOO'].tolist() == ['007', 'abc', '']
+    assert metadata['RT'].tolist() == ['', '1.50', 'nan']
+
+
+def test_peaks_match_mgf(tmp_path):
+    input_mgf = str(tmp_path / 'library.mgf')
+    with open(input_mgf, 'w') as file:
+        file.write(MGF_TEXT)
+
+    mgf_spectra = load_spectra(input_mgf)
+    bundle_spectra = load_spectra(mgf_to_bundle(input_mgf, batch_size=2))
+    for name in ['scans', 'precmz', 'offsets', 'mz', 'intensity']:
+        assert np.array_equal(getattr(bundle_spectra, name), getattr(mgf_spectra, name)), name
@@ -0,0 +1,156 @@
+"""
+Streaming mgf reader against the line-by-line scripts it replaced (correct_scans, correct_spec,
+generate_library_df). Run from evaluation/: python -m pytest -q
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from mgf_reader import iter_mgf_blocks, correct_mgf, write_library_tsv, _parse_peak_lines
+from bile19_msql import BILE19_RULES
+from new_core_db_msql import NEW_CORE_RULES
+
+
+MGF_LINES = [
+    'BEGIN IONS', 'PEPMASS=400.0', 'CHARGE=2+', '  SCANS=7', 'TITLE=a BEGIN IONS b', '100.0 5.0', 'END IONS', '',
+    'BEGIN IONS', 'SCANS=3  ', ' CHARGE=1-', 'NAME=END IONS', 'abc 1.0', '200.0 10.0', '210.0 x', 'END IONS', '',
+    'BEGIN IONS', 'SCANS=9', 'CHARGE=1', 'END IONS', '',
+    'BEGIN IONS', 'SCANS=4', 'FOO=007', 'RT=1.50', '300.0 1.0', 'END IONS', '',
+]
+
+
+def baseline_correct_scans(input_mgf, out_name):
+    """
+    correct_scans of bile19_msql before the streaming reader
+    """
+    scan_cnt = 0
+    new_lines = []
+    with open(input_mgf, 'r') as file:
+        for line in file:
+            _line = line.strip()
+            if not _line:
+                new_lines.append(line)
+                continue
+            elif line.startswith('SCANS'):
+                new_lines.append(f'SCANS={scan_cnt}\n')
+                scan_cnt += 1
+            else:
+                new_lines.append(line)
+
+    with open(out_name, 'w') as file:
+        for line in new_lines:
+            file.write(line)
+
+
+def baseline_correct_spec(input_mgf, out_name):
+    """
+    correct_spec of new_core_db_msql before the streaming reader
+    """
+    new_lines = []
+    scan_cnt = 0
+    with open(input_mgf, 'r') as file:
+        for line in file:
+            _line = line.strip()
+            if not _line:
+                new_lines.append(line)
+                continue
+            elif '=' in line:
+                key, value = _line.split('=', 1)
+                if key == 'SCANS':
+                    new_lines.append(f'SCANS={scan_cnt}\n')
+                    scan_cnt += 1
+                elif key == 'CHARGE':
+                    new_lines.append('CHARGE=1\n')
+                else:
+                    new_lines.append(line)
+            else:
+                new_lines.append(line)
+
+    with open(out_name, 'w') as file:
+        for line in new_lines:
+            file.write(line)
+
+
+def baseline_generate_library_df(library_mgf, out_name):
+    """
+    generate_library_df of bile19_msql before the streaming reader
+    """
+    with open(library_mgf, 'r') as file:
+        spectrum_list = []
+        for line in file:
+            _line = line.strip()
+            if not _line:
+                continue
+            elif line.startswith('BEGIN IONS'):
+                spectrum = {}
+                mz_list = []
+                intensity_list = []
+            elif line.startswith('END IONS'):
+                if len(mz_list) == 0:
+                    continue
+                spectrum['mz_ls'] = mz_list
+                spectrum['intensity_ls'] = intensity_list
+                spectrum_list.append(spectrum)
+                continue
+            else:
+                if '=' in _line:
+                    key, value = _line.split('=', 1)
+                    spectrum[key] = value
+                else:
+                    this_mz, this_int = _line.split()
+                    try:
+                        mz_list.append(float(this_mz))
+                        intensity_list.append(float(this_int))
+                    except:
+                        continue
+
+    df = pd.DataFrame(spectrum_list)
+    df.drop(columns=['mz_ls', 'intensity_ls'], inplace=True)
+    df.to_csv(out_name, sep='\t', index=False)
+
+
+def _write_mgf(path, newline):
+    with open(path, 'wb') as file:
+        file.write(''.join(x + newline for x in MGF_LINES).encode())
+    return str(path)
+
+
+@pytest.mark.parametrize('newline', ['\n', '\r\n', '\r'])
+@pytest.mark.parametrize('rules, baseline', [(BILE19_RULES, baseline_correct_scans),
+                                             (NEW_CORE_RULES, baseline_correct_spec)])
+def test_correct_mgf(tmp_path, newline, rules, baseline):
+    input_mgf = _write_mgf(tmp_path / 'library.mgf', newline)
+    baseline(input_mgf, tmp_path / 'baseline.mgf')
+    correct_mgf(input_mgf, str(tmp_path / 'corrected.mgf'), rules)
+
+    assert (tmp_path / 'corrected.mgf').read_bytes() == (tmp_path / 'baseline.mgf').read_bytes()
+
+
+@pytest.mark.parametrize('newline', ['\n', '\r\n', '\r'])
+def test_blocks_hold_whole_spectra(tmp_path, newline):
+    input_mgf = _write_mgf(tmp_path / 'library.mgf', newline)
+    blocks = list(iter_mgf_blocks(input_mgf, block_bytes=7))
+
+    assert ''.join(blocks) == ''.join(x + '\n' for x in MGF_LINES)
+    # the blank line after the last spectrum comes last on its own
+    assert all(x.rstrip('\n').endswith('END IONS') for x in blocks[:-1]) and not blocks[-1].strip()
+
+
+@pytest.mark.parametrize('newline', ['\n', '\r\n'])
+def test_write_library_tsv(tmp_path, newline):
+    input_mgf = _write_mgf(tmp_path / 'library.mgf', newline)
+    baseline_generate_library_df(input_mgf, tmp_path / 'baseline.tsv')
+    write_library_tsv(input_mgf, str(tmp_path / 'library.tsv'), batch_size=2)
+
+    assert (tmp_path / 'library.tsv').read_text() == (tmp_path / 'baseline.tsv').read_text()
+
+
+def test_parse_peak_lines():
+    # lines that are not an m/z and an intensity are dropped, extra columns ignored
+    mz, intensity, counts, has_mz = _parse_peak_lines(['100.0', '200.0 5.0 7.0'], np.array([2]))
+    assert mz.tolist() == [200.0] and intensity.tolist() == [5.0]
+    assert counts.tolist() == [1] and has_mz.tolist() == [True]
+
+    mz, intensity, counts, has_mz = _parse_peak_lines(['100.0 1.0', '200.0 2.0', '300.0 3.0'], np.array([1, 2]))
+    assert mz.tolist() == [100.0, 200.0, 300.0] and intensity.tolist() == [1.0, 2.0, 3.0]
+    assert counts.tolist() == [1, 2] and has_mz.tolist() == [True, True]
@@ -0,0 +1,174 @@
+"""
+Native query engine against massql, and the shared probe plan and every other way of running the queries
+against the serial native run, on a tiny seeded synthetic library. Run from evaluation/: python -m pytest -q
+"""
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+from massql import msql_engine
+
+from new_core_db_msql import NEW_QUERIES
+from library_bundle import mgf_to_bundle, preprocess_bundle
+from query_engine import load_spectra, compile_query, compile_plan, run_plan, run_plan_parallel, \
+    run_plan_out_of_core, compile_gated_plan, run_gated_plan, run_gated_plan_parallel
+from incremental import update_hits
+from query_cache import library_hash, get_cached, put_cached
+from msql_common import get_passed_scans, get_filter_gates
+
+
+# about 10 chunks of the tiny library
+CHUNK_MB = 0.01
+
+
+@pytest.fixture(scope='module')
+def library(library_mgf):
+    """
+    Synthetic library with its serial native hits
+    """
+    compiled_queries = {k: compile_query(v) for k, v in NEW_QUERIES.items()}
+    spectra = load_spectra(library_mgf)
+    hits = run_plan(spectra, compile_plan(compiled_queries))
+
+    return {'mgf': library_mgf, 'queries': compiled_queries, 'scans': spectra.scans, 'hits': hits}
+
+
+def _bundle_copy(library, name):
+    bundle_dir = os.path.join(os.path.dirname(library['mgf']), f'{name}.bundle')
+    shutil.rmtree(bundle_dir, ignore_errors=True)
+    return mgf_to_bundle(library['mgf'], bundle_dir)
+
+
+def _assert_same_hits(library, scans, hits):
+    assert list(scans) == list(library['scans'])
+    assert np.array_equal(hits, library['hits'])
+
+
+def _gated_hits(library, gates):
+    """
+    Serial hits with the gated queries masked by their gates
+    """
+    names = list(library['queries'])
+    hits = library['hits'].copy()
+    for query_name, query_gates in gates.items():
+        if query_gates:
+            hits[:, names.index(query_name)] &= hits[:, [names.index(x) for x in query_gates]].max(axis=1)
+    return hits
+
+
+def test_library_hits_every_query(library):
+    assert library['hits'].any(axis=0).all()
+
+
+def test_native_matches_massql(library):
+    for i, (query_name, input_query) in enumerate(NEW_QUERIES.items()):
+        results_df = msql_engine.process_query(input_query, library['mgf'])
+        massql_scans = set(str(x) for x in results_df['scan'].values) if len(results_df) else set()
+        assert set(library['scans'][library['hits'][:, i] == 1]) == massql_scans, query_name
+
+
+def test_shared_plan(library):
+    # the probes are shared between the queries, each query hits as if planned on its own
+    plan = compile_plan(library['queries'])
+    assert len(plan['probes']) < sum(len(v) for v in library['queries'].values())
+    spectra = load_spectra(library['mgf'])
+    for i, (query_name, conditions) in enumerate(library['queries'].items()):
+        hits = run_plan(spectra, compile_plan({query_name: conditions}))
+        assert np.array_equal(hits[:, 0], library['hits'][:, i]), query_name
+
+
+def test_bundle(library):
+    spectra = load_spectra(_bundle_copy(library, 'bundle'))
+    _assert_same_hits(library, spectra.scans, run_plan(spectra, compile_plan(library['queries'])))
+
+
+def test_preprocessed_bundle(library):
+    bundle_dir = _bundle_copy(library, 'preprocessed')
+    preprocess_bundle(bundle_dir)
+    spectra = load_spectra(bundle_dir)
+    _assert_same_hits(library, spectra.scans, run_plan(spectra, compile_plan(library['queries'])))
+
+
+@pytest.mark.parametrize('source', ['mgf', 'bundle'])
+def test_parallel(library, source):
+    path = library['mgf'] if source == 'mgf' else _bundle_copy(library, 'parallel')
+    scans, hits = run_plan_parallel(path, compile_plan(library['queries']), n_workers=2, chunk_mb=CHUNK_MB)
+    _assert_same_hits(library, scans, hits)
+
+
+@pytest.mark.parametrize('source', ['mgf', 'bundle'])
+def test_out_of_core(library, source):
+    path = library['mgf'] if source == 'mgf' else _bundle_copy(library, 'out_of_core')
+    scans, precmz, hits = run_plan_out_of_core(path, compile_plan(library['queries']), chunk_mb=CHUNK_MB)
+    _assert_same_hits(library, scans, hits)
+    assert len(precmz) == len(scans)
+
+
+def test_gated(library):
+    gates = get_filter_gates(library['queries'])
+    plan = compile_gated_plan(library['queries'], gates)
+    expected = _gated_hits(library, gates)
+
+    assert np.array_equal(run_gated_plan(load_spectra(library['mgf']), plan), expected)
+    scans, hits = run_gated_plan_parallel(library['mgf'], plan, n_workers=2, chunk_mb=CHUNK_MB)
+    assert list(scans) == list(library['scans'])
+    assert np.array_equal(hits, expected)
+
+
+@pytest.mark.parametrize('n_workers', [1, 2])
+def test_passed_scans(library, n_workers):
+    expected = {x: library['scans'][library['hits'][:, i] == 1].tolist() for i, x in enumerate(NEW_QUERIES)}
+    assert get_passed_scans(library['mgf'], NEW_QUERIES, n_workers=n_workers) == expected
+
+
+def test_cache(library, tmp_path):
+    expected = {x: library['scans'][library['hits'][:, i] == 1].tolist() for i, x in enumerate(NEW_QUERIES)}
+    cache_dir = str(tmp_path / 'cache')
+    # the first run fills the cache, the second reads it
+    for _ in range(2):
+        assert get_passed_scans(library['mgf'], NEW_QUERIES, cache_dir=cache_dir) == expected
+
+
+def test_cache_keys(library, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    library_key = library_hash(library['mgf'], cache_dir)
+    input_query = NEW_QUERIES['Monohydroxy']
+
+    # the same query and library run by another engine (or version) is another entry
+    put_cached(cache_dir, library_key, 'native 1', input_query, ['1', '2'])
+    assert get_cached(cache_dir, library_key, 'native 1', ' '.join(input_query.split())) == ['1', '2']
+    assert get_cached(cache_dir, library_key, 'native 2', input_query) is None
+    assert get_cached(cache_dir, library_key, 'massql 1', input_query) is None
+
+    # a broken hash index is rebuilt
+    with open(os.path.join(cache_dir, 'library_hashes.json'), 'w') as file:
+        file.write('{"truncated')
+    assert library_hash(library['mgf'], cache_dir) == library_key
+    assert library_hash(library['mgf'], cache_dir) == library_key
+    assert not [x for x in os.listdir(cache_dir) if x.endswith('.tmp')]
+
+
+def test_incremental(library, tmp_path):
+    # first run on the first half of the library, then only the new spectra are evaluated
+    with open(library['mgf']) as file:
+        blocks = file.read().split('BEGIN IONS')
+    first_half = str(tmp_path / 'first_half.mgf')
+    with open(first_half, 'w') as file:
+        file.write('BEGIN IONS'.join(blocks[:len(blocks) // 2]))
+
+    state_dir = str(tmp_path / 'state')
+    scans, hits = update_hits(first_half, library['queries'], state_dir)
+    assert np.array_equal(hits, library['hits'][:len(scans)])
+
+    _assert_same_hits(library, *update_hits(library['mgf'], library['queries'], state_dir))
+    # the whole state is one file
+    assert os.listdir(state_dir) == ['hits.npz']
+
+    # an edited query is run again, the others are taken from the state
+    queries = dict(library['queries'])
+    edited_query = NEW_QUERIES['Monohydroxy'].replace('INTENSITYPERCENT=2 ', 'INTENSITYPERCENT=30 ', 1)
+    queries['Monohydroxy'] = compile_query(edited_query)
+    scans, hits = update_hits(library['mgf'], queries, state_dir)
+    assert np.array_equal(hits, run_plan(load_spectra(library['mgf']), compile_plan(queries)))
@@ -0,0 +1,125 @@
+"""
+Sharded filter against querying every file on its own, and its checkpoint resume, on the synthetic library
+spread over a collection. Run from evaluation/: python -m pytest -q
+"""
+import os
+import json
+
+import pandas as pd
+import pytest
+
+from bile19_msql import NEW_QUERIES
+from library_bundle import mgf_to_bundle
+from msql_common import MERGED_QUERIES
+from query_engine import load_spectra, compile_query, compile_plan, run_plan
+from sharded_filter import sharded_filter, load_checkpoint
+
+
+# dataset directory -> files, c.bundle is a library bundle
+FILES = {'ds1': ['a.mgf', 'b.mgf'], 'ds2': ['c.bundle', 'd.mgf']}
+
+
+def _write_collection(root, library_mgf):
+    """
+    The spectra of the library spread over the files of FILES
+    """
+    with open(library_mgf) as file:
+        blocks = file.read().split('BEGIN IONS')[1:]
+
+    paths = [os.path.join(root, dataset, x) for dataset, names in FILES.items() for x in names]
+    for k, path in enumerate(paths):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        mgf_path = path.replace('.bundle', '.mgf')
+        with open(mgf_path, 'w') as file:
+            file.write(''.join('BEGIN IONS' + x for x in blocks[k::len(paths)]))
+        if path.endswith('.bundle'):
+            mgf_to_bundle(mgf_path, path)
+            os.remove(mgf_path)
+    return paths
+
+
+def _expected_hits(root, paths):
+    """
+    Hit table of every file queried on its own, merged queries as in massql_filter
+    """
+    compiled_queries = {k: compile_query(v) for k, v in NEW_QUERIES.items()}
+    names = list(compiled_queries)
+    merged_names = {x for v in MERGED_QUERIES.values() for x in v}
+
+    df_ls = []
+    for path in paths:
+        spectra = load_spectra(path)
+        hits = run_plan(spectra, compile_plan(compiled_queries))
+        df = pd.DataFrame({'file': os.path.relpath(path, root), 'scan': spectra.scans})
+        for i, x in enumerate(names):
+            if x not in merged_names:
+                df[x] = hits[:, i]
+        for k, v in MERGED_QUERIES.items():
+            df[k] = hits[:, [names.index(x) for x in v]].max(axis=1)
+        df_ls.append(df[df.drop(columns=['file', 'scan']).any(axis=1)])
+    return pd.concat(df_ls, ignore_index=True)
+
+
+def _read_hits(out_dir):
+    df = pd.read_parquet(os.path.join(out_dir, 'hits'))
+    df['dataset'] = df['dataset'].astype(str)
+    return df.sort_values(['file', 'scan'], key=lambda x: x.map(int) if x.name == 'scan' else x,
+                          ignore_index=True)
+
+
+def _checkpoint_lines(out_dir):
+    with open(os.path.join(out_dir, 'checkpoint.jsonl')) as file:
+        return file.read().splitlines()
+
+
+@pytest.fixture
+def collection(tmp_path, library_mgf):
+    root = str(tmp_path / 'repository')
+    return root, _write_collection(root, library_mgf)
+
+
+def test_sharded_filter(collection, tmp_path):
+    root, paths = collection
+    out_dir = str(tmp_path / 'hits')
+    assert sharded_filter(root, NEW_QUERIES, out_dir, n_workers=2, chunk_mb=0.01) == []
+
+    df = _read_hits(out_dir)
+    expected = _expected_hits(root, paths)
+    assert df['dataset'].tolist() == [x.split(os.sep)[0] for x in expected['file']]
+    for x in expected.columns:
+        assert df[x].astype(str).tolist() == expected[x].astype(str).tolist(), x
+    assert set(os.listdir(os.path.join(out_dir, 'hits'))) == {f'dataset={x}' for x in FILES}
+
+
+def test_resume(collection, tmp_path):
+    root, paths = collection
+    out_dir = str(tmp_path / 'hits')
+    sharded_filter(root, NEW_QUERIES, out_dir, n_workers=2)
+    expected = _read_hits(out_dir)
+
+    # nothing to run again
+    lines = _checkpoint_lines(out_dir)
+    sharded_filter(root, NEW_QUERIES, out_dir, n_workers=2)
+    assert _checkpoint_lines(out_dir) == lines
+    assert _read_hits(out_dir).equals(expected)
+
+    # an interrupted job: the last record half written, its shard is run again
+    with open(os.path.join(out_dir, 'checkpoint.jsonl'), 'w') as file:
+        file.write('\n'.join(lines[:-1]) + '\n' + lines[-1][:20])
+    sharded_filter(root, NEW_QUERIES, out_dir, n_workers=2)
+    rerun = [json.loads(x)['file'] for x in _checkpoint_lines(out_dir)[len(lines):]]
+    assert rerun == [json.loads(lines[-1])['file']]
+    assert _read_hits(out_dir).equals(expected)
+
+    # a changed file and other queries
+    with open(paths[0], 'a') as file:
+        file.write('\n')
+    sharded_filter(root, NEW_QUERIES, out_dir, n_workers=2)
+    assert json.loads(_checkpoint_lines(out_dir)[-1])['file'] == os.path.relpath(paths[0], root)
+
+    queries = {k: v for k, v in NEW_QUERIES.items() if k != '3a-OH'}
+    sharded_filter(root, queries, out_dir, n_workers=2)
+    assert len(load_checkpoint(out_dir)) == len(paths)
+    assert _read_hits(out_dir).equals(expected.drop(columns='3a-OH')[(
+        expected.drop(columns=['dataset', 'file', 'scan', 'precursor_mz', '3a-OH']) == 1).any(axis=1)]
+        .reset_index(drop=True))
@@ -0,0 +1,66 @@
+"""
+Threshold sweep against running the edited queries at every grid point, on the synthetic library.
+Run from evaluation/: python -m pytest -q
+"""
+import numpy as np
+import pytest
+
+import query_engine
+from bile19_msql import NEW_QUERIES
+from main_evaluation import group_containers
+from query_engine import load_spectra, compile_query, compile_plan, run_plan, sweep_queries
+
+
+PPM_GRID = [5, 20]
+RATIO_GRID = [0.8, 1.0, 1.3]
+PERCENT_GRID = [10, 40]
+
+
+@pytest.fixture(scope='module')
+def spectra(library_mgf):
+    return load_spectra(library_mgf)
+
+
+def _edited(conditions, ppm, ratio, percent):
+    """
+    The query as if its text had been edited to the grid point
+    """
+    edited = []
+    for c in conditions:
+        c = dict(c)
+        if c['tol_ppm'] is not None:
+            c['tol_ppm'] = ppm
+        if c['match_var'] is not None:
+            c['match_factor'] = c['match_factor'] * ratio
+            c['match_tol_percent'] = percent
+        edited.append(c)
+    return edited
+
+
+def test_sweep_matches_edited_queries(spectra):
+    compiled_queries = {x: compile_query(NEW_QUERIES[x]) for x in group_containers['di']}
+    grid, hits = sweep_queries(spectra, compiled_queries, PPM_GRID, RATIO_GRID, PERCENT_GRID)
+    assert len(grid) == len(PPM_GRID) * len(RATIO_GRID) * len(PERCENT_GRID)
+
+    for k, (ppm, ratio, percent) in enumerate(grid.itertuples(index=False)):
+        edited = {x: _edited(v, ppm, ratio, percent) for x, v in compiled_queries.items()}
+        expected = run_plan(spectra, compile_plan(edited))
+        for i, query_name in enumerate(edited):
+            assert np.array_equal(hits[query_name][:, k], expected[:, i]), (query_name, ppm, ratio, percent)
+    # the thresholds change some hits
+    assert any((x != x[:, [0]]).any() for x in hits.values())
+
+
+def test_probes_searched_once_per_ppm(spectra, monkeypatch):
+    calls = []
+    run_probes = query_engine.run_probes
+    monkeypatch.setattr(query_engine, 'run_probes', lambda *args: calls.append(1) or run_probes(*args))
+
+    compiled_queries = {x: compile_query(NEW_QUERIES[x]) for x in group_containers['mono']}
+    sweep_queries(spectra, compiled_queries, PPM_GRID, RATIO_GRID, PERCENT_GRID)
+    assert len(calls) == len(PPM_GRID)
+
+
+def test_variable_queries_rejected(spectra):
+    with pytest.raises(ValueError):
+        sweep_queries(spectra, {'x': compile_query('QUERY scaninfo(MS2DATA) WHERE MS2PREC=X AND MS2PROD=X-18.0106')})
@@ -0,0 +1,127 @@
+"""
+Threshold sweep for the isomer queries: FDR / FNR over grids of TOLERANCEPPM, INTENSITYMATCH ratio and
+INTENSITYMATCHPERCENT, evaluated like main_evaluation but without editing NEW_QUERIES and rerunning
+massql_filter for every setting.
+"""
+import numpy as np
+import pandas as pd
+
+from library_bundle import is_bundle
+from query_engine import load_spectra, compile_query, sweep_queries
+from evaluation_core import encode_binary, confusion_counts
+from main_evaluation import group_containers, load_label_tables, get_adduct_masks, get_eval_matrices
+from bile19_msql import NEW_QUERIES
+
+
+library_mgfs = ['data/BILELIB19_corrected.mgf', 'data/new_core_corrected.mgf']
+
+
+def load_library_spectra(library_mgfs):
+    """
+    Peaks of the libraries behind the label tables (bundle if converted)
+    """
+    spectra_ls = []
+    for input_mgf in library_mgfs:
+        bundle_dir = input_mgf.replace('.mgf', '.bundle')
+        spectra_ls.append(load_spectra(bundle_dir if is_bundle(bundle_dir) else input_mgf))
+    return spectra_ls
+
+
+def get_row_spectra(spectra, scans):
+    """
+    Spectrum index of each label table row by SCANS, -1 if the scan is not in the library
+    """
+    spectra_scans = pd.Index(spectra.scans)
+    first = ~spectra_scans.duplicated(keep='first')
+    row_spectra = spectra_scans[first].get_indexer(pd.Series(scans).astype(str).values)
+    return np.where(row_spectra >= 0, np.flatnonzero(first)[row_spectra], -1)
+
+
+def sweep_group(group='di', ppm_grid=None, ratio_grid=(1.0,), percent_grid=None, adduct_filter=False,
+                label_tables=None, spectra_ls=None, queries=NEW_QUERIES):
+    """
+    FDR / FNR of every query in the group container at every grid point, as an ROC-style table.
+    Parent queries and the class gate are taken from the label tables as in main_evaluation.
+    """
+    group_container = group_containers[group]
+
+    if label_tables is None:
+        label_tables = load_label_tables()
+    if spectra_ls is None:
+        spectra_ls = load_library_spectra(library_mgfs)
+    masks = get_adduct_masks(*label_tables, adduct_filter)
+
+    # ground truth of the container queries come after the class query (and 1-OH-core for di)
+    n_before = 2 if group == 'di' else 1
+    gt_ls = [get_eval_matrices(df, group, group_container, substring, mask)[0][:, n_before:]
+             for df, substring, mask in zip(label_tables, [False, True], masks)]
+    row_spectra_ls = [get_row_spectra(spectra, df['SCANS']) for spectra, df in zip(spectra_ls, label_tables)]
+
+    compiled_queries = {}
+    for _group in group_container:
+        try:
+            conditions = compile_query(queries[_group])
+        except (KeyError, ValueError) as e:
+            print(f'{_group}: cannot be swept, {e}')
+            continue
+        if any(c['x_offset'] is not None for c in conditions):
+            print(f'{_group}: cannot be swept, it has variables')
+            continue
+        compiled_queries[_group] = conditions
+
+    # one plan over all the container queries, the probes are searched once per library and ppm value
+    sweeps = [sweep_queries(spectra, compiled_queries, ppm_grid, ratio_grid, percent_grid) for spectra in spectra_ls]
+
+    out_ls = []
+    for j, (_group, (massql_groups, _)) in enumerate(group_container.items()):
+        if _group not in compiled_queries:
+            continue
+
+        gt_all = []
+        pred_all = []
+        for df, row_spectra, gt, (grid, group_hits) in zip(label_tables, row_spectra_ls, gt_ls, sweeps):
+            hits = group_hits[_group]
+            # rows without a spectrum never hit
+            prediction = np.vstack([hits, np.zeros((1, hits.shape[1]), dtype=np.uint8)])[row_spectra]
+            for msql_group in massql_groups:
+                if msql_group != _group:
+                    prediction = prediction & df[msql_group].values[:, None]
+            gt_all.append(np.repeat(gt[:, [j]], len(grid), axis=1))
+            pred_all.append(encode_binary(prediction))
+
+        dataset = np.repeat([0, 1], [len(x) for x in gt_all])
+        counts = confusion_counts(np.vstack(gt_all), np.vstack(pred_all), dataset=dataset, n_datasets=2)
+
+        total = counts.sum(axis=0)
+        out_df = grid.copy()
+        out_df.insert(0, 'group', _group)
+        for i, prefix in enumerate(['bile19', 'new_core', 'total']):
+            this_counts = total if prefix == 'total' else counts[i]
+            for k, name in enumerate(['TP', 'FP', 'TN', 'FN']):
+                out_df[f'{prefix}_{name}'] = this_counts[:, k]
+        out_df['total_FDR'] = out_df['total_FP'] / (out_df['total_FP'] + out_df['total_TP'])
+        out_df['total_FNR'] = out_df['total_FN'] / (out_df['total_FN'] + out_df['total_TP'])
+        # ROC
+        out_df['total_TPR'] = out_df['total_TP'] / (out_df['total_TP'] + out_df['total_FN'])
+        out_df['total_FPR'] = out_df['total_FP'] / (out_df['total_FP'] + out_df['total_TN'])
+        out_ls.append(out_df)
+
+    out_df = pd.concat(out_ls, ignore_index=True)
+
+    if adduct_filter:
+        out_name = f'data/result/{group}_sweep_H_adducts.tsv'
+    else:
+        out_name = f'data/result/{group}_sweep_all_adducts.tsv'
+
+    out_df.to_csv(out_name, sep='\t', index=False)
+
+    return out_df
+
+
+if __name__ == '__main__':
+    label_tables = load_label_tables()
+    spectra_ls = load_library_spectra(library_mgfs)
+
+    for group in ['mono', 'di', 'tri']:
+        sweep_group(group, ppm_grid=[5, 10, 20, 30], ratio_grid=np.round(np.arange(0.5, 1.55, 0.1), 2),
+                    percent_grid=[10, 20, 30, 40, 60, 80], label_tables=label_tables, spectra_ls=spectra_ls)
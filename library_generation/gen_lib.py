@@ -3,36 +3,48 @@ Prepare library mgf and tsv files that are ready to be uploaded to GNPS.
 """
 import pandas as pd
 import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from tqdm import tqdm
 import numpy as np
-from requests import get
-from json import loads
 from matchms.importing import load_from_mgf
 
+from library_artifact import save_library_artifact, load_library_artifact
+# the USI loaders live in usi_loader.py, load_from_usi is still importable from here
+from usi_loader import load_from_usi, load_from_usis
 
-def load_csv(dir_path):
+
+def _read_libhit_csv(path, dtype=None):
+    this_df = pd.read_csv(path, dtype=dtype)
+
+    if '_mono_' in path:
+        prefix = 'mono_'
+    elif '_di_' in path:
+        prefix = 'di_'
+    else:
+        prefix = 'tri_'
+    this_df['id'] = prefix + this_df['original_Scan'].astype(str)
+
+    return this_df
+
+
+def load_csv(dir_path, dtype=None, n_workers=8):
     """
-    Libhit files
+    Libhit files, read in parallel and concatenated once.
+    dtype: explicit column types passed to read_csv (inferred if None)
     """
 
     dfs = os.listdir(dir_path)
     dfs = [x for x in dfs if x.endswith('.csv') and not x.startswith('.')]
     dfs = [os.path.join(dir_path, x) for x in dfs]
 
-    all_df = pd.DataFrame()
-    for df in dfs:
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        df_ls = list(executor.map(lambda x: _read_libhit_csv(x, dtype=dtype), dfs))
+
+    for df, this_df in zip(dfs, df_ls):
         print(f'Loading {df}')
-        this_df = pd.read_csv(df)
         print('rows:', this_df.shape[0])
 
-        if '_mono_' in df:
-            this_df['id'] = 'mono_' + this_df['original_Scan'].astype(str)
-        elif '_di_' in df:
-            this_df['id'] = 'di_' + this_df['original_Scan'].astype(str)
-        else:
-            this_df['id'] = 'tri_' + this_df['original_Scan'].astype(str)
-
-        all_df = pd.concat([all_df, this_df])
+    all_df = pd.concat(df_ls) if df_ls else pd.DataFrame()
 
     # remove rows whose id is duplicated
     all_df = all_df[~all_df.duplicated(subset='id')]
@@ -42,16 +54,14 @@ def load_csv(dir_path):
 
 def load_db_df():
 
-    mono = pd.read_csv('data/mono_nowaterloss_scan_index.tsv', sep='\t')
-    mono['id'] = 'mono_' + mono['stage2_merged_scan'].astype(str)
-
-    di = pd.read_csv('data/di_nowaterloss_scan_index.tsv', sep='\t')
-    di['id'] = 'di_' + di['stage2_merged_scan'].astype(str)
+    paths = {x: f'data/{x}_nowaterloss_scan_index.tsv' for x in ['mono', 'di', 'tri']}
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        db_dfs = dict(zip(paths, executor.map(lambda x: pd.read_csv(x, sep='\t'), paths.values())))
 
-    tri = pd.read_csv('data/tri_nowaterloss_scan_index.tsv', sep='\t')
-    tri['id'] = 'tri_' + tri['stage2_merged_scan'].astype(str)
+    for prefix, db_df in db_dfs.items():
+        db_df['id'] = f'{prefix}_' + db_df['stage2_merged_scan'].astype(str)
 
-    db_df = pd.concat([mono, di, tri])
+    db_df = pd.concat(db_dfs.values())
 
     return db_df
 
@@ -66,9 +76,10 @@ def merge_df():
 
     merged_df = pd.merge(libhit_df, db_df, on='id', how='left')
 
-    merged_df['isomer_label'] = merged_df['isomer_label'].apply(lambda x: x.replace('OH2', '(OH)2').replace('OH3', '(OH)3'))
-    merged_df['Compound_Name'] = merged_df['Compound_Name'].apply(lambda x: x.replace('""', ''))
-    merged_df['new_name'] = merged_df.apply(lambda x: f'[BA_core: {x["isomer_label"]}] {x["Compound_Name"]}', axis=1)
+    merged_df['isomer_label'] = merged_df['isomer_label'].str.replace('OH2', '(OH)2', regex=False).str.replace(
+        'OH3', '(OH)3', regex=False)
+    merged_df['Compound_Name'] = merged_df['Compound_Name'].str.replace('""', '', regex=False)
+    merged_df['new_name'] = '[BA_core: ' + merged_df['isomer_label'] + '] ' + merged_df['Compound_Name']
 
     # save
     merged_df.to_csv('out/merged_db_all_metadata.tsv', sep='\t', index=False)
@@ -76,113 +87,172 @@ def merge_df():
     return
 
 
-def add_ms2():
+def _scan_row_index(df, prefix):
+    """
+    scan -> first row of the rows from one merged mgf (id prefix)
+    """
+    rows = df[df['id'].str.startswith(f'{prefix}_') & df['stage2_merged_scan'].notna()]
+    rows = rows[~rows['stage2_merged_scan'].duplicated(keep='first')]
+    return dict(zip(rows['stage2_merged_scan'], rows.index))
+
+
+def add_ms2(dtype=np.float64, compress=False, legacy_outputs=True):
+    """
+    Attach the merged MS2 spectra to the library rows and save the compact library artifact
+    (out/merged_db_all_metadata_with_ms2, see library_artifact.py).
+    dtype: peak buffer type, np.float32 halves the artifact but rounds the m/z and intensities written to the
+    GNPS files to about 7 significant digits
+    legacy_outputs: also write the TSV and pickle with peak array cells, which downstream scripts read
+    (False to only save the artifact)
+    """
     df = pd.read_csv('out/merged_db_all_metadata.tsv', sep='\t')
-    df['peaks'] = None
-
-    # For mono spectra
-    spectra_from_path = list(load_from_mgf('data/mono_nowaterloss_stage2_result_merged.mgf'))
-    for spec in tqdm(spectra_from_path):
-        mask = (df['id'].str.startswith('mono_')) & (df['stage2_merged_scan'] == int(spec.metadata['scans']))
-        if mask.any():
-            first_match_idx = df.index[mask][0]
-            peaks = np.column_stack((spec.peaks.mz, spec.peaks.intensities))
-            df.at[first_match_idx, 'peaks'] = peaks
-
-    # For di spectra
-    spectra_from_path = list(load_from_mgf('data/di_nowaterloss_stage2_result_merged.mgf'))
-    for spec in tqdm(spectra_from_path):
-        mask = (df['id'].str.startswith('di_')) & (df['stage2_merged_scan'] == int(spec.metadata['scans']))
-        if mask.any():
-            first_match_idx = df.index[mask][0]
-            peaks = np.column_stack((spec.peaks.mz, spec.peaks.intensities))
-            df.at[first_match_idx, 'peaks'] = peaks
-
-    # For tri spectra
-    spectra_from_path = list(load_from_mgf('data/tri_nowaterloss_stage2_result_merged.mgf'))
-    for spec in tqdm(spectra_from_path):
-        mask = (df['id'].str.startswith('tri_')) & (df['stage2_merged_scan'] == int(spec.metadata['scans']))
-        if mask.any():
-            first_match_idx = df.index[mask][0]
-            peaks = np.column_stack((spec.peaks.mz, spec.peaks.intensities))
-            df.at[first_match_idx, 'peaks'] = peaks
-
-    df.to_csv('out/merged_db_all_metadata_with_ms2.tsv', sep='\t', index=False)
-    df.to_pickle('out/merged_db_all_metadata_with_ms2.pkl')
-
-
-def create_gnps_files():
-    df = pd.read_pickle('out/merged_db_all_metadata_with_ms2.pkl')
-
-    out_rows = []
-    new_scan = 1
-    for i, row in tqdm(df.iterrows(), total=df.shape[0]):
-
-        out_row = {
-            'FILENAME': 'ba_isomer.mgf',
-            'SEQ': '*..*',
-            'COMPOUND_NAME': row['new_name'],
-            'MOLECULEMASS': row['precmz'],
-            'INSTRUMENT': 'Orbitrap',
-            'IONSOURCE': 'LC-ESI',
-            'EXTRACTSCAN': new_scan,
-            'SMILES': 'N/A',
-            'INCHI': 'N/A',
-            'INCHIAUX': 'N/A',
-            'CHARGE': '1',
-            'IONMODE': 'Positive',
-            'PUBMED': 'N/A',
-            'ACQUISITION': 'Crude',
-            'EXACTMASS': row['precmz'] - 1.007276,
-            'DATACOLLECTOR': 'Ipsita Mohanty',
-            'ADDUCT': '[M+H]+',
-            'CASNUMBER': 'N/A',
-            'PI': 'Pieter Dorrestein',
-            'LIBQUALITY': '4',
-            'GENUS': 'N/A',
-            'SPECIES': 'N/A',
-            'INTEREST': 'N/A',
-            'STRAIN': 'N/A'
-        }
-        out_rows.append(out_row)
-        new_scan += 1
-
-    out_df = pd.DataFrame(out_rows)
-    out_df.to_csv('out/ba_isomer.tsv', sep='\t', index=False)
-
-    with open('out/ba_isomer.mgf', 'w') as f:
-        new_scan = 1
-        for i, row in df.iterrows():
-
-            f.write('BEGIN IONS\n')
-            f.write(f'TITLE={row["new_name"]}\n')
-            f.write(f'PEPMASS={row["precmz"]}\n')
-            f.write(f'SCANS={new_scan}\n')
-            for mz, intensity in row['peaks']:
-                f.write(f'{mz} {intensity}\n')
-            f.write('END IONS\n\n')
-            new_scan += 1
-
-
-def load_from_usi(usi):
-    """
-    Load spectrum from USI
-    :param usi: USI
-    :return: spectrum
-    """
-    url = 'https://metabolomics-usi.gnps2.org/json/?usi1=' + usi
-    response = get(url, timeout=10)
-    json_data = loads(response.text)
-
-    # check if the USI is valid
-    if 'error' in json_data:
-        raise ValueError
-
-    prec_mz = json_data['precursor_mz']
-    peaks = np.asarray(json_data['peaks'])
-
-    return prec_mz, peaks
 
+    # stream the mono, di, tri spectra into a (prefix, scan) -> row index, the last spectrum of a scan wins
+    spectrum_peaks = {}
+    for prefix in ['mono', 'di', 'tri']:
+        scan_row = _scan_row_index(df, prefix)
+        for spec in tqdm(load_from_mgf(f'data/{prefix}_nowaterloss_stage2_result_merged.mgf')):
+            row = scan_row.get(int(spec.metadata['scans']))
+            if row is not None:
+                spectrum_peaks[row] = (spec.peaks.mz, spec.peaks.intensities)
+
+    # contiguous (mz, intensity) buffer, peaks of row i are [offsets[i], offsets[i + 1])
+    counts = np.zeros(df.shape[0], dtype=np.int64)
+    for row, (mz, _) in spectrum_peaks.items():
+        counts[row] = len(mz)
+    offsets = np.zeros(df.shape[0] + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    peaks = np.empty((offsets[-1], 2))
+    for row, (mz, intensity) in spectrum_peaks.items():
+        peaks[offsets[row]:offsets[row + 1], 0] = mz
+        peaks[offsets[row]:offsets[row + 1], 1] = intensity
+
+    has_peaks = np.zeros(df.shape[0], dtype=bool)
+    has_peaks[list(spectrum_peaks)] = True
+
+    save_library_artifact('out/merged_db_all_metadata_with_ms2', df, offsets, peaks, has_peaks,
+                          dtype=dtype, compress=compress)
+
+    if legacy_outputs:
+        # peak cells are views of the buffer, None for rows without a spectrum
+        peak_cells = np.empty(df.shape[0], dtype=object)
+        for row in spectrum_peaks:
+            peak_cells[row] = peaks[offsets[row]:offsets[row + 1]]
+        df['peaks'] = peak_cells
+
+        df.to_csv('out/merged_db_all_metadata_with_ms2.tsv', sep='\t', index=False)
+        df.to_pickle('out/merged_db_all_metadata_with_ms2.pkl')
+
+
+# GNPS batch upload columns, None for the columns filled per spectrum
+GNPS_COLUMNS = {
+    'FILENAME': None,
+    'SEQ': '*..*',
+    'COMPOUND_NAME': None,
+    'MOLECULEMASS': None,
+    'INSTRUMENT': 'Orbitrap',
+    'IONSOURCE': 'LC-ESI',
+    'EXTRACTSCAN': None,
+    'SMILES': 'N/A',
+    'INCHI': 'N/A',
+    'INCHIAUX': 'N/A',
+    'CHARGE': '1',
+    'IONMODE': 'Positive',
+    'PUBMED': 'N/A',
+    'ACQUISITION': 'Crude',
+    'EXACTMASS': None,
+    'DATACOLLECTOR': 'Ipsita Mohanty',
+    'ADDUCT': '[M+H]+',
+    'CASNUMBER': 'N/A',
+    'PI': 'Pieter Dorrestein',
+    'LIBQUALITY': '4',
+    'GENUS': 'N/A',
+    'SPECIES': 'N/A',
+    'INTEREST': 'N/A',
+    'STRAIN': 'N/A'
+}
+
+
+def _gnps_metadata(names, precmz, filename, scans):
+    """
+    GNPS metadata table of a chunk of spectra
+    """
+    out_df = pd.DataFrame({x: value for x, value in GNPS_COLUMNS.items() if value is not None},
+                          index=range(len(names)))
+    out_df['FILENAME'] = filename
+    out_df['COMPOUND_NAME'] = names
+    out_df['MOLECULEMASS'] = precmz
+    out_df['EXTRACTSCAN'] = scans
+    out_df['EXACTMASS'] = precmz - 1.007276
+    return out_df[list(GNPS_COLUMNS)]
+
+
+def _format_values(values):
+    """
+    Shortest repr of each value, as str() prints them (float32 values keep their float32 repr)
+    """
+    if values.dtype == np.float32:
+        return values.astype(str).tolist()
+    return list(map(repr, values.tolist()))
+
+
+def _format_mgf(names, precmz, scans, peaks, offsets):
+    """
+    mgf text of a chunk of spectra, peaks of spectrum i are peaks[offsets[i]:offsets[i + 1]]
+    """
+    # peak lines formatted in bulk
+    peak_lines = [x + ' ' + y for x, y in zip(_format_values(peaks[:, 0]), _format_values(peaks[:, 1]))]
+    offsets = offsets - offsets[0]
+
+    blocks = []
+    for i, (name, mz, scan) in enumerate(zip(names, _format_values(precmz), scans)):
+        peak_text = '\n'.join(peak_lines[offsets[i]:offsets[i + 1]])
+        blocks.append(f'BEGIN IONS\nTITLE={name}\nPEPMASS={mz}\nSCANS={scan}\n'
+                      + (peak_text + '\n' if peak_text else '') + 'END IONS\n\n')
+    return ''.join(blocks)
+
+
+def create_gnps_files(max_spectra_per_file=None, chunk_size=10000, n_workers=1):
+    """
+    Write the GNPS batch upload files (out/ba_isomer.tsv and out/ba_isomer.mgf) in one pass, chunk by chunk.
+    max_spectra_per_file: split into ba_isomer_1.tsv / .mgf, ba_isomer_2 ... for GNPS upload limits,
+    scans restart at 1 in every part
+    n_workers: > 1 to format the mgf chunks in a process pool
+    """
+    artifact = load_library_artifact('out/merged_db_all_metadata_with_ms2', columns=['new_name', 'precmz'])
+    names = artifact['metadata']['new_name'].astype(object).values
+    precmz = artifact['metadata']['precmz'].values
+    offsets = artifact['offsets']
+    n = len(names)
+
+    if max_spectra_per_file is None:
+        parts = [('ba_isomer', 0, n)]
+    else:
+        parts = [(f'ba_isomer_{k + 1}', start, min(start + max_spectra_per_file, n))
+                 for k, start in enumerate(range(0, n, max_spectra_per_file))]
+
+    executor = ProcessPoolExecutor(max_workers=n_workers) if n_workers > 1 else None
+    for part_name, part_start, part_end in parts:
+        chunks = [(start, min(start + chunk_size, part_end))
+                  for start in range(part_start, max(part_end, part_start + 1), chunk_size)]
+        chunk_args = ((names[start:end], precmz[start:end], np.arange(start - part_start + 1, end - part_start + 1),
+                       np.asarray(artifact['peaks'][offsets[start]:offsets[end]]), offsets[start:end + 1])
+                      for start, end in chunks)
+        if executor is None:
+            results = ((args, _format_mgf(*args)) for args in chunk_args)
+        else:
+            chunk_args = list(chunk_args)
+            results = zip(chunk_args, executor.map(_format_mgf, *zip(*chunk_args)))
+
+        with open(f'out/{part_name}.tsv', 'w') as tsv_file, open(f'out/{part_name}.mgf', 'w') as mgf_file:
+            for k, (args, mgf_text) in enumerate(tqdm(results, total=len(chunks))):
+                chunk_names, chunk_precmz, scans = args[:3]
+                metadata_df = _gnps_metadata(chunk_names, chunk_precmz, f'{part_name}.mgf', scans)
+                metadata_df.to_csv(tsv_file, sep='\t', index=False, header=k == 0)
+                mgf_file.write(mgf_text)
+
+    if executor is not None:
+        executor.shutdown()
 
 
 if __name__ == '__main__':
@@ -190,6 +260,11 @@ if __name__ == '__main__':
     # merge_df()
 
     # add_ms2()
+    # or a float32 peak buffer, half the size (the GNPS files then hold the rounded values)
+    # add_ms2(dtype=np.float32)
+
+    # reference spectra of library entries by USI, in one batched pass, later runs read data/usi_cache
+    # usi_spectra = load_from_usis(usi_ls)
 
     create_gnps_files()
 
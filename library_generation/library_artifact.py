@@ -0,0 +1,60 @@
+"""
+Compact merged-library artifact: a directory with the metadata table as Parquet and all peaks in a single
+(n_peaks, 2) buffer of (mz, intensity) with CSR-style row offsets.
+
+    metadata.parquet   one row per library entry
+    offsets.npy        int64, peaks of row i are [offsets[i], offsets[i + 1])
+    has_peaks.npy      bool, False for rows without a spectrum
+    peaks.npy          float64 by default (float32 on request), memory-mapped when loaded
+    peaks.npz          instead of the three .npy files when compressed (loaded into memory)
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+
+def save_library_artifact(out_dir, metadata_df, offsets, peaks, has_peaks, dtype=np.float64, compress=False):
+    """
+    Write the artifact. dtype: peak buffer type (float64 keeps the exact mgf values, float32 halves the size)
+    compress: zstd Parquet and a compressed .npz for the peaks, smaller but not memory-mappable
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    peaks = np.asarray(peaks, dtype=dtype)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    has_peaks = np.asarray(has_peaks, dtype=bool)
+
+    metadata_df.to_parquet(os.path.join(out_dir, 'metadata.parquet'), index=False,
+                           compression='zstd' if compress else 'snappy')
+
+    # remove the files of the other layout, if any
+    for name in ['peaks.npz'] if not compress else ['offsets.npy', 'has_peaks.npy', 'peaks.npy']:
+        if os.path.exists(os.path.join(out_dir, name)):
+            os.remove(os.path.join(out_dir, name))
+
+    if compress:
+        np.savez_compressed(os.path.join(out_dir, 'peaks.npz'), offsets=offsets, has_peaks=has_peaks, peaks=peaks)
+    else:
+        np.save(os.path.join(out_dir, 'offsets.npy'), offsets)
+        np.save(os.path.join(out_dir, 'has_peaks.npy'), has_peaks)
+        np.save(os.path.join(out_dir, 'peaks.npy'), peaks)
+
+
+def load_library_artifact(out_dir, mmap_mode='r', columns=None):
+    """
+    Load the artifact as a dict of metadata (DataFrame, only the given columns if any), offsets, has_peaks
+    and peaks. Arrays are memory-mapped (zero-copy) unless the artifact is compressed or mmap_mode is None.
+    """
+    artifact = {'metadata': pd.read_parquet(os.path.join(out_dir, 'metadata.parquet'), columns=columns)}
+
+    npz_path = os.path.join(out_dir, 'peaks.npz')
+    if os.path.exists(npz_path):
+        with np.load(npz_path) as data:
+            for name in ['offsets', 'has_peaks', 'peaks']:
+                artifact[name] = data[name]
+    else:
+        for name in ['offsets', 'has_peaks', 'peaks']:
+            artifact[name] = np.load(os.path.join(out_dir, f'{name}.npy'), mmap_mode=mmap_mode)
+
+    return artifact
+
@@ -0,0 +1,142 @@
+"""
+add_ms2 and the GNPS export against the row-by-row versions they replaced, on a small synthetic library.
+Run from library_generation/: python -m pytest -q
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+from tqdm import tqdm
+from matchms.importing import load_from_mgf
+
+from gen_lib import add_ms2, create_gnps_files
+from library_artifact import load_library_artifact
+
+
+PREFIXES = ['mono', 'di', 'tri']
+
+
+def baseline_add_ms2():
+    """
+    add_ms2 of gen_lib before the library artifact
+    """
+    df = pd.read_csv('out/merged_db_all_metadata.tsv', sep='\t')
+    df['peaks'] = None
+
+    for prefix in PREFIXES:
+        spectra_from_path = list(load_from_mgf(f'data/{prefix}_nowaterloss_stage2_result_merged.mgf'))
+        for spec in tqdm(spectra_from_path):
+            mask = (df['id'].str.startswith(f'{prefix}_')) & (df['stage2_merged_scan'] == int(spec.metadata['scans']))
+            if mask.any():
+                first_match_idx = df.index[mask][0]
+                peaks = np.column_stack((spec.peaks.mz, spec.peaks.intensities))
+                df.at[first_match_idx, 'peaks'] = peaks
+
+    df.to_csv('out/merged_db_all_metadata_with_ms2.tsv', sep='\t', index=False)
+    df.to_pickle('out/merged_db_all_metadata_with_ms2.pkl')
+
+
+def baseline_create_gnps_files():
+    """
+    create_gnps_files of gen_lib before the bulk export
+    """
+    df = pd.read_pickle('out/merged_db_all_metadata_with_ms2.pkl')
+
+    out_rows = []
+    new_scan = 1
+    for i, row in df.iterrows():
+        out_rows.append({
+            'FILENAME': 'ba_isomer.mgf', 'SEQ': '*..*', 'COMPOUND_NAME': row['new_name'],
+            'MOLECULEMASS': row['precmz'], 'INSTRUMENT': 'Orbitrap', 'IONSOURCE': 'LC-ESI', 'EXTRACTSCAN': new_scan,
+            'SMILES': 'N/A', 'INCHI': 'N/A', 'INCHIAUX': 'N/A', 'CHARGE': '1', 'IONMODE': 'Positive',
+            'PUBMED': 'N/A', 'ACQUISITION': 'Crude', 'EXACTMASS': row['precmz'] - 1.007276,
+            'DATACOLLECTOR': 'Ipsita Mohanty', 'ADDUCT': '[M+H]+', 'CASNUMBER': 'N/A', 'PI': 'Pieter Dorrestein',
+            'LIBQUALITY': '4', 'GENUS': 'N/A', 'SPECIES': 'N/A', 'INTEREST': 'N/A', 'STRAIN': 'N/A'
+        })
+        new_scan += 1
+
+    pd.DataFrame(out_rows).to_csv('out/ba_isomer.tsv', sep='\t', index=False)
+
+    with open('out/ba_isomer.mgf', 'w') as f:
+        new_scan = 1
+        for i, row in df.iterrows():
+            f.write('BEGIN IONS\n')
+            f.write(f'TITLE={row["new_name"]}\n')
+            f.write(f'PEPMASS={row["precmz"]}\n')
+            f.write(f'SCANS={new_scan}\n')
+            for mz, intensity in row['peaks']:
+                f.write(f'{mz} {intensity}\n')
+            f.write('END IONS\n\n')
+            new_scan += 1
+
+
+def _write_library(work_dir, all_matched, seed=0):
+    """
+    Merged mgf files of the three groups and the merged metadata table in work_dir/data and work_dir/out.
+    all_matched: every row has a spectrum (otherwise some rows have none and some scans two rows)
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.join(work_dir, 'data'), exist_ok=True)
+    os.makedirs(os.path.join(work_dir, 'out'), exist_ok=True)
+
+    rows = []
+    for prefix in PREFIXES:
+        with open(os.path.join(work_dir, 'data', f'{prefix}_nowaterloss_stage2_result_merged.mgf'), 'w') as file:
+            for scan in range(1, 16):
+                peaks = np.sort(np.round(rng.uniform(50, 500, rng.integers(1, 8)), 4))
+                file.write(f'BEGIN IONS\nPEPMASS={rng.uniform(300, 500):.4f}\nSCANS={scan}\n')
+                file.write(''.join(f'{mz} {np.round(rng.uniform(1, 1e5), 2)}\n' for mz in peaks))
+                file.write('END IONS\n\n')
+        scans = list(range(1, 16)) if all_matched else [1, 2, 2, 5, 40, 7, 9, 9, 15]
+        rows += [{'id': f'{prefix}_{i}', 'stage2_merged_scan': scan, 'precmz': np.round(rng.uniform(300, 500), 4),
+                  'new_name': f'[BA_core: 3-OH] {prefix} {i}'} for i, scan in enumerate(scans)]
+
+    pd.DataFrame(rows).sample(frac=1, random_state=seed).to_csv(
+        os.path.join(work_dir, 'out', 'merged_db_all_metadata.tsv'), sep='\t', index=False)
+
+
+def _read_bytes(path):
+    with open(path, 'rb') as file:
+        return file.read()
+
+
+@pytest.mark.parametrize('all_matched', [True, False])
+def test_add_ms2(tmp_path, monkeypatch, all_matched):
+    for name in ['baseline', 'new']:
+        _write_library(str(tmp_path / name), all_matched)
+
+    monkeypatch.chdir(tmp_path / 'baseline')
+    baseline_add_ms2()
+    monkeypatch.chdir(tmp_path / 'new')
+    add_ms2()
+
+    assert _read_bytes('out/merged_db_all_metadata_with_ms2.tsv') == \
+        _read_bytes('../baseline/out/merged_db_all_metadata_with_ms2.tsv')
+
+    expected = pd.read_pickle('../baseline/out/merged_db_all_metadata_with_ms2.pkl')
+    for df in [pd.read_pickle('out/merged_db_all_metadata_with_ms2.pkl'),
+               load_library_artifact('out/merged_db_all_metadata_with_ms2')['metadata']]:
+        assert df.drop(columns='peaks', errors='ignore').equals(expected.drop(columns='peaks'))
+
+    artifact = load_library_artifact('out/merged_db_all_metadata_with_ms2')
+    for i, peaks in enumerate(expected['peaks']):
+        assert artifact['has_peaks'][i] == (peaks is not None)
+        if peaks is not None:
+            assert np.array_equal(artifact['peaks'][artifact['offsets'][i]:artifact['offsets'][i + 1]], peaks)
+
+
+@pytest.mark.parametrize('n_workers', [1, 2])
+def test_create_gnps_files(tmp_path, monkeypatch, n_workers):
+    for name in ['baseline', 'new']:
+        _write_library(str(tmp_path / name), all_matched=True)
+
+    monkeypatch.chdir(tmp_path / 'baseline')
+    baseline_add_ms2()
+    baseline_create_gnps_files()
+    monkeypatch.chdir(tmp_path / 'new')
+    add_ms2(legacy_outputs=False)
+    create_gnps_files(chunk_size=4, n_workers=n_workers)
+
+    for name in ['ba_isomer.tsv', 'ba_isomer.mgf']:
+        assert _read_bytes(f'out/{name}') == _read_bytes(f'../baseline/out/{name}'), name
@@ -0,0 +1,104 @@
+"""
+USI loader against a local stand-in of the USI service. Run from library_generation/: python -m pytest -q
+"""
+import json
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+import pytest
+
+from gen_lib import load_from_usi, load_from_usis
+
+
+SPECTRA = {
+    'mzspec:TEST:a:scan:1': {'precursor_mz': 391.28, 'peaks': [[105.07, 10.0], [391.28, 100.0]]},
+    'mzspec:TEST:b:scan:2': {'precursor_mz': 407.28, 'peaks': [[255.21, 5.5]]},
+}
+# answered with 503 this many times before the spectrum
+FLAKY = {'mzspec:TEST:b:scan:2': 2}
+
+
+class USIHandler(BaseHTTPRequestHandler):
+    requests = Counter()
+
+    def do_GET(self):
+        usi = parse_qs(urlparse(self.path).query)['usi1'][0]
+        self.requests[usi] += 1
+
+        if self.requests[usi] <= FLAKY.get(usi, 0):
+            self.send_response(503)
+            self.end_headers()
+            return
+
+        if usi in SPECTRA:
+            body = SPECTRA[usi]
+        elif usi == 'mzspec:TEST:malformed:scan:3':
+            body = {'precursor_mz': 1.0, 'peaks': [1.0, 2.0, 3.0]}
+        else:
+            body = {'error': 'not found'}
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps(body).encode())
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def usi_url():
+    USIHandler.requests.clear()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), USIHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}/json/?usi1='
+    server.shutdown()
+    server.server_close()
+
+
+def test_load_from_usi(usi_url):
+    prec_mz, peaks = load_from_usi('mzspec:TEST:a:scan:1', usi_url=usi_url)
+    assert prec_mz == 391.28
+    assert np.array_equal(peaks, [[105.07, 10.0], [391.28, 100.0]])
+
+    with pytest.raises(ValueError):
+        load_from_usi('mzspec:TEST:missing:scan:9', usi_url=usi_url)
+
+
+def test_load_from_usis(usi_url, tmp_path):
+    usi_ls = list(SPECTRA) + ['mzspec:TEST:missing:scan:9', 'mzspec:TEST:malformed:scan:3', 'mzspec:TEST:a:scan:1']
+    cache_dir = str(tmp_path / 'usi_cache')
+
+    results = load_from_usis(usi_ls, cache_dir=cache_dir, n_workers=4, usi_url=usi_url, backoff=0)
+    assert set(results) == set(usi_ls)
+    for usi, spectrum in SPECTRA.items():
+        assert results[usi][0] == spectrum['precursor_mz']
+        assert np.array_equal(results[usi][1], spectrum['peaks'])
+    assert results['mzspec:TEST:missing:scan:9'] is None
+    assert results['mzspec:TEST:malformed:scan:3'] is None
+
+    # the flaky USI is retried until it is served, the others are requested once (duplicates too)
+    assert USIHandler.requests['mzspec:TEST:b:scan:2'] == FLAKY['mzspec:TEST:b:scan:2'] + 1
+    assert USIHandler.requests['mzspec:TEST:a:scan:1'] == 1
+
+    # the second run is served from the cache, failed USIs are asked again
+    n_requests = sum(USIHandler.requests.values())
+    cached = load_from_usis(usi_ls, cache_dir=cache_dir, usi_url=usi_url, backoff=0)
+    assert sum(USIHandler.requests.values()) == n_requests + 2
+    for usi in SPECTRA:
+        assert cached[usi][0] == results[usi][0] and np.array_equal(cached[usi][1], results[usi][1])
+
+
+def test_retries_exhausted(usi_url, tmp_path):
+    FLAKY['mzspec:TEST:a:scan:1'] = 10
+    try:
+        results = load_from_usis(['mzspec:TEST:a:scan:1'], cache_dir=str(tmp_path / 'usi_cache'), usi_url=usi_url,
+                                 retries=2, backoff=0)
+    finally:
+        del FLAKY['mzspec:TEST:a:scan:1']
+
+    assert results['mzspec:TEST:a:scan:1'] is None
+    assert USIHandler.requests['mzspec:TEST:a:scan:1'] == 3
@@ -0,0 +1,125 @@
+"""
+Spectrum lookup by USI through the GNPS2 metabolomics USI service, with a pooled session, retries with
+backoff, bounded concurrency and an on-disk cache, so that later runs do not hit the service again.
+"""
+import os
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+USI_URL = 'https://metabolomics-usi.gnps2.org/json/?usi1='
+
+
+def make_usi_session(pool_size=8, retries=3, backoff=0.5):
+    """
+    Session with a connection pool of pool_size, retrying failed connections and 429 / 5xx responses
+    with exponential backoff (backoff, 2 * backoff, ... seconds)
+    """
+    retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=['GET'], raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def load_from_usi(usi, session=None, usi_url=USI_URL, timeout=10):
+    """
+    Load spectrum from USI
+    :param usi: USI
+    :return: spectrum
+    """
+    url = usi_url + usi
+    response = (session or requests).get(url, timeout=timeout)
+    json_data = json.loads(response.text)
+
+    # check if the USI is valid
+    if not isinstance(json_data, dict) or 'error' in json_data:
+        raise ValueError(f'no spectrum for {usi}')
+
+    return _parse_spectrum(json_data)
+
+
+def _parse_spectrum(json_data):
+    """
+    (prec_mz, peaks) of a spectrum object, ValueError if it is not {'precursor_mz': number, 'peaks': [[mz, i], ...]}
+    """
+    try:
+        prec_mz = float(json_data['precursor_mz'])
+        peaks = np.asarray(json_data['peaks'], dtype=np.float64)
+    except (KeyError, TypeError) as e:
+        raise ValueError(f'malformed spectrum: {e!r}')
+    if peaks.size == 0:
+        peaks = peaks.reshape(0, 2)
+    if peaks.ndim != 2 or peaks.shape[1] != 2:
+        raise ValueError(f'malformed peaks of shape {peaks.shape}')
+
+    return prec_mz, peaks
+
+
+def _cache_path(cache_dir, usi):
+    return os.path.join(cache_dir, hashlib.sha256(usi.encode()).hexdigest() + '.json')
+
+
+def _read_cache(cache_dir, usi):
+    try:
+        with open(_cache_path(cache_dir, usi)) as file:
+            return _parse_spectrum(json.load(file))
+    except (OSError, ValueError):
+        return None
+
+
+def _write_cache(cache_dir, usi, prec_mz, peaks):
+    path = _cache_path(cache_dir, usi)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump({'usi': usi, 'precursor_mz': prec_mz, 'peaks': peaks.tolist()}, file)
+    os.replace(tmp_path, path)
+
+
+def load_from_usis(usi_ls, cache_dir='data/usi_cache', n_workers=8, usi_url=USI_URL, retries=3, backoff=0.5,
+                   timeout=10):
+    """
+    Resolve many USIs in one batched pass: cached spectra are read from cache_dir, the others are fetched
+    by n_workers threads sharing one pooled session and then cached.
+    Returns a dict of USI -> (prec_mz, peaks), None for USIs that could not be resolved
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+
+    results = {}
+    missing = []
+    for usi in dict.fromkeys(usi_ls):
+        results[usi] = _read_cache(cache_dir, usi)
+        if results[usi] is None:
+            missing.append(usi)
+
+    if not missing:
+        return results
+
+    session = make_usi_session(pool_size=n_workers, retries=retries, backoff=backoff)
+
+    def fetch(usi):
+        # unresolved USI, service error or malformed payload: this USI fails, the batch goes on
+        try:
+            return load_from_usi(usi, session=session, usi_url=usi_url, timeout=timeout)
+        except (ValueError, requests.RequestException):
+            return None
+
+    with session, ThreadPoolExecutor(max_workers=n_workers) as executor:
+        for usi, spectrum in zip(missing, executor.map(fetch, missing)):
+            results[usi] = spectrum
+            if spectrum is not None:
+                _write_cache(cache_dir, usi, *spectrum)
+
+    n_failed = sum(results[x] is None for x in missing)
+    print(f'USIs: {len(results) - len(missing)} from cache, {len(missing) - n_failed} fetched, {n_failed} failed')
+
+    return results